@@ -3,10 +3,26 @@
 # pyright: reportInvalidTypeForm=false
 
 from __future__ import annotations
+import hashlib
+import json
+import math
+import os
+import struct
+import tempfile
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from types import SimpleNamespace
 from typing import Type, TypeVar
 from typing import cast
 
 import bpy
+import bmesh
+from bpy.app.handlers import persistent
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
+import numpy as np
 from bpy.props import (
     BoolProperty,
     CollectionProperty,
@@ -33,7 +49,6 @@ from bpy.types import (
     ShaderNodeVectorMath,
 )
 
-import _bpy
 
 
 bl_info = {
@@ -72,6 +87,25 @@ solution_bake_modes = {
     'NORMAL' : 'NORMAL',
     'EMISSION' : 'EMIT' }
 
+enum_aa_filters = (
+    ('BOX', "Box", "Area average"),
+    ('LANCZOS', "Lanczos", "Lanczos 3, sharpest"),
+    ('MITCHELL', "Mitchell", "Mitchell-Netravali, balanced sharpness and ringing"))
+
+enum_export_formats = (
+    ('PNG', "PNG", ''),
+    ('OPEN_EXR', "OpenEXR", ''),
+    ('TARGA', "Targa", ''))
+
+enum_export_depths = (
+    ('8', "8", "8 bit, PNG and Targa"),
+    ('16', "16", "16 bit PNG or half float EXR"),
+    ('32', "32", "Full float EXR"))
+
+enum_exr_codecs = (
+    ('ZIP', "ZIP", "Lossless, zlib in blocks of 16 lines"),
+    ('NONE', "None", ''))
+
 enum_normal_direction = (
     ('POS_X', "+X", ''),
     ('POS_Y', "+Y", ''),
@@ -80,16 +114,16 @@ enum_normal_direction = (
     ('NEG_Y', "-Y", ''),
     ('NEG_Z', "-Z", ''))
 
-def update_solution():
-    update_node_solution()
+def update_solution(context):
+    schedule_node_update(BakingSolutionSettings.from_scene(context.scene).node_update_delay)
 
 def property_update(self, context):
-    update_solution()
+    update_solution(context)
 
 def check_empty_sources(self, context):
-    for source in self:
-        if source.object is None:
-            self.remove(source)
+    for index in reversed(range(len(self))):
+        if self[index].object is None:
+            self.remove(index)
 
 class BakingSolutionImageTarget(bpy.types.PropertyGroup):
     """ Output image settings """
@@ -102,6 +136,31 @@ class BakingSolutionImageTargets(bpy.types.PropertyGroup):
     NORMAL: PointerProperty(type = BakingSolutionImageTarget)
     EMISSION: PointerProperty(type = BakingSolutionImageTarget)
 
+def render_profile_type(name: str, use_profile: bool, samples: int, max_bounces: int) -> type:
+    """ Render profile property group with mode specific defaults """
+    return type(name, (bpy.types.PropertyGroup,), {'__annotations__': {
+        'use_profile': BoolProperty(name = "Use Render Profile", default = use_profile, description = "Override Cycles settings while baking this mode"),
+        'samples': IntProperty(name = "Samples", default = samples, min = 1),
+        'max_bounces': IntProperty(name = "Bounces", default = max_bounces, min = 0),
+        'use_adaptive_sampling': BoolProperty(name = "Adaptive Sampling", default = False),
+        'adaptive_threshold': FloatProperty(name = "Noise Threshold", default = 0.01, min = 0.0, precision = 4),
+        'threads': IntProperty(name = "Threads", default = 0, min = 0, description = "Render threads, 0 detects automatically"),
+        'use_denoising': BoolProperty(name = "Denoise", default = False, description = "Bake noisy modes at low samples and denoise them with normal/albedo guides"),
+        'denoise_samples': IntProperty(name = "Denoise Samples", default = 16, min = 1, description = "Samples used while denoising") }})
+
+BakingRenderProfileCombined = render_profile_type("BakingRenderProfileCombined", False, 128, 4)
+BakingRenderProfileEmit = render_profile_type("BakingRenderProfileEmit", True, 1, 0)
+BakingRenderProfileMasks = render_profile_type("BakingRenderProfileMasks", True, 64, 1)
+BakingRenderProfileNormal = render_profile_type("BakingRenderProfileNormal", False, 128, 4)
+
+class BakingSolutionRenderProfiles(bpy.types.PropertyGroup):
+    """ Cycles settings applied while baking each mode """
+    COMBINED: PointerProperty(type = BakingRenderProfileCombined)
+    DIFFUSE: PointerProperty(type = BakingRenderProfileEmit)
+    MASKS: PointerProperty(type = BakingRenderProfileMasks)
+    NORMAL: PointerProperty(type = BakingRenderProfileNormal)
+    EMISSION: PointerProperty(type = BakingRenderProfileEmit)
+
 class BakingSolutionNodeSettings(bpy.types.PropertyGroup):
     combined_emission_mul: FloatProperty(name = "Emission Multiplier", default = 1.0, update = property_update)
     combined_emission_clamp: BoolProperty(name = "Clamp Emission", default = True, update = property_update)
@@ -118,8 +177,15 @@ class BakingSource(bpy.types.PropertyGroup):
     object: PointerProperty(type = bpy.types.Object, name = "Object")
     is_enabled: BoolProperty(default = True, name = "Enable Bake", description = "Enable Bake")
 
+# Object types a source collection contributes
+SOURCE_TYPES = ('MESH', 'CURVE', 'SURFACE', 'META', 'FONT')
+
 class BakingGroup(bpy.types.PropertyGroup):
+    is_enabled: BoolProperty(default = True, name = "Enable Bake", description = "Include this group when baking all groups")
     sources: CollectionProperty(type = BakingSource)
+    source_index: IntProperty(default = 0)
+    source_collection: PointerProperty(type = bpy.types.Collection, name = "Source Collection",
+        description = "Objects in this collection and its children are baked as sources too, resolved at bake time")
     target: PointerProperty(type = bpy.types.Object, name = "Target")
     cage_object: PointerProperty(type = bpy.types.Object, name = "Cage")
     cage_extrusion: FloatProperty(default = 0, soft_min = 0, name = "Cage Extrusion")
@@ -127,6 +193,21 @@ class BakingGroup(bpy.types.PropertyGroup):
     solution_settings: PointerProperty(type = BakingSolutionNodeSettings)
     image_targets: PointerProperty(type = BakingSolutionImageTargets)
 
+    def enabled_sources(self) -> list[bpy.types.Object]:
+        """ Enabled explicit sources followed by the geometry of the source collection, without duplicates """
+        objects = {}
+        for source in self.sources:
+            if source.is_enabled and source.object is not None:
+                objects[source.object.name] = source.object
+        if self.source_collection is not None:
+            for obj in self.source_collection.all_objects:
+                if obj.type in SOURCE_TYPES and obj.name not in objects:
+                    objects[obj.name] = obj
+        for obj in (self.target, self.cage_object):
+            if obj is not None:
+                objects.pop(obj.name, None)
+        return list(objects.values())
+
 class BakingSolutionSettings(bpy.types.PropertyGroup):
     solution_mode: EnumProperty(
         description = "BakingSolution node mode",
@@ -135,8 +216,42 @@ class BakingSolutionSettings(bpy.types.PropertyGroup):
         update = property_update)
     groups: CollectionProperty(type = BakingGroup)
     group_index: IntProperty(default = -1)
+    draft_scale: FloatProperty(name = "Draft Scale", default = 0.25, min = 0.05, max = 1.0, subtype = 'FACTOR',
+        description = "Resolution of draft bakes relative to the output image")
+    draft_samples: IntProperty(name = "Draft Samples", default = 4, min = 1, description = "Cycles samples of draft bakes")
+    node_update_delay: FloatProperty(name = "Node Update Delay", default = 0.15, min = 0.0, soft_max = 1.0,
+        description = "Seconds edits of node settings wait for further edits before the node group is updated, 0 updates on every edit")
     solution_defaults: PointerProperty(type = BakingSolutionNodeSettings)
     aa_scale: FloatProperty(name = "AA Scale", default = 1.0, min = 1.0, max = 8.0, step = 50)
+    aa_filter: EnumProperty(name = "AA Filter", items = enum_aa_filters, default = 'BOX', description = "Filter used to downsample supersampled bakes")
+    use_cache: BoolProperty(name = "Use Bake Cache", default = False, description = "Restore unchanged bakes from disk instead of baking them again")
+    cache_dir: StringProperty(name = "Cache Directory", default = "//bake_cache", subtype = 'DIR_PATH')
+    cache_max_size: IntProperty(name = "Max Size (MB)", default = 2048, min = 0)
+    cache_max_age: IntProperty(name = "Max Age (days)", default = 30, min = 0, description = "0 keeps entries until the size limit")
+    keep_canonical_bakes: BoolProperty(name = "Keep for Repack", default = False,
+        description = "Keep MASKS and NORMAL bakes in memory so Repack can change their layout, hashes the scene after each bake when the bake cache is off")
+    use_source_culling: BoolProperty(name = "Cull Distant Sources", default = True,
+        description = "Leave sources out of a bake when bake rays can't reach them, needs a ray length")
+    use_source_proxies: BoolProperty(name = "Freeze Sources", default = False,
+        description = "Bake sources with modifiers from hidden copies of their evaluated mesh, made once per bake session for all modes")
+    render_profiles: PointerProperty(type = BakingSolutionRenderProfiles)
+    log_path: StringProperty(name = "Log File", subtype = 'FILE_PATH', description = "JSON lines bake timing log, system temp directory if empty")
+    aa_tiled: BoolProperty(name = "Tiled", default = False, description = "Bake supersampled images in UV tiles to keep memory near one tile")
+    aa_tile_size: IntProperty(name = "Tile Size", default = 1024, min = 64, description = "Tile size in final image pixels")
+    use_export: BoolProperty(name = "Export", default = False, description = "Write baked and cached images to disk after each bake")
+    export_path: StringProperty(name = "Path", default = "//baked/{target}_{mode}",
+        description = "Export path without extension, {blend} {group} {target} {mode} and {image} are replaced")
+    export_format: EnumProperty(name = "Format", items = enum_export_formats, default = 'PNG')
+    export_color_depth: EnumProperty(name = "Color Depth", items = enum_export_depths, default = '8')
+    export_compression: IntProperty(name = "Compression", default = 15, min = 0, max = 100, subtype = 'PERCENTAGE',
+        description = "zlib level of PNG and ZIP EXR, Targa is always written uncompressed")
+    export_exr_codec: EnumProperty(name = "Codec", items = enum_exr_codecs, default = 'ZIP')
+    export_threads: IntProperty(name = "Threads", default = 0, min = 0, description = "Export threads, 0 uses one per CPU")
+    use_margin_dilation: BoolProperty(name = "Dilate Margin", default = True,
+        description = "Bake without margin and extend UV islands by the bake margin in final image pixels afterwards")
+    use_memory_budget: BoolProperty(name = "Memory Budget", default = True,
+        description = "Bake in tiles or lower AA Scale when the estimated peak memory of a bake is over the budget")
+    memory_budget: IntProperty(name = "Budget (MB)", default = 0, min = 0, description = "0 uses half of the physical memory")
 
     @classmethod
     def from_scene(cls, scene: bpy.types.Scene) -> BakingSolutionSettings:
@@ -177,10 +292,7 @@ class OperatorAddGroupFromSelectedAndActive(bpy.types.Operator):
         active = context.active_object
         new_group = settings.groups.add()
         new_group.target = active
-        for obj in selection:
-            if obj != active:
-                newobj = new_group.sources.add()
-                newobj.object = obj
+        add_objects_to_sources(new_group.sources, [obj for obj in selection if obj != active])
         return {'FINISHED'}
 
 class OperatorAddGroup(bpy.types.Operator):
@@ -207,13 +319,34 @@ class OperatorRemoveCurrentGroup(bpy.types.Operator):
         settings.groups.remove(settings.group_index)
         return {'FINISHED'}
 
+def source_index(sources) -> dict[str, int]:
+    """ Object name -> index of its entry in sources """
+    return {source.object.name: index for index, source in enumerate(sources) if source.object is not None}
+
+def add_objects_to_sources(sources, objects) -> int:
+    """ Adds objects not in sources yet and enables the ones already there, returns the number added """
+    index = source_index(sources)
+    added = 0
+    for obj in objects:
+        if obj.name in index:
+            sources[index[obj.name]].is_enabled = True
+            continue
+        source = sources.add()
+        source.object = obj
+        index[obj.name] = len(sources) - 1
+        added += 1
+    return added
+
 def add_object_to_sources(sources, object):
-    for source in sources:
-        if source.object == object:
-            source.is_enabled = True
-            return
-    source = sources.add()
-    source.object = object
+    add_objects_to_sources(sources, [object])
+
+def remove_objects_from_sources(sources, objects) -> int:
+    """ Removes the entries of objects, returns the number removed """
+    index = source_index(sources)
+    indices = sorted({index[obj.name] for obj in objects if obj.name in index}, reverse = True)
+    for i in indices:
+        sources.remove(i)
+    return len(indices)
 
 class OperatorAddSelectedToActiveGroup(bpy.types.Operator):
     bl_idname = 'baking_solution.add_selected_to_active_group'
@@ -226,10 +359,52 @@ class OperatorAddSelectedToActiveGroup(bpy.types.Operator):
     def execute(self, context):
         group = BakingSolutionSettings.from_scene(context.scene).active_group
         if group is None: return {'FINISHED'}
-        for object in context.selected_objects:
-            add_object_to_sources(group.sources, object)
+        added = add_objects_to_sources(group.sources, [obj for obj in context.selected_objects if obj != group.target])
+        self.report({'INFO'}, "Added {} sources".format(added))
         return {'FINISHED'}
 
+class OperatorRemoveSelectedFromActiveGroup(bpy.types.Operator):
+    bl_idname = 'baking_solution.remove_selected_from_active_group'
+    bl_label = "Remove Selected Objects from Active Group"
+
+    @classmethod
+    def poll(cls, context):  # pyright: ignore
+        return BakingSolutionSettings.from_scene(context.scene).active_group is not None
+
+    def execute(self, context):
+        group = BakingSolutionSettings.from_scene(context.scene).active_group
+        removed = remove_objects_from_sources(group.sources, context.selected_objects)
+        group.source_index = min(group.source_index, max(0, len(group.sources) - 1))
+        self.report({'INFO'}, "Removed {} sources".format(removed))
+        return {'FINISHED'}
+
+class BAKING_SOLUTION_UL_sources(bpy.types.UIList):
+    """ Source objects of a group, only visible rows are drawn and they can be filtered by name """
+
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
+        row = layout.row(align = True)
+        if item.object is None:
+            row.label(text = "Missing", icon = 'ERROR')
+        else:
+            row.label(text = item.object.name, icon_value = layout.icon(item.object))
+        row.prop(item, 'is_enabled', text = "", icon = item.is_enabled and 'RESTRICT_RENDER_OFF' or 'RESTRICT_RENDER_ON', emboss = False)
+        op_remove = cast(OperatorRemoveFromActiveGroup, row.operator('baking_solution.remove_from_active_group', text = "", icon = 'X', emboss = False))
+        op_remove.remove_index = index
+
+    def filter_items(self, context, data, propname):
+        sources = getattr(data, propname)
+        if not self.filter_name and not self.use_filter_sort_alpha:
+            return [], []
+        names = [source.object is not None and source.object.name.lower() or "" for source in sources]
+        flags = []
+        if self.filter_name:
+            pattern = self.filter_name.lower()
+            flags = [pattern in name and self.bitflag_filter_item or 0 for name in names]
+        order = []
+        if self.use_filter_sort_alpha:
+            order = bpy.types.UI_UL_list.sort_items_helper(list(enumerate(names)), lambda entry: entry[1])
+        return flags, order
+
 class OperatorRemoveFromActiveGroup(bpy.types.Operator):
     bl_idname = 'baking_solution.remove_from_active_group'
     bl_label = "Remove"
@@ -247,184 +422,2526 @@ class OperatorRemoveFromActiveGroup(bpy.types.Operator):
         group.sources.remove(self.remove_index)
         return {'FINISHED'}
 
-def find_image_node(object, image) -> (bpy.types.Node, bpy.types.Material):
+# Target object name -> image name -> (material name, node name), dropped by depsgraph updates
+image_node_index: dict[str, dict[str, tuple[str, str]]] = {}
+
+def build_image_node_index(object) -> dict[str, tuple[str, str]]:
+    entries = {}
     for mat in object.data.materials:
+        if mat is None or mat.node_tree is None:
+            continue
+        for node in mat.node_tree.nodes:
+            if node.type == 'TEX_IMAGE' and node.image is not None:
+                entries.setdefault(node.image.name, (mat.name, node.name))
+    return entries
+
+def find_image_node(object, image) -> (bpy.types.Node, bpy.types.Material):
+    if object.data is None or image is None:
+        return None, None
+    entries = image_node_index.get(object.name)
+    if entries is None:
+        entries = image_node_index[object.name] = build_image_node_index(object)
+    found = entries.get(image.name)
+    if found is None:
+        return None, None
+    mat = bpy.data.materials.get(found[0])
+    node = mat and mat.node_tree and mat.node_tree.nodes.get(found[1])
+    if node is None or node.image != image:
+        # Renamed or edited without a depsgraph update, index it again
+        del image_node_index[object.name]
+        for mat in object.data.materials:
+            if mat is None or mat.node_tree is None:
+                continue
+            for node in mat.node_tree.nodes:
+                if node.type == 'TEX_IMAGE' and node.image == image:
+                    return node, mat
+        return None, None
+    return node, mat
+
+@persistent
+def invalidate_image_node_index(scene, depsgraph = None):
+    if not hasattr(depsgraph, 'updates'):  # load_post
+        image_node_index.clear()
+        return
+    for update in depsgraph.updates:
+        id = update.id
+        if isinstance(id, (bpy.types.Material, bpy.types.Mesh, bpy.types.Image)):
+            image_node_index.clear()
+            return
+        if isinstance(id, bpy.types.NodeTree) and not id.name.startswith("BakingSolution"):
+            image_node_index.clear()
+            return
+        if isinstance(id, bpy.types.Object) and update.is_updated_geometry:
+            image_node_index.pop(id.name, None)
+
+# Geometry
+
+def evaluated_triangles(obj: bpy.types.Object, depsgraph) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ World-space vertices (v, 3), loop triangle vertex indices (t, 3) and corner normals (t, 3, 3) """
+    obj_eval = obj.evaluated_get(depsgraph)
+    mesh = obj_eval.to_mesh()
+    try:
+        mesh.calc_loop_triangles()
+        vertices = np.empty(len(mesh.vertices) * 3, dtype = np.float64)
+        mesh.vertices.foreach_get('co', vertices)
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype = np.int64)
+        mesh.loop_triangles.foreach_get('vertices', triangles)
+        normals = np.empty(len(mesh.loop_triangles) * 9, dtype = np.float64)
+        mesh.loop_triangles.foreach_get('split_normals', normals)
+    finally:
+        obj_eval.to_mesh_clear()
+    matrix = np.array(obj.matrix_world, dtype = np.float64)
+    vertices = vertices.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3]
+    normals = normals.reshape(-1, 3, 3) @ np.linalg.inv(matrix[:3, :3])
+    normals /= np.maximum(np.linalg.norm(normals, axis = 2, keepdims = True), 1e-12)
+    return vertices, triangles.reshape(-1, 3), normals
+
+def uv_triangles(obj: bpy.types.Object, depsgraph) -> np.ndarray:
+    """ UV corners (t, 3, 2) of the evaluated mesh's loop triangles in the active UV map """
+    obj_eval = obj.evaluated_get(depsgraph)
+    mesh = obj_eval.to_mesh()
+    try:
+        uv_layer = mesh.uv_layers.active
+        if uv_layer is None:
+            raise ValueError("{} has no UV map".format(obj.name))
+        mesh.calc_loop_triangles()
+        uvs = np.empty(len(mesh.loops) * 2, dtype = np.float32)
+        uv_layer.data.foreach_get('uv', uvs)
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype = np.int64)
+        mesh.loop_triangles.foreach_get('loops', triangles)
+    finally:
+        obj_eval.to_mesh_clear()
+    return uvs.reshape(-1, 2)[triangles.reshape(-1, 3)]
+
+def connected_labels(corners: np.ndarray) -> np.ndarray:
+    """ Component index of each triangle (t, 3) of corner ids, triangles sharing a corner are connected.
+    Corners hook to the smallest label of their triangles and jump to their label's label until stable """
+    labels = np.arange(corners.max() + 1 if len(corners) else 0)
+    while True:
+        hooked = labels.copy()
+        np.minimum.at(hooked, corners.ravel(), np.repeat(labels[corners].min(axis = 1), 3))
+        hooked = hooked[hooked]
+        if np.array_equal(hooked, labels):
+            break
+        labels = hooked
+    return np.unique(labels[corners[:, 0]], return_inverse = True)[1].reshape(-1)
+
+def uv_islands(obj: bpy.types.Object, depsgraph) -> tuple[np.ndarray, np.ndarray]:
+    """ UV corners (t, 3, 2) of the evaluated mesh's loop triangles in the active UV map and the
+    UV island of each triangle, triangles sharing a vertex at the same UV are one island """
+    obj_eval = obj.evaluated_get(depsgraph)
+    mesh = obj_eval.to_mesh()
+    try:
+        uv_layer = mesh.uv_layers.active
+        if uv_layer is None:
+            raise ValueError("{} has no UV map".format(obj.name))
+        mesh.calc_loop_triangles()
+        uvs = np.empty(len(mesh.loops) * 2, dtype = np.float32)
+        uv_layer.data.foreach_get('uv', uvs)
+        vertices = np.empty(len(mesh.loops), dtype = np.int64)
+        mesh.loops.foreach_get('vertex_index', vertices)
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype = np.int64)
+        mesh.loop_triangles.foreach_get('loops', triangles)
+    finally:
+        obj_eval.to_mesh_clear()
+    uvs = uvs.reshape(-1, 2)
+    triangles = triangles.reshape(-1, 3)
+    keys = np.column_stack((vertices, np.round(uvs * 65536).astype(np.int64)))
+    _, corners = np.unique(keys, axis = 0, return_inverse = True)
+    return uvs[triangles], connected_labels(corners.reshape(-1)[triangles])
+
+def uv_tangent_frames(obj: bpy.types.Object, depsgraph) -> tuple[np.ndarray, np.ndarray]:
+    """ Object-space UV corners (t, 3, 2) and tangent frames (t, 3, 7) of the evaluated mesh's loop
+    triangles, a frame is tangent, bitangent sign and split normal of the active UV map.
+    N-gons are triangulated first like Cycles does, calc_tangents only takes triangles and quads """
+    obj_eval = obj.evaluated_get(depsgraph)
+    bm = bmesh.new()
+    try:
+        evaluated = obj_eval.to_mesh()
+        uv_layer = evaluated.uv_layers.active
+        if uv_layer is None:
+            raise ValueError("{} has no UV map".format(obj.name))
+        uv_name = uv_layer.name
+        bm.from_mesh(evaluated)
+        obj_eval.to_mesh_clear()
+        ngons = [face for face in bm.faces if len(face.verts) > 4]
+        if ngons:
+            bmesh.ops.triangulate(bm, faces = ngons, quad_method = 'BEAUTY', ngon_method = 'BEAUTY')
+        mesh = bpy.data.meshes.new("BakingSolution Tangents")
+        bm.to_mesh(mesh)
+    finally:
+        bm.free()
+        obj_eval.to_mesh_clear()
+    try:
+        uv_layer = mesh.uv_layers[uv_name]
+        mesh.calc_tangents(uvmap = uv_name)
+        mesh.calc_loop_triangles()
+        loop_count = len(mesh.loops)
+        uvs = np.empty(loop_count * 2, dtype = np.float32)
+        uv_layer.data.foreach_get('uv', uvs)
+        tangents = np.empty(loop_count * 3, dtype = np.float32)
+        mesh.loops.foreach_get('tangent', tangents)
+        signs = np.empty(loop_count, dtype = np.float32)
+        mesh.loops.foreach_get('bitangent_sign', signs)
+        normals = np.empty(loop_count * 3, dtype = np.float32)
+        mesh.loops.foreach_get('normal', normals)
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype = np.int64)
+        mesh.loop_triangles.foreach_get('loops', triangles)
+    finally:
+        bpy.data.meshes.remove(mesh)
+    triangles = triangles.reshape(-1, 3)
+    frames = np.concatenate((tangents.reshape(-1, 3), signs[:, None], normals.reshape(-1, 3)), axis = 1)
+    return uvs.reshape(-1, 2)[triangles], frames[triangles]
+
+def world_bounds(obj: bpy.types.Object) -> tuple[np.ndarray, np.ndarray]:
+    corners = np.array([tuple(obj.matrix_world @ Vector(corner)) for corner in obj.bound_box])
+    return corners.min(axis = 0), corners.max(axis = 0)
+
+def out_of_reach_sources(group: BakingGroup) -> list[bpy.types.Object]:
+    """ Enabled sources whose bounds can't be reached by bake rays of the group.
+    Rays start at most cage_extrusion (or the cage) away from the target and travel
+    max_ray_distance, unbounded rays can reach anything so nothing is culled then. """
+    if group.max_ray_distance <= 0:
+        return []
+    low, high = world_bounds(group.target)
+    low -= group.cage_extrusion + group.max_ray_distance
+    high += group.cage_extrusion + group.max_ray_distance
+    if group.cage_object is not None:
+        cage_low, cage_high = world_bounds(group.cage_object)
+        low = np.minimum(low, cage_low - group.max_ray_distance)
+        high = np.maximum(high, cage_high + group.max_ray_distance)
+    culled = []
+    for obj in group.enabled_sources():
+        source_low, source_high = world_bounds(obj)
+        if np.any(source_high < low) or np.any(source_low > high):
+            culled.append(obj)
+    return culled
+
+def sources_bvh(objects, depsgraph) -> BVHTree | None:
+    """ One world-space BVH over all given objects """
+    all_vertices = []
+    all_triangles = []
+    offset = 0
+    for obj in objects:
+        if obj.type != 'MESH':
+            continue
+        vertices, triangles, _ = evaluated_triangles(obj, depsgraph)
+        all_vertices.append(vertices)
+        all_triangles.append(triangles + offset)
+        offset += len(vertices)
+    if offset == 0:
+        return None
+    return BVHTree.FromPolygons(np.concatenate(all_vertices).tolist(), np.concatenate(all_triangles).tolist(), all_triangles = True)
+
+def sample_surface(vertices: np.ndarray, triangles: np.ndarray, normals: np.ndarray, count: int, seed: int = 0):
+    """ Area-weighted random points on triangles with interpolated normals """
+    rng = np.random.default_rng(seed)
+    corners = vertices[triangles]
+    areas = np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis = 1)
+    chosen = rng.choice(len(triangles), size = count, p = areas / areas.sum())
+    r1 = np.sqrt(rng.random(count))
+    r2 = rng.random(count)
+    weights = np.stack((1 - r1, r1 * (1 - r2), r1 * r2), axis = 1)[:, :, None]
+    points = (corners[chosen] * weights).sum(axis = 1)
+    point_normals = (normals[chosen] * weights).sum(axis = 1)
+    point_normals /= np.maximum(np.linalg.norm(point_normals, axis = 1, keepdims = True), 1e-12)
+    return points, point_normals
+
+def estimate_ray_settings(context, group: BakingGroup, samples: int = 4096, percentile: float = 99.0, margin: float = 0.05):
+    """ Smallest cage extrusion and ray length that let percentile of target points hit a source.
+    Rays start at the extruded target surface and travel inward, so sources in front of the
+    surface need extrusion and sources behind it need ray length past the surface. """
+    depsgraph = context.evaluated_depsgraph_get()
+    bvh = sources_bvh(group.enabled_sources(), depsgraph)
+    if bvh is None:
+        raise ValueError("Group has no enabled mesh sources")
+    vertices, triangles, normals = evaluated_triangles(group.target, depsgraph)
+    if len(triangles) == 0:
+        raise ValueError("Target has no faces")
+    corners = vertices[triangles]
+    if not np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis = 1).sum() > 0:
+        raise ValueError("Target has no area")  # sample_surface weighs triangles by area
+    points, point_normals = sample_surface(vertices, triangles, normals, samples)
+    outward = np.zeros(samples)
+    inward = np.zeros(samples)
+    misses = 0
+    for index in range(samples):
+        point = Vector(points[index])
+        normal = Vector(point_normals[index])
+        hit_out = bvh.ray_cast(point, normal)[3]
+        hit_in = bvh.ray_cast(point, -normal)[3]
+        if hit_out is not None and (hit_in is None or hit_out <= hit_in):
+            outward[index] = hit_out
+        elif hit_in is not None:
+            inward[index] = hit_in
+        else:
+            misses += 1
+            nearest = bvh.find_nearest(point)[3]
+            outward[index] = inward[index] = nearest or 0.0
+    extrusion = float(np.percentile(outward, percentile)) * (1 + margin)
+    ray_distance = extrusion + float(np.percentile(inward, percentile)) * (1 + margin)
+    return extrusion, max(ray_distance, 1e-4), misses
+
+# Image Processing
+
+def box_taps(src: int, dst: int):
+    """ Source indices and area weights of each destination pixel, works for non-integer ratios """
+    ratio = src / dst
+    count = int(math.ceil(ratio)) + 1
+    start = np.arange(dst) * ratio
+    index = np.floor(start).astype(np.int64)[:, None] + np.arange(count)[None, :]
+    low = np.maximum(start[:, None], index)
+    high = np.minimum(start[:, None] + ratio, index + 1)
+    weights = np.clip(high - low, 0, None) / ratio
+    return np.minimum(index, src - 1), weights.astype(np.float32)
+
+def lanczos_kernel(x: np.ndarray) -> np.ndarray:
+    return np.where(np.abs(x) < 3, np.sinc(x) * np.sinc(x / 3), 0)
+
+def mitchell_kernel(x: np.ndarray) -> np.ndarray:
+    b = c = 1 / 3
+    x = np.abs(x)
+    near = ((12 - 9 * b - 6 * c) * x ** 3 + (-18 + 12 * b + 6 * c) * x ** 2 + (6 - 2 * b)) / 6
+    far = ((-b - 6 * c) * x ** 3 + (6 * b + 30 * c) * x ** 2 + (-12 * b - 48 * c) * x + (8 * b + 24 * c)) / 6
+    return np.where(x < 1, near, np.where(x < 2, far, 0))
+
+filter_kernels = {
+    'LANCZOS': (lanczos_kernel, 3),
+    'MITCHELL': (mitchell_kernel, 2) }
+
+def filter_taps(src: int, dst: int, filter: str = 'BOX'):
+    """ Source indices and normalized weights of each destination pixel for a downsampling filter """
+    if filter == 'BOX':
+        return box_taps(src, dst)
+    kernel, radius = filter_kernels[filter]
+    ratio = src / dst
+    support = radius * ratio
+    count = int(math.ceil(2 * support)) + 1
+    center = (np.arange(dst) + 0.5) * ratio - 0.5
+    index = np.floor(center - support).astype(np.int64)[:, None] + 1 + np.arange(count)[None, :]
+    weights = kernel((index - center[:, None]) / ratio)
+    weights /= weights.sum(axis = 1, keepdims = True)
+    return np.clip(index, 0, src - 1), weights.astype(np.float32)
+
+def resample_axis(pixels: np.ndarray, axis: int, index: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    shape = [1] * pixels.ndim
+    shape[axis] = -1
+    result = None
+    for tap in range(index.shape[1]):
+        weighted = np.take(pixels, index[:, tap], axis = axis)
+        weighted *= weights[:, tap].reshape(shape)
+        if result is None:
+            result = weighted
+        else:
+            result += weighted
+    return result
+
+def downsample(pixels: np.ndarray, width: int, height: int, filter: str = 'BOX') -> np.ndarray:
+    """ Filtered (h, w, channels) pixels at given size """
+    pixels = resample_axis(pixels, 1, *filter_taps(pixels.shape[1], width, filter))
+    pixels = resample_axis(pixels, 0, *filter_taps(pixels.shape[0], height, filter))
+    if filter != 'BOX':
+        np.clip(pixels[..., 3], 0, 1, out = pixels[..., 3])
+    return pixels
+
+def island_map(uvs: np.ndarray, labels: np.ndarray, width: int, height: int) -> np.ndarray:
+    """ (h, w) island index of every texel, -1 outside the UV triangles """
+    values = np.repeat((labels + 1).astype(np.float32)[:, None, None], 3, axis = 1)
+    ids, covered = rasterize_triangles(uvs, values, width, height)
+    return np.where(covered, np.rint(ids[..., 0]).astype(np.int64) - 1, -1)
+
+def pack_islands(islands: np.ndarray, gutter: int) -> tuple[list[tuple[int, int, int, int, int, int, int]], int, int]:
+    """ Shelf packs the bounding boxes of the islands apart from each other, returns
+    (island, y, x, height, width, canvas y, canvas x) boxes and the canvas width and height """
+    index = np.flatnonzero(islands >= 0)
+    if len(index) == 0:
+        return [], 0, 0
+    labels = islands.ravel()[index]
+    ys, xs = np.divmod(index, islands.shape[1])
+    count = labels.max() + 1
+    low_y, low_x = np.full(count, islands.shape[0]), np.full(count, islands.shape[1])
+    high_y, high_x = np.full(count, -1), np.full(count, -1)
+    np.minimum.at(low_y, labels, ys)
+    np.minimum.at(low_x, labels, xs)
+    np.maximum.at(high_y, labels, ys)
+    np.maximum.at(high_x, labels, xs)
+    present = np.flatnonzero(high_y >= 0)
+    sizes = [(int(high_y[i] - low_y[i] + 1), int(high_x[i] - low_x[i] + 1), int(i)) for i in present]
+    row_limit = max(islands.shape[1], max(width for _, width, _ in sizes) + 2 * gutter)
+    boxes = []
+    x = y = shelf = 0
+    canvas_width = 0
+    for box_h, box_w, island in sorted(sizes, reverse = True):
+        if x + box_w + 2 * gutter > row_limit:
+            x, y, shelf = 0, y + shelf, 0
+        boxes.append((island, int(low_y[island]), int(low_x[island]), box_h, box_w, y + gutter, x + gutter))
+        x += box_w + 2 * gutter
+        shelf = max(shelf, box_h + 2 * gutter)
+        canvas_width = max(canvas_width, x)
+    return boxes, canvas_width, y + shelf
+
+def denoise_islands(noisy: np.ndarray, guides: list[np.ndarray | None], islands: np.ndarray) -> np.ndarray | None:
+    """ Denoises every UV island apart from the others in one compositor run, the islands are copied
+    into a canvas with gutters between them. None when the canvas would be over twice the image """
+    boxes, canvas_width, canvas_height = pack_islands(islands, 16)
+    if len(boxes) == 0 or canvas_width * canvas_height > 2 * islands.size:
+        return None
+    canvases = [None if pixels is None else np.zeros((canvas_height, canvas_width, 4), dtype = np.float32) for pixels in [noisy] + guides]
+    for island, y, x, box_h, box_w, canvas_y, canvas_x in boxes:
+        mask = islands[y:y + box_h, x:x + box_w, None] == island
+        for canvas, pixels in zip(canvases, [noisy] + guides):
+            if canvas is not None:
+                canvas[canvas_y:canvas_y + box_h, canvas_x:canvas_x + box_w] = np.where(mask, pixels[y:y + box_h, x:x + box_w], 0)
+    for canvas in canvases[1:]:
+        if canvas is not None:
+            canvas[..., 3] = 1
+    denoised_canvas = denoise_render(*canvases)
+    denoised = noisy.copy()
+    for island, y, x, box_h, box_w, canvas_y, canvas_x in boxes:
+        mask = islands[y:y + box_h, x:x + box_w, None] == island
+        region = denoised[y:y + box_h, x:x + box_w]
+        region[...] = np.where(mask, denoised_canvas[canvas_y:canvas_y + box_h, canvas_x:canvas_x + box_w], region)
+    return denoised
+
+def denoise_pixels(noisy: np.ndarray, normal: np.ndarray | None = None, albedo: np.ndarray | None = None, islands: np.ndarray | None = None) -> np.ndarray:
+    """ OpenImageDenoise through the compositor Denoise node. Guides are margin-free bakes, their
+    alpha marks baked texels, only those take the denoised result. With an island map every UV
+    island is denoised on its own so islands don't bleed into each other, otherwise guides are
+    just zeroed outside the baked texels """
+    coverage = None
+    if normal is not None:
+        coverage = normal[..., 3:4] > 0.5
+        normal = np.where(coverage, normal * 2 - 1, 0).astype(np.float32)
+        normal[..., 3] = 1
+    if albedo is not None:
+        albedo = np.where(albedo[..., 3:4] > 0.5, albedo, 0).astype(np.float32)
+        albedo[..., 3] = 1
+    denoised = None
+    if islands is not None:
+        denoised = denoise_islands(noisy, [normal, albedo], islands)
+    if denoised is None:
+        denoised = denoise_render(noisy, normal, albedo)
+    if coverage is not None:
+        denoised = np.where(coverage, denoised, noisy)
+    denoised[..., 3] = noisy[..., 3]
+    return denoised
+
+def denoise_render(noisy: np.ndarray, normal: np.ndarray | None, albedo: np.ndarray | None) -> np.ndarray:
+    """ Runs the compositor Denoise node over the pixels in a temporary scene """
+    height, width = noisy.shape[:2]
+    path = os.path.join(tempfile.gettempdir(), "baking_solution_denoise_{}.exr".format(os.getpid()))
+    scene = bpy.data.scenes.new("BakingSolution Denoise")
+    images = []
+    try:
+        scene.render.engine = 'CYCLES'
+        scene.render.resolution_x = width
+        scene.render.resolution_y = height
+        scene.render.resolution_percentage = 100
+        scene.render.use_compositing = True
+        scene.render.use_sequencer = False
+        scene.render.filepath = path
+        scene.render.image_settings.file_format = 'OPEN_EXR'
+        scene.render.image_settings.color_depth = '32'
+        scene.use_nodes = True
+        tree = scene.node_tree
+        tree.nodes.clear()
+        node_denoise = tree.nodes.new('CompositorNodeDenoise')
+        node_denoise.use_hdr = True
+        node_composite = tree.nodes.new('CompositorNodeComposite')
+        tree.links.new(node_denoise.outputs["Image"], node_composite.inputs["Image"])
+        for pixels, socket in ((noisy, "Image"), (normal, "Normal"), (albedo, "Albedo")):
+            if pixels is None:
+                continue
+            image = bpy.data.images.new("BakingSolution Denoise " + socket, width, height, alpha = True, float_buffer = True)
+            image.colorspace_settings.name = 'Non-Color'
+            image.pixels.foreach_set(np.ascontiguousarray(pixels, dtype = np.float32).ravel())
+            images.append(image)
+            node_image = tree.nodes.new('CompositorNodeImage')
+            node_image.image = image
+            tree.links.new(node_image.outputs["Image"], node_denoise.inputs[socket])
+        bpy.ops.render.render(write_still = True, scene = scene.name)
+        result = bpy.data.images.load(path, check_existing = False)
+        result.colorspace_settings.name = 'Non-Color'
+        images.append(result)
+        denoised = read_pixels(result).copy()
+    finally:
+        for image in images:
+            bpy.data.images.remove(image)
+        bpy.data.scenes.remove(scene)
+        if os.path.exists(path):
+            os.remove(path)
+    return denoised
+
+def rasterize_triangles(uvs: np.ndarray, values: np.ndarray, width: int, height: int, budget: int = 1 << 22) -> tuple[np.ndarray, np.ndarray]:
+    """ Barycentric interpolation of per-corner values (t, 3, c) over UV triangles (t, 3, 2) at texel
+    centers, returns (h, w, c) values and the (h, w) coverage. Works on triangle rows in batches of
+    about budget texels so big triangles don't blow up memory """
+    result = np.zeros((height * width, values.shape[2]), dtype = np.float32)
+    covered = np.zeros(height * width, dtype = bool)
+    corners = uvs * np.array((width, height), dtype = np.float64) - 0.5  # texel centers on integers
+    low = np.maximum(np.ceil(corners.min(axis = 1)), 0).astype(np.int64)
+    high = np.minimum(np.floor(corners.max(axis = 1)), (width - 1, height - 1)).astype(np.int64)
+    extent = high - low + 1
+    visible = np.flatnonzero((extent > 0).all(axis = 1))
+    if len(visible) == 0:
+        return result.reshape(height, width, -1), covered.reshape(height, width)
+
+    rows = extent[visible, 1]
+    row_triangle = np.repeat(visible, rows)
+    row_y = low[row_triangle, 1] + np.arange(rows.sum()) - np.repeat(np.cumsum(rows) - rows, rows)
+    row_width = extent[row_triangle, 0]
+    row_end = np.cumsum(row_width)
+    start = 0
+    while start < len(row_triangle):
+        end = max(start + 1, int(np.searchsorted(row_end, row_end[start] - row_width[start] + budget, side = 'right')))
+        counts = row_width[start:end]
+        owner = np.repeat(row_triangle[start:end], counts)
+        px = low[owner, 0] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        py = np.repeat(row_y[start:end], counts)
+        a, b, c = corners[owner, 0], corners[owner, 1], corners[owner, 2]
+        edge_b, edge_c = b - a, c - a
+        dx, dy = px - a[:, 0], py - a[:, 1]
+        area = edge_b[:, 0] * edge_c[:, 1] - edge_c[:, 0] * edge_b[:, 1]
+        safe_area = np.where(np.abs(area) > 1e-12, area, 1.0)
+        weight_b = (dx * edge_c[:, 1] - edge_c[:, 0] * dy) / safe_area
+        weight_c = (edge_b[:, 0] * dy - dx * edge_b[:, 1]) / safe_area
+        weight_a = 1 - weight_b - weight_c
+        inside = (np.abs(area) > 1e-12) & (weight_a >= -1e-6) & (weight_b >= -1e-6) & (weight_c >= -1e-6)
+        corner_values = values[owner[inside]]
+        weights = np.stack((weight_a[inside], weight_b[inside], weight_c[inside]), axis = 1)[:, :, None]
+        index = py[inside] * width + px[inside]
+        result[index] = (corner_values * weights).sum(axis = 1)
+        covered[index] = True
+        start = end
+    return result.reshape(height, width, -1), covered.reshape(height, width)
+
+def jump_flood(covered: np.ndarray, max_distance: int) -> tuple[np.ndarray, np.ndarray]:
+    """ Flat index of the nearest covered texel (-1 if none within max_distance) and the squared
+    distance to it. Jump flooding with steps from max_distance down to 1, so each of the
+    log2(max_distance) passes is linear in pixel count """
+    height, width = covered.shape
+    rows, columns = np.indices((height, width), dtype = np.float32)
+    far = np.float32(1e7)
+    nearest_y = np.where(covered, rows, far)
+    nearest_x = np.where(covered, columns, far)
+    distance = np.where(covered, np.float32(0), np.float32(np.inf))
+    step = 1 << int(math.log2(max(1, max_distance)))
+    steps = [1]  # extra unit pass fixes most jump flooding errors
+    while step >= 1:
+        steps.insert(-1, step)
+        step //= 2
+    for step in steps:
+        for dy in (-step, 0, step):
+            for dx in (-step, 0, step):
+                if dy == 0 and dx == 0 or abs(dy) >= height or abs(dx) >= width:
+                    continue  # steps past the image edge have no neighbour to read
+                target = (slice(max(-dy, 0), height - max(dy, 0)), slice(max(-dx, 0), width - max(dx, 0)))
+                source = (slice(max(dy, 0), height - max(-dy, 0)), slice(max(dx, 0), width - max(-dx, 0)))
+                candidate_y = nearest_y[source]
+                candidate_x = nearest_x[source]
+                offset_y = candidate_y - rows[target]
+                offset_x = candidate_x - columns[target]
+                offset_y *= offset_y
+                offset_x *= offset_x
+                offset_y += offset_x
+                better = offset_y < distance[target]
+                np.copyto(nearest_y[target], candidate_y, where = better)
+                np.copyto(nearest_x[target], candidate_x, where = better)
+                np.minimum(distance[target], offset_y, out = distance[target])
+    reached = distance <= max_distance * max_distance
+    nearest = np.where(reached, nearest_y.astype(np.int64) * width + nearest_x.astype(np.int64), -1)
+    return nearest, distance
+
+def grow_coverage(values: np.ndarray, covered: np.ndarray, distance: int) -> tuple[np.ndarray, np.ndarray]:
+    """ Extends covered values up to distance texels into uncovered ones, nearest value wins """
+    if covered.all() or not covered.any():
+        return values, covered
+    nearest, _ = jump_flood(covered, distance)
+    grown = nearest >= 0
+    fill = grown & ~covered
+    result = values.copy()
+    result[fill] = values.reshape(-1, values.shape[-1])[nearest[fill]]
+    return result, grown
+
+def dilate_margin(pixels: np.ndarray, covered: np.ndarray, margin: int) -> np.ndarray:
+    """ Bake margin at final resolution: partially baked texels inside the coverage are unpremultiplied,
+    the rest is replaced by the nearest covered texel up to margin texels away """
+    pixels = pixels.copy()
+    alpha = pixels[..., 3]
+    partial = covered & (alpha > 0) & (alpha < 1)
+    pixels[partial, :3] /= alpha[partial, None]
+    pixels[partial, 3] = 1
+    dilated, grown = grow_coverage(pixels, covered, margin)
+    dilated[~grown] = pixels[~grown]
+    return dilated
+
+def convert_normals(pixels: np.ndarray, normal_settings, frames: np.ndarray | None = None) -> np.ndarray:
+    """ Object-space +X+Y+Z normal pixels in the axes and space of normal_settings,
+    frames (h, w, 7) of the target are needed for tangent space """
+    normals = pixels[..., :3] * 2 - 1
+    if normal_settings.normal_tangent_space:
+        # Inverse of the (tangent, bitangent, normal) matrix like Blender's tangent space bake,
+        # its rows are the cross products of the other two axes over the determinant
+        tangent = frames[..., 0:3] / np.maximum(np.linalg.norm(frames[..., 0:3], axis = 2, keepdims = True), 1e-12)
+        geometry = frames[..., 4:7] / np.maximum(np.linalg.norm(frames[..., 4:7], axis = 2, keepdims = True), 1e-12)
+        bitangent = np.where(frames[..., 3:4] < 0, -1.0, 1.0) * np.cross(geometry, tangent)
+        rows = (np.cross(bitangent, geometry), np.cross(geometry, tangent), np.cross(tangent, bitangent))
+        determinant = (tangent * rows[0]).sum(axis = 2)
+        determinant = np.where(np.abs(determinant) < 1e-12, 1e-12, determinant)
+        normals = np.stack([(normals * row).sum(axis = 2) / determinant for row in rows], axis = 2)
+        normals /= np.maximum(np.linalg.norm(normals, axis = 2, keepdims = True), 1e-12)
+    converted = np.empty_like(pixels)
+    converted[..., 3] = pixels[..., 3]
+    for index, direction in enumerate((normal_settings.normal_r, normal_settings.normal_g, normal_settings.normal_b)):
+        component = normals[..., 'XYZ'.index(direction[-1])]
+        sign = direction.startswith('NEG') and -1.0 or 1.0
+        converted[..., index] = sign * component * 0.5 + 0.5
+    return converted
+
+def resize_image(image: bpy.types.Image, width: int, height: int):
+    """ Changes image size without keeping its content when Blender can just reallocate it """
+    if image.source == 'GENERATED':
+        image.generated_width = width
+        image.generated_height = height
+    else:
+        image.scale(width, height)
+
+def read_pixels(image: bpy.types.Image, buffer: np.ndarray | None = None) -> np.ndarray:
+    """ (h, w, 4) float32 view of image pixels, fetched in one call """
+    width, height = image.size[0], image.size[1]
+    if buffer is None or buffer.size != width * height * 4:
+        buffer = np.empty(width * height * 4, dtype = np.float32)
+    image.pixels.foreach_get(buffer)
+    return buffer.reshape(height, width, 4)
+
+def write_pixels(image: bpy.types.Image, pixels: np.ndarray):
+    if not image.is_float:
+        np.clip(pixels, 0, 1, out = pixels)
+    image.pixels.foreach_set(pixels.ravel())
+    image.update()
+
+def snapshot_pixels(image: bpy.types.Image) -> np.ndarray:
+    """ Copy of the pixels to roll back to, 8-bit images are kept as uint8 at a quarter of the memory """
+    pixels = read_pixels(image)
+    if image.is_float:
+        return pixels.copy()
+    return np.rint(pixels * 255).astype(np.uint8)
+
+def restore_snapshot(image: bpy.types.Image, snapshot: np.ndarray):
+    height, width = snapshot.shape[:2]
+    if tuple(image.size) != (width, height):
+        resize_image(image, width, height)
+    if snapshot.dtype == np.uint8:
+        snapshot = snapshot * np.float32(1 / 255)
+    write_pixels(image, snapshot)
+
+# Bake Queue
+
+class BakeItem:
+    """ Single group/mode pair scheduled for baking """
+
+    def __init__(self, group_index: int, mode: str, aa_scale: float = 1.0):
+        self.group_index = group_index
+        self.mode = mode
+        self.aa_scale = aa_scale
+        self.status = 'PENDING'
+        self.label = ""
+        self.original_size = (0, 0)
+        self.filter = 'BOX'
+        self.downsample_time = 0.0
+        self.cache_key = ""
+        self.stages: dict[str, float] = {}
+        self.cycles_start: float | None = None
+        self.peak_memory = 0
+        self.memory_estimate = 0
+        self.memory_note = ""
+        self.culled_sources = 0
+        self.denoise = False
+        self.masks_ao = False
+        self.guides: dict[str, np.ndarray] = {}
+        self.uv_islands: tuple[np.ndarray, np.ndarray] | None = None
+        self.original_pixels: np.ndarray | None = None
+        self.canonical = False
+        self.export_path = ""
+        self.hidden_objects: list[str] = []
+        self.proxy_objects: list[str] = []
+        self.patched_solution = False
+        self.draft = False
+        self.draft_image = ""
+        self.tiled: TiledBake | None = None
+
+    @property
+    def tile_count(self) -> int:
+        return self.tiled is not None and len(self.tiled.tiles) or 1
+
+    def bake_image(self, settings: BakingSolutionSettings) -> bpy.types.Image | None:
+        """ Image the bake writes into right now, the scratch image when tiled """
+        if self.tiled is not None:
+            return bpy.data.images.get(self.tiled.scratch_name)
+        return self.image(settings)
+
+    def group(self, settings: BakingSolutionSettings) -> BakingGroup:
+        return settings.groups[self.group_index]
+
+    def image(self, settings: BakingSolutionSettings) -> bpy.types.Image | None:
+        if self.draft:
+            return bpy.data.images.get(self.draft_image)
+        image_target = getattr(self.group(settings).image_targets, self.mode, None)
+        return image_target and image_target.image
+
+class TiledBake:
+    """ Supersampled bake of one image in UV-space tiles through a single scratch image,
+    so peak memory follows tile size instead of image size * aa_scale """
+
+    UV_NAME = "BakingSolution Tile"
+    SCRATCH_NAME = "BakingSolution Scratch"
+
+    def __init__(self, image: bpy.types.Image, aa_scale: float, tile_size: int, padding: int, filter: str = 'BOX'):
+        width, height = image.size[0], image.size[1]
+        self.size = (width, height)
+        self.filter = filter
+        self.tile_size = tile_size
+        self.padding = padding
+        self.region = (min(tile_size, width) + 2 * padding, min(tile_size, height) + 2 * padding)
+        self.scratch_size = (int(round(self.region[0] * aa_scale)), int(round(self.region[1] * aa_scale)))
+        self.tiles = [(x, y, min(tile_size, width - x), min(tile_size, height - y))
+            for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+        self.image_name = image.name
+        self.mesh_name = ""
+        self.scratch_name = ""
+        self.active_uv_index = 0
+        self.swapped_nodes: list[tuple[str, str]] = []
+        self.uv = None
+        self.buffer = None
+        self.result = None
+
+    def begin(self, target: bpy.types.Object):
+        image = bpy.data.images[self.image_name]
+        mesh = target.data
+        self.mesh_name = mesh.name
+        uv_layers = mesh.uv_layers
+        self.active_uv_index = uv_layers.active_index
+        layer = uv_layers.new(name = self.UV_NAME, do_init = True)
+        if layer is None:
+            raise RuntimeError("{} has no free UV map slot for tiled baking".format(mesh.name))
+        uv_layers.active_index = self.active_uv_index
+        self.uv = np.empty(len(layer.data) * 2, dtype = np.float32)
+        layer.data.foreach_get('uv', self.uv)
+
+        scratch = bpy.data.images.new(self.SCRATCH_NAME, *self.scratch_size, alpha = True, float_buffer = image.is_float)
+        scratch.colorspace_settings.name = image.colorspace_settings.name
+        self.scratch_name = scratch.name
+        self.swapped_nodes = []
+        for mat in mesh.materials:
+            if mat is None or mat.node_tree is None:
+                continue
+            for node in mat.node_tree.nodes:
+                if node.type == 'TEX_IMAGE' and node.image == image:
+                    node.image = scratch
+                    self.swapped_nodes.append((mat.name, node.name))
+        self.buffer = np.empty(self.scratch_size[0] * self.scratch_size[1] * 4, dtype = np.float32)
+        self.result = np.zeros((self.size[1], self.size[0], 4), dtype = np.float32)
+        print("Tiled bake: {} tiles of {}x{} scratch pixels".format(len(self.tiles), *self.scratch_size))
+
+    def setup_tile(self, index: int):
+        """ Maps the padded tile region of UV space to the whole scratch image """
+        mesh = bpy.data.meshes[self.mesh_name]
+        mesh.uv_layers[self.UV_NAME].data.foreach_set('uv', self.tile_uvs(self.uv.reshape(-1, 2), index).ravel())
+        mesh.update()
+
+    def tile_uvs(self, uv: np.ndarray, index: int) -> np.ndarray:
+        """ UVs (..., 2) moved so the padded region of the tile covers the scratch image """
+        x, y, _, _ = self.tiles[index]
+        width, height = self.size
+        tile_uv = np.empty_like(uv)
+        tile_uv[..., 0] = (uv[..., 0] - (x - self.padding) / width) * (width / self.region[0])
+        tile_uv[..., 1] = (uv[..., 1] - (y - self.padding) / height) * (height / self.region[1])
+        return tile_uv
+
+    def collect_tile(self, index: int, process = None):
+        """ Downsamples the baked scratch image into the result, process(pixels) may filter it first """
+        x, y, tile_w, tile_h = self.tiles[index]
+        padding = self.padding
+        bpy.data.images[self.scratch_name].pixels.foreach_get(self.buffer)
+        pixels = self.buffer.reshape(self.scratch_size[1], self.scratch_size[0], 4)
+        if process is not None:
+            pixels = process(pixels)
+        tile = downsample(pixels, *self.region, self.filter)
+        self.result[y:y + tile_h, x:x + tile_w] = tile[padding:padding + tile_h, padding:padding + tile_w]
+
+    def end(self, write = True):
+        """ Writes collected tiles and restores target, safe to call after a failed tile """
+        image = bpy.data.images.get(self.image_name)
+        if write and image is not None and self.result is not None:
+            write_pixels(image, self.result)
+        for mat_name, node_name in self.swapped_nodes:
+            mat = bpy.data.materials.get(mat_name)
+            node = mat and mat.node_tree.nodes.get(node_name)
+            if node is not None:
+                node.image = image
+        self.swapped_nodes = []
+        mesh = bpy.data.meshes.get(self.mesh_name)
+        if mesh is not None:
+            layer = mesh.uv_layers.get(self.UV_NAME)
+            if layer is not None:
+                mesh.uv_layers.remove(layer)
+                mesh.uv_layers.active_index = self.active_uv_index
+        scratch = bpy.data.images.get(self.scratch_name)
+        if scratch is not None:
+            bpy.data.images.remove(scratch)
+        self.uv = None
+        self.buffer = None
+        self.result = None
+
+def tile_padding(margin: int, aa_scale: float) -> int:
+    """ Final-resolution pixels around a tile, enough for the bake margin and the filter """
+    return int(math.ceil(margin / aa_scale)) + 3
+
+# Items of the running or last bake, in the order they were queued
+bake_queue: list[BakeItem] = []
+
+# Bake Statistics
+
+# Records of finished bakes in this session, newest last
+bake_stats: list[dict] = []
+# What the running bake is doing, drawn by the panel
+bake_progress = {'index': 0, 'total': 0, 'label': "", 'stage': "", 'fraction': 0.0, 'elapsed': 0.0, 'eta': -1.0}
+
+def image_bytes(width: int, height: int, is_float: bool) -> int:
+    return int(width) * int(height) * 4 * (is_float and 4 or 1)
+
+@contextmanager
+def bake_stage(item: BakeItem, name: str):
+    bake_progress['stage'] = name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        item.stages[name] = item.stages.get(name, 0.0) + time.perf_counter() - start
+
+def start_cycles_timer(item: BakeItem):
+    bake_progress['stage'] = 'bake'
+    item.cycles_start = time.perf_counter()
+
+def stop_cycles_timer(item: BakeItem):
+    if item.cycles_start is not None:
+        item.stages['bake'] = item.stages.get('bake', 0.0) + time.perf_counter() - item.cycles_start
+        item.cycles_start = None
+
+def track_memory(item: BakeItem, size: int):
+    item.peak_memory = max(item.peak_memory, size)
+
+def stats_log_path(settings: BakingSolutionSettings) -> str:
+    if settings.log_path:
+        return bpy.path.abspath(settings.log_path)
+    return os.path.join(tempfile.gettempdir(), "baking_solution.log")
+
+def record_bake_stats(context, item: BakeItem) -> dict:
+    """ Stores timing of a finished item and appends it to the log file as a JSON line """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    image = item.image(settings)
+    stop_cycles_timer(item)
+    record = {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'blend': bpy.data.filepath,
+        'label': item.label,
+        'group': item.group_index,
+        'target': item.group(settings).target.name,
+        'mode': item.mode,
+        'resolution': image and [image.size[0], image.size[1]],
+        'aa_scale': item.aa_scale,
+        'tiles': item.tile_count,
+        'status': item.status,
+        'stages': dict(item.stages),
+        'total': sum(item.stages.values()),
+        'peak_image_memory': item.peak_memory,
+        'memory_estimate': item.memory_estimate,
+        'memory_note': item.memory_note,
+        'culled_sources': item.culled_sources,
+        'draft': item.draft }
+    bake_stats.append(record)
+    try:
+        with open(stats_log_path(settings), 'a') as file:
+            file.write(json.dumps(record) + "\n")
+    except OSError as error:
+        print("Unable to write bake log: {}".format(error))
+    print("{}: {} in {:.2f}s ({})".format(item.label, item.status, record['total'],
+        ", ".join("{} {:.2f}s".format(name, seconds) for name, seconds in record['stages'].items())))
+    return record
+
+def get_bake_stats() -> list[dict]:
+    """ Timing records of bakes finished in this session """
+    return [dict(record) for record in bake_stats]
+
+def collect_bake_items(settings: BakingSolutionSettings, group_indices = None, modes = None) -> list[BakeItem]:
+    """ Every enabled group in every mode that has an output image """
+    if group_indices is None:
+        group_indices = [i for i, group in enumerate(settings.groups) if group.is_enabled]
+    if modes is None:
+        modes = [mode for mode, _, _ in enum_solution_modes]
+    items = []
+    for group_index in group_indices:
+        if settings.groups[group_index].target is None:
+            continue
+        for mode in modes:
+            item = new_bake_item(settings, group_index, mode)
+            if item.image(settings) is None:
+                continue
+            items.append(item)
+    return items
+
+def new_bake_item(settings: BakingSolutionSettings, group_index: int, mode: str, masks_ao: bool | None = None, canonical: bool | None = None) -> BakeItem:
+    """ masks_ao forces the AO channel of a MASKS bake on or off, by default it follows the channel mapping.
+    canonical forces the canonical layout, by default tangent space normals are baked by Cycles directly """
+    group = settings.groups[group_index]
+    item = BakeItem(group_index, mode, settings.aa_scale)
+    item.label = "{} [{}]".format(group.target.name, mode)
+    item.filter = settings.aa_filter
+    solution_settings = group.solution_settings
+    if masks_ao is None:
+        masks_ao = 'AO' in (solution_settings.mask_r, solution_settings.mask_g, solution_settings.mask_b)
+    item.masks_ao = mode == 'MASKS' and masks_ao
+    if canonical is None:
+        canonical = not (mode == 'NORMAL' and solution_settings.normal_tangent_space)
+    item.canonical = mode in CANONICAL_MODES and canonical
+    profile = getattr(settings.render_profiles, mode)
+    # Denoising costs a compositor run and guide bakes, it only pays off for fewer samples
+    item.denoise = (mode == 'COMBINED' or item.masks_ao) and profile.use_profile and profile.use_denoising and profile.denoise_samples < profile.samples
+    image = item.image(settings)
+    if image is not None and settings.aa_tiled and item.aa_scale != 1:
+        margin = settings.id_data.render.bake.margin
+        item.tiled = TiledBake(image, item.aa_scale, settings.aa_tile_size, tile_padding(margin, item.aa_scale), settings.aa_filter)
+    return item
+
+def bake_properties(settings: BakingSolutionSettings, item: BakeItem) -> dict:
+    """ OBJECT_OT_bake arguments for the item """
+    group = item.group(settings)
+    solution_settings = canonical_solution_settings(settings, item) or group.solution_settings
+    return {
+        'type': solution_bake_modes[item.mode],
+        'use_selected_to_active': True,
+        'cage_extrusion': group.cage_extrusion,
+        'max_ray_distance': group.max_ray_distance,
+        'use_clear': True,
+        'normal_r': solution_settings.normal_r,
+        'normal_g': solution_settings.normal_g,
+        'normal_b': solution_settings.normal_b,
+        'normal_space': solution_settings.normal_tangent_space and 'TANGENT' or 'OBJECT',
+        'cage_object': group.cage_object and group.cage_object.name or "",
+        'use_cage': group.cage_object is not None,
+        'uv_layer': item.tiled is not None and TiledBake.UV_NAME or "",
+        'margin': settings.use_margin_dilation and 0 or settings.id_data.render.bake.margin }
+
+def guide_bake_properties(settings: BakingSolutionSettings, item: BakeItem, guide: str) -> dict:
+    """ Margin-free normal or albedo bake of the item, used to guide the denoiser """
+    properties = bake_properties(settings, item)
+    properties['margin'] = 0
+    if guide == 'NORMAL':
+        properties.update(type = 'NORMAL', normal_space = 'OBJECT', normal_r = 'POS_X', normal_g = 'POS_Y', normal_b = 'POS_Z')
+    else:
+        properties.update(type = 'DIFFUSE', pass_filter = {'COLOR'})
+    return properties
+
+def denoise_guides(item: BakeItem) -> tuple[str, ...]:
+    """ Guide passes baked before the item when it is denoised """
+    return item.denoise and (item.mode == 'COMBINED' and ('NORMAL', 'ALBEDO') or ('NORMAL',)) or ()
+
+def bake_steps(settings: BakingSolutionSettings, item: BakeItem) -> list[tuple[object, dict]]:
+    """ Steps between pre_bake_item and post_bake_item as (function(context, item, **properties), properties),
+    OBJECT_OT_bake steps have no function """
+    guides = denoise_guides(item)
+    steps = []
+    for tile_index in range(item.tile_count):
+        if item.tiled is not None:
+            steps.append((begin_tile, {'tile_index': tile_index}))
+        for guide in guides:
+            steps.append((begin_guide, {'guide': guide}))
+            steps.append((None, guide_bake_properties(settings, item, guide)))
+            steps.append((end_guide, {'guide': guide}))
+        steps.append((None, bake_properties(settings, item)))
+        if item.tiled is not None:
+            steps.append((end_tile, {'tile_index': tile_index}))
+    return steps
+
+def prepare_bake_item(context, item: BakeItem):
+    """ Select sources and target, switch solution mode and activate the output image node """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    group = item.group(settings)
+    print("Preparing {}".format(item.label))
+    item.status = 'BAKING'
+    bake_progress.update(index = bake_queue.index(item) + 1, total = len(bake_queue), label = item.label)
+    with bake_stage(item, 'select'):
+        if context.view_layer.objects.active is not None and context.view_layer.objects.active.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode = 'OBJECT')
+        bpy.ops.object.select_all(action = 'DESELECT')
+        for obj in group.enabled_sources():
+            obj.select_set(True)
+        group.target.select_set(True)
+        context.view_layer.objects.active = group.target
+        if settings.use_source_culling:
+            cull_bake_sources(item, group)
+    if settings.use_source_proxies:
+        with bake_stage(item, 'freeze'):
+            swap_in_proxies(context, item, group)
+    with bake_stage(item, 'nodes'):
+        settings.group_index = item.group_index
+        node_settings = canonical_solution_settings(settings, item) or group.solution_settings
+        if not swap_solution_nodes(context, item, solution_instance(item.mode, node_settings)):
+            # Some material reaches BakingSolution through its own groups, patch the shared group for those
+            node_bake_solution = solution_base_tree()
+            patch_solution_tree(node_bake_solution, item.mode, node_settings)
+            node_bake_solution["baking_solution_state"] = solution_state(item.mode, node_settings)
+            item.patched_solution = True
+        image = item.image(settings)
+        if image is not None:
+            node, mat = find_image_node(group.target, image)
+            if node is not None:
+                mat.node_tree.nodes.active = node
+
+def cull_bake_sources(item: BakeItem, group: BakingGroup):
+    """ Leaves sources out of the bake selection, modes that don't trace the scene
+    also hide them from render so Cycles doesn't build them into its BVH """
+    culled = out_of_reach_sources(group)
+    hide = solution_bake_modes[item.mode] != 'COMBINED' and item.mode != 'MASKS'
+    for obj in culled:
+        obj.select_set(False)
+        if hide and not obj.hide_render:
+            obj.hide_render = True
+            item.hidden_objects.append(obj.name)
+    item.culled_sources = len(culled)
+    if culled:
+        print("Culled {} of {} sources out of reach".format(len(culled), len(group.enabled_sources())))
+
+def restore_culled_sources(item: BakeItem):
+    for name in item.hidden_objects:
+        obj = bpy.data.objects.get(name)
+        if obj is not None:
+            obj.hide_render = False
+    item.hidden_objects = []
+
+# Source Proxies
+
+""" With Freeze Sources, sources with modifiers are baked from hidden copies of their evaluated mesh.
+A copy is made the first time a bake session needs it, reused by every later item while the hash
+of its source matches, and removed when the session ends """
+
+PROXY_COLLECTION = "BakingSolution Proxies"
+
+# Source object name -> (hash of the source, proxy object name)
+source_proxies: dict[str, tuple[str, str]] = {}
+
+def needs_proxy(obj: bpy.types.Object) -> bool:
+    return obj.type in ('CURVE', 'SURFACE', 'META', 'FONT') or (obj.type == 'MESH' and len(obj.modifiers) > 0)
+
+def source_hash(obj: bpy.types.Object) -> str:
+    hasher = hashlib.sha1()
+    hash_object(hasher, obj)
+    return hasher.hexdigest()
+
+@contextmanager
+def render_modifier_levels(obj: bpy.types.Object):
+    """ Gives modifiers their render visibility and subdivision levels while the object is evaluated """
+    saved = []
+    for modifier in obj.modifiers:
+        values = {'show_viewport': modifier.show_render}
+        if modifier.type in ('SUBSURF', 'MULTIRES'):
+            values['levels'] = modifier.render_levels
+        saved.append((modifier, {name: getattr(modifier, name) for name in values}))
+        for name, value in values.items():
+            setattr(modifier, name, value)
+    try:
+        yield
+    finally:
+        for modifier, values in saved:
+            for name, value in values.items():
+                setattr(modifier, name, value)
+
+def build_source_proxy(context, obj: bpy.types.Object) -> bpy.types.Object:
+    collection = bpy.data.collections.get(PROXY_COLLECTION)
+    if collection is None:
+        collection = bpy.data.collections.new(PROXY_COLLECTION)
+    if collection.name not in context.scene.collection.children:
+        context.scene.collection.children.link(collection)
+    with render_modifier_levels(obj):
+        depsgraph = context.evaluated_depsgraph_get()
+        mesh = bpy.data.meshes.new_from_object(obj.evaluated_get(depsgraph), preserve_all_data_layers = True, depsgraph = depsgraph)
+    mesh.name = "{} Proxy".format(obj.name)
+    proxy = bpy.data.objects.new(mesh.name, mesh)
+    proxy.matrix_world = obj.matrix_world
+    for slot, proxy_slot in zip(obj.material_slots, proxy.material_slots):
+        if slot.link == 'OBJECT':
+            proxy_slot.link = 'OBJECT'
+            proxy_slot.material = slot.material
+    collection.objects.link(proxy)
+    proxy.hide_render = True
+    proxy.hide_set(True)
+    print("Froze {} into {} triangles".format(obj.name, len(mesh.loop_triangles)))
+    return proxy
+
+def remove_proxy(proxy: bpy.types.Object):
+    mesh = proxy.data
+    bpy.data.objects.remove(proxy)
+    if mesh.users == 0:
+        bpy.data.meshes.remove(mesh)
+
+def source_proxy(context, obj: bpy.types.Object) -> bpy.types.Object:
+    """ Proxy of obj, rebuilt when obj changed since the proxy was made """
+    key = source_hash(obj)
+    entry = source_proxies.get(obj.name)
+    proxy = entry and bpy.data.objects.get(entry[1])
+    if proxy is not None and entry[0] == key:
+        return proxy
+    if proxy is not None:
+        remove_proxy(proxy)
+    proxy = build_source_proxy(context, obj)
+    source_proxies[obj.name] = (key, proxy.name)
+    return proxy
+
+def swap_in_proxies(context, item: BakeItem, group: BakingGroup):
+    """ Selects proxies instead of the selected sources that need one, the sources are hidden from render """
+    for obj in group.enabled_sources():
+        if not obj.select_get() or not needs_proxy(obj):
+            continue
+        proxy = source_proxy(context, obj)
+        proxy.hide_set(False)
+        proxy.hide_render = False
+        proxy.select_set(True)
+        item.proxy_objects.append(proxy.name)
+        obj.select_set(False)
+        if not obj.hide_render:
+            obj.hide_render = True
+            item.hidden_objects.append(obj.name)
+
+def hide_source_proxies(item: BakeItem):
+    for name in item.proxy_objects:
+        proxy = bpy.data.objects.get(name)
+        if proxy is not None:
+            proxy.hide_render = True
+            proxy.hide_set(True)
+    item.proxy_objects = []
+
+def release_source_proxies():
+    """ Removes every proxy, called when a bake session ends """
+    for _, name in source_proxies.values():
+        proxy = bpy.data.objects.get(name)
+        if proxy is not None:
+            remove_proxy(proxy)
+    source_proxies.clear()
+    collection = bpy.data.collections.get(PROXY_COLLECTION)
+    if collection is not None and len(collection.objects) == 0:
+        bpy.data.collections.remove(collection)
+
+RENDER_PROFILE_BOUNCES = ('max_bounces', 'diffuse_bounces', 'glossy_bounces', 'transmission_bounces', 'volume_bounces', 'transparent_max_bounces')
+
+# (struct path, attribute) -> value of settings overridden by a render profile
+saved_render_settings: dict[tuple[str, str], object] = {}
+
+def render_profile_values(settings: BakingSolutionSettings, item: BakeItem) -> dict[tuple[str, str], object]:
+    """ Settings the item's render profile overrides, empty when the profile is off """
+    if item.draft:
+        return {
+            ('cycles', 'samples'): item.mode == 'MASKS' and not item.masks_ao and 1 or settings.draft_samples,
+            ('cycles', 'use_adaptive_sampling'): False,
+            ('cycles', 'use_denoising'): False }
+    profile = getattr(settings.render_profiles, item.mode)
+    if not profile.use_profile:
+        return {}
+    samples, bounces = profile.samples, profile.max_bounces
+    if item.mode == 'MASKS' and not item.masks_ao:
+        samples, bounces = 1, 0  # Without AO masks are just emitted inputs
+    elif item.denoise:
+        samples = min(samples, profile.denoise_samples)
+    values = {
+        ('cycles', 'samples'): samples,
+        ('cycles', 'use_adaptive_sampling'): profile.use_adaptive_sampling,
+        ('cycles', 'adaptive_threshold'): profile.adaptive_threshold,
+        ('cycles', 'use_denoising'): profile.use_denoising }
+    for name in RENDER_PROFILE_BOUNCES:
+        values[('cycles', name)] = bounces
+    if profile.threads > 0:
+        values[('render', 'threads_mode')] = 'FIXED'
+        values[('render', 'threads')] = profile.threads
+    return values
+
+def apply_render_profile(scene: bpy.types.Scene, values: dict):
+    for (path, name), value in values.items():
+        struct = getattr(scene, path)
+        if (path, name) not in saved_render_settings:
+            saved_render_settings[(path, name)] = getattr(struct, name)
+        setattr(struct, name, value)
+
+def restore_render_settings(scene: bpy.types.Scene):
+    for (path, name), value in saved_render_settings.items():
+        setattr(getattr(scene, path), name, value)
+    saved_render_settings.clear()
+
+def pre_bake_item(context, item: BakeItem):
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    image = item.image(settings)
+    print("Pre-Bake stage")
+    with bake_stage(item, 'upscale'):
+        if item.tiled is not None:
+            item.tiled.begin(item.group(settings).target)
+            scratch_w, scratch_h = item.tiled.scratch_size
+            track_memory(item, image_bytes(scratch_w, scratch_h, image.is_float) + scratch_w * scratch_h * 16 + image.size[0] * image.size[1] * 16)
+        elif image is not None and item.aa_scale != 1:
+            item.original_size = (image.size[0], image.size[1])
+            item.original_pixels = snapshot_pixels(image)  # restored if the bake fails
+            scale_w = int(image.size[0] * item.aa_scale)
+            scale_h = int(image.size[1] * item.aa_scale)
+            print("Resolution before upscale: {} {}".format(image.size[0], image.size[1]))
+            print("Scaling to: {} {}".format(scale_w, scale_h))
+            resize_image(image, scale_w, scale_h)  # content is cleared by the bake anyway
+            print("Resolution after upscale: {} {}".format(image.size[0], image.size[1]))
+            track_memory(item, image_bytes(scale_w, scale_h, image.is_float))
+        elif image is not None:
+            item.original_pixels = snapshot_pixels(image)
+            track_memory(item, image_bytes(image.size[0], image.size[1], image.is_float))
+    apply_render_profile(context.scene, render_profile_values(settings, item))
+    start_cycles_timer(item)
+
+def post_bake_item(context, item: BakeItem):
+    """ Finishes the item, or rolls back everything its bake changed once it has FAILED """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    image = item.image(settings)
+    stop_cycles_timer(item)
+    restore_render_settings(context.scene)
+    restore_culled_sources(item)
+    hide_source_proxies(item)
+    guide = bpy.data.images.get("BakingSolution Guide")
+    if guide is not None:
+        swap_node_images(item.group(settings).target, guide, item.bake_image(settings))
+        bpy.data.images.remove(guide)
+    item.guides = {}
+    item.uv_islands = None
+    if item.status == 'BAKING':
+        item.original_pixels = None  # no rollback needed, free it before the downscale buffers
+    print("Post-Bake stage")
+    with bake_stage(item, 'downscale'):
+        if item.tiled is not None:
+            item.tiled.end(write = item.status == 'BAKING')
+        elif item.status != 'BAKING':
+            if image is not None and item.original_pixels is not None:
+                restore_snapshot(image, item.original_pixels)
+        elif image is not None and item.denoise and item.aa_scale == 1:
+            write_pixels(image, denoise_bake(context, item, read_pixels(image)))
+        elif image is not None and item.aa_scale != 1:
+            print("Resolution before downscale: {} {}".format(image.size[0], image.size[1]))
+            print("Scaling to: {} {} ({})".format(*item.original_size, item.filter))
+            start = time.perf_counter()
+            track_memory(item, image_bytes(image.size[0], image.size[1], image.is_float) + image.size[0] * image.size[1] * 16 + item.original_size[0] * item.original_size[1] * 16)
+            pixels = read_pixels(image)
+            if item.denoise:
+                pixels = denoise_bake(context, item, pixels)
+            pixels = downsample(pixels, *item.original_size, item.filter)
+            resize_image(image, *item.original_size)
+            write_pixels(image, pixels)
+            item.downsample_time = time.perf_counter() - start
+            print("Resolution after downscale: {} {} in {:.2f}s".format(image.size[0], image.size[1], item.downsample_time))
+    item.original_pixels = None
+    if item.patched_solution:
+        item.patched_solution = False
+        update_node_solution()  # back to the preview
+    if item.status != 'BAKING':
+        return
+    if settings.use_margin_dilation and image is not None:
+        with bake_stage(item, 'margin'):
+            dilate_bake(context, item, image)
+    if item.cache_key and image is not None and settings.use_cache:
+        with bake_stage(item, 'save'):
+            store_in_cache(settings, item.cache_key, image)
+    if item.canonical and image is not None:
+        with bake_stage(item, 'convert'):
+            pixels = read_pixels(image).copy()
+            if not item.draft:
+                keep_canonical(context, item, pixels)
+            write_pixels(image, convert_canonical(context, item, pixels))
+    item.status = 'DONE'
+    export_bake_item(context, item)
+
+def dilate_bake(context, item: BakeItem, image: bpy.types.Image):
+    """ Extends the margin-free bake by the scene bake margin, coverage is the target's UV layout """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    width, height = image.size
+    uvs = uv_triangles(item.group(settings).target, context.evaluated_depsgraph_get())
+    _, covered = rasterize_triangles(uvs, np.ones((len(uvs), 3, 1), dtype = np.float32), width, height)
+    track_memory(item, image_bytes(width, height, True) * 3 + width * height * 8 * 6)
+    write_pixels(image, dilate_margin(read_pixels(image), covered, context.scene.render.bake.margin))
+
+def begin_tile(context, item: BakeItem, tile_index: int):
+    if item.tiled is not None:
+        stop_cycles_timer(item)
+        with bake_stage(item, 'upscale'):
+            item.tiled.setup_tile(tile_index)
+        start_cycles_timer(item)
+
+def end_tile(context, item: BakeItem, tile_index: int):
+    if item.tiled is not None:
+        stop_cycles_timer(item)
+        process = item.denoise and (lambda pixels: denoise_bake(context, item, pixels, tile_index)) or None
+        with bake_stage(item, 'downscale'):
+            item.tiled.collect_tile(tile_index, process)
+
+def begin_guide(context, item: BakeItem, guide: str):
+    """ Points the bake image nodes to a float scratch image for a guide pass """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    bake_image = item.bake_image(settings)
+    stop_cycles_timer(item)
+    image = bpy.data.images.new("BakingSolution Guide", bake_image.size[0], bake_image.size[1], alpha = True, float_buffer = True)
+    image.colorspace_settings.name = 'Non-Color'
+    swap_node_images(item.group(settings).target, bake_image, image)
+    start_cycles_timer(item)
+
+def end_guide(context, item: BakeItem, guide: str):
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    stop_cycles_timer(item)
+    bake_image = item.bake_image(settings)
+    image = bpy.data.images["BakingSolution Guide"]
+    item.guides[guide] = read_pixels(image).copy()
+    swap_node_images(item.group(settings).target, image, bake_image)
+    bpy.data.images.remove(image)
+    start_cycles_timer(item)
+
+def swap_node_images(target: bpy.types.Object, image: bpy.types.Image, replacement: bpy.types.Image):
+    image_node_index.pop(target.name, None)
+    for mat in target.data.materials:
+        if mat is None or mat.node_tree is None:
+            continue
         for node in mat.node_tree.nodes:
             if node.type == 'TEX_IMAGE' and node.image == image:
-                return node, mat
-    return None, None
+                node.image = replacement
+
+def bake_islands(context, item: BakeItem, width: int, height: int, tile_index: int | None = None) -> np.ndarray:
+    """ UV island of every texel of the item's bake or of one of its tiles, -1 outside the islands """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    if item.uv_islands is None:
+        item.uv_islands = uv_islands(item.group(settings).target, context.evaluated_depsgraph_get())
+    uvs, labels = item.uv_islands
+    if tile_index is not None:
+        uvs = item.tiled.tile_uvs(uvs, tile_index)
+    return island_map(uvs, labels, width, height)
+
+def denoise_bake(context, item: BakeItem, pixels: np.ndarray, tile_index: int | None = None) -> np.ndarray:
+    """ Denoises freshly baked pixels with the item's guide passes, island by island """
+    stop_cycles_timer(item)
+    with bake_stage(item, 'denoise'):
+        normal = item.guides.get('NORMAL')
+        albedo = item.guides.get('ALBEDO')
+        islands = bake_islands(context, item, pixels.shape[1], pixels.shape[0], tile_index)
+        denoised = denoise_pixels(pixels, normal, albedo, islands)
+    if item.mode == 'MASKS':
+        denoised[..., 1:3] = pixels[..., 1:3]  # only canonical AO is noisy
+    item.guides = {}
+    return denoised
+
+# Memory Budget
+
+""" Before a queue starts every item gets an estimate of its peak memory, items over the budget
+are switched to tiled baking, then to smaller tiles, then to lower aa_scale until they fit """
+
+# Bytes per baked pixel of Blender's low and high poly BakePixel arrays and the float result
+BAKE_PIXEL_BYTES = 2 * 36 + 16
+# Bytes per triangle of the triangulated copies Blender bakes from and the Cycles BVH
+BVH_TRIANGLE_BYTES = 256
+# Smallest tile fit_memory_budget splits into before it lowers aa_scale
+MIN_TILE_SIZE = 256
+
+def physical_memory() -> int:
+    """ Installed RAM in bytes, 0 where the platform doesn't report it """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+def memory_budget(settings: BakingSolutionSettings) -> int:
+    """ Budget in bytes, 0 when there is no limit """
+    if not settings.use_memory_budget:
+        return 0
+    if settings.memory_budget > 0:
+        return settings.memory_budget * 1024 * 1024
+    return physical_memory() // 2
+
+def group_triangles(group: BakingGroup, depsgraph) -> int:
+    """ Evaluated triangles of the target and enabled sources """
+    count = 0
+    for obj in [group.target] + group.enabled_sources():
+        if obj is not None and obj.type == 'MESH':
+            count += len(obj.evaluated_get(depsgraph).data.loop_triangles)
+    return count
+
+def estimate_bake_memory(settings: BakingSolutionSettings, item: BakeItem, triangles: int) -> int:
+    """ Peak bytes of the item: the bake itself with its images, BakePixel arrays and BVH,
+    or the NumPy stages after it, whichever is bigger """
+    image = item.image(settings)
+    if image is None:
+        return 0
+    width, height = image.size[0], image.size[1]
+    final_pixels = width * height
+    if item.tiled is not None:
+        bake_w, bake_h = item.tiled.scratch_size
+        images = image_bytes(width, height, image.is_float) + image_bytes(bake_w, bake_h, image.is_float)
+        kept = final_pixels * 16  # collected tiles
+        downscale = bake_w * bake_h * 16 * 2
+    else:
+        bake_w, bake_h = int(width * item.aa_scale), int(height * item.aa_scale)
+        images = image_bytes(bake_w, bake_h, image.is_float)
+        kept = image_bytes(width, height, image.is_float)  # rollback snapshot
+        downscale = bake_w * bake_h * 16 + final_pixels * 16
+    bake_pixels = bake_w * bake_h
+    bake = images + kept + bake_pixels * BAKE_PIXEL_BYTES + triangles * BVH_TRIANGLE_BYTES
+    guides = len(denoise_guides(item)) * bake_pixels * 16
+    if item.denoise:
+        downscale += bake_pixels * (16 * 4 * 2 + 12)  # compositor images and result on an island canvas up to twice the bake, island map
+    margin = settings.use_margin_dilation and final_pixels * (16 * 3 + 8 * 6) or 0
+    return max(bake + guides, images + guides + downscale, image_bytes(width, height, image.is_float) + margin)
+
+def fit_memory_budget(context, items: list[BakeItem]) -> list[str]:
+    """ Sets memory_estimate of the items and lowers the cost of those over the budget,
+    returns a message for every item it changed or couldn't fit """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    budget = memory_budget(settings)
+    depsgraph = context.evaluated_depsgraph_get()
+    margin = context.scene.render.bake.margin
+    triangles = {}
+    messages = []
+    for item in items:
+        image = item.image(settings)
+        if image is None:
+            continue
+        if item.group_index not in triangles:
+            triangles[item.group_index] = group_triangles(item.group(settings), depsgraph)
+        item.memory_estimate = estimate_bake_memory(settings, item, triangles[item.group_index])
+        requested = (item.aa_scale, item.tile_count)
+        while budget > 0 and item.memory_estimate > budget and item.aa_scale != 1:
+            if item.tiled is None:
+                tile_size = settings.aa_tile_size
+            elif item.tiled.tile_size > MIN_TILE_SIZE:
+                tile_size = max(MIN_TILE_SIZE, item.tiled.tile_size // 2)
+            else:
+                item.aa_scale = max(1.0, item.aa_scale - 0.5)
+                tile_size = settings.aa_tile_size
+            item.tiled = None
+            if item.aa_scale != 1:
+                item.tiled = TiledBake(image, item.aa_scale, tile_size, tile_padding(margin, item.aa_scale), item.filter)
+            item.memory_estimate = estimate_bake_memory(settings, item, triangles[item.group_index])
+        if requested != (item.aa_scale, item.tile_count):
+            item.memory_note = "AA {:g} in {} tiles, was AA {:g} in {} tiles".format(item.aa_scale, item.tile_count, *requested)
+        if budget > 0 and item.memory_estimate > budget:
+            item.memory_note = (item.memory_note and item.memory_note + ", " or "") + "still over budget"
+        if item.memory_note:
+            messages.append("{}: {} ({:.0f} of {:.0f} MB)".format(
+                item.label, item.memory_note, item.memory_estimate / 1048576, budget / 1048576))
+            print(messages[-1])
+    return messages
+
+def trim_canonical_memory(settings: BakingSolutionSettings):
+    """ Drops the oldest kept canonical bakes and tangent frames past a quarter of the memory budget """
+    budget = memory_budget(settings) // 4
+    if budget <= 0:
+        return
+    for kept in (tangent_frame_cache, canonical_bakes):
+        while len(kept) > 1 and sum(entry[-1].nbytes for entry in kept.values()) > budget:
+            del kept[next(iter(kept))]
+
+# Bake Cache
+
+""" Baked results are stored on disk under a hash of everything the bake reads,
+unchanged groups are restored from there instead of baked again """
+
+CACHE_CYCLES_SETTINGS = (
+    'samples', 'use_adaptive_sampling', 'adaptive_threshold', 'max_bounces', 'diffuse_bounces',
+    'glossy_bounces', 'transmission_bounces', 'volume_bounces', 'transparent_max_bounces', 'seed')
+
+# Properties that only change how things look in the UI, or differ between background and UI sessions
+HASH_EXCLUDED_PROPERTIES = {
+    'select', 'show_expanded', 'is_active', 'show_in_editmode', 'show_on_cage', 'show_viewport', 'use_pin_to_last',
+    'is_override_data', 'persistent_uid', 'users', 'tag', 'session_uid', 'is_evaluated', 'use_extra_user'}
+# Editor layout of nodes and sockets, names like color and width shade on lights and other structs
+HASH_EXCLUDED_NODE_PROPERTIES = HASH_EXCLUDED_PROPERTIES | {
+    'location', 'width', 'width_hidden', 'height', 'dimensions', 'hide', 'show_options', 'show_preview',
+    'show_texture', 'use_custom_color', 'color'}
+
+def hash_rna(hasher, struct, exclude_images = ()):
+    """ Hashes plain properties of an RNA struct and its ID properties, IDs by name """
+    excluded = isinstance(struct, (bpy.types.Node, bpy.types.NodeSocket)) and HASH_EXCLUDED_NODE_PROPERTIES or HASH_EXCLUDED_PROPERTIES
+    for prop in struct.bl_rna.properties:
+        identifier = prop.identifier
+        if identifier == 'rna_type' or prop.type == 'COLLECTION' or identifier in excluded:
+            continue
+        value = getattr(struct, identifier, None)
+        if prop.type == 'POINTER':
+            if isinstance(value, bpy.types.Image):
+                hash_image(hasher, value, exclude_images)
+            elif isinstance(value, bpy.types.ID):
+                hasher.update(repr((identifier, value.name)).encode())
+            continue
+        if hasattr(value, '__len__') and not isinstance(value, str):
+            value = tuple(value)
+        hasher.update(repr((identifier, value)).encode())
+    if hasattr(struct, 'keys'):
+        for key in sorted(struct.keys()):  # Geometry Nodes modifier inputs live here
+            value = struct[key]
+            if isinstance(value, bpy.types.ID):
+                value = value.name
+            elif hasattr(value, 'to_dict'):
+                value = value.to_dict()
+            elif hasattr(value, 'to_list'):
+                value = value.to_list()
+            hasher.update(repr((key, value)).encode())
+
+def hash_image(hasher, image: bpy.types.Image, exclude_images = ()):
+    hasher.update(repr((image.name, image.source, tuple(image.size), image.colorspace_settings.name)).encode())
+    if image.name in exclude_images:
+        return
+    if image.source == 'FILE':
+        path = bpy.path.abspath(image.filepath)
+        hasher.update(repr((path, os.path.exists(path) and os.path.getmtime(path))).encode())
+    elif image.source == 'GENERATED' and image.is_dirty:
+        hasher.update(read_pixels(image).tobytes())
+
+def hash_node_tree(hasher, tree, exclude_images = (), visited = None):
+    visited = visited if visited is not None else set()
+    if tree is None or tree.name in visited:
+        return
+    visited.add(tree.name)
+    if tree.name == "BakingSolution" or tree.get("baking_solution_instance"):
+        # Its state follows settings already hashed per item
+        hasher.update(repr(("BakingSolution", SOLUTION_LAYOUT_VERSION)).encode())
+        return
+    for node in sorted(tree.nodes, key = lambda node: node.name):
+        hasher.update(repr((node.name, node.bl_idname)).encode())
+        hash_rna(hasher, node, exclude_images)
+        for socket in node.inputs:
+            if not socket.is_linked and hasattr(socket, 'default_value'):
+                value = socket.default_value
+                hasher.update(repr(hasattr(value, '__len__') and tuple(value) or value).encode())
+        node_tree = getattr(node, 'node_tree', None)
+        if node_tree is not None:
+            hash_node_tree(hasher, node_tree, exclude_images, visited)
+    for link in tree.links:
+        hasher.update(repr((link.from_node.name, link.from_socket.identifier, link.to_node.name, link.to_socket.identifier)).encode())
+
+def hash_mesh(hasher, mesh: bpy.types.Mesh):
+    for collection, attribute, count, dtype in (
+            (mesh.vertices, 'co', 3, np.float32),
+            (mesh.loops, 'vertex_index', 1, np.int32),
+            (mesh.polygons, 'loop_total', 1, np.int32),
+            (mesh.polygons, 'use_smooth', 1, bool),
+            (mesh.polygons, 'material_index', 1, np.int32)):
+        buffer = np.empty(len(collection) * count, dtype = dtype)
+        collection.foreach_get(attribute, buffer)
+        hasher.update(buffer.tobytes())
+    for layer in mesh.uv_layers:
+        buffer = np.empty(len(layer.data) * 2, dtype = np.float32)
+        layer.data.foreach_get('uv', buffer)
+        hasher.update(layer.name.encode())
+        hasher.update(buffer.tobytes())
+
+def hash_object(hasher, obj: bpy.types.Object, exclude_images = (), visited = None, depsgraph = None):
+    """ With a depsgraph the evaluated mesh is hashed, which covers everything modifiers, shape keys
+    and the objects and textures they point to do to the geometry """
+    hasher.update(repr((obj.name, obj.type, tuple(tuple(row) for row in obj.matrix_world))).encode())
+    for modifier in obj.modifiers:
+        hash_rna(hasher, modifier)
+    if depsgraph is not None and obj.type in SOURCE_TYPES:
+        obj_eval = obj.evaluated_get(depsgraph)
+        mesh = obj_eval.to_mesh()
+        try:
+            if mesh is not None:
+                hash_mesh(hasher, mesh)
+        finally:
+            obj_eval.to_mesh_clear()
+    elif isinstance(obj.data, bpy.types.Mesh):
+        hash_mesh(hasher, obj.data)
+    elif obj.type == 'LIGHT':
+        hash_rna(hasher, obj.data)
+        if obj.data.use_nodes:
+            hash_node_tree(hasher, obj.data.node_tree, exclude_images, visited)
+    for slot in obj.material_slots:
+        if slot.material is not None:
+            hasher.update(slot.material.name.encode())
+            hash_node_tree(hasher, slot.material.node_tree, exclude_images, visited)
+
+def object_digest(obj: bpy.types.Object, exclude_images, depsgraph, digests: dict[str, str]) -> str:
+    """ Hash of the evaluated object, memoized in digests for the items of one queue """
+    digest = digests.get(obj.name)
+    if digest is None:
+        hasher = hashlib.sha1()
+        hash_object(hasher, obj, exclude_images, None, depsgraph)
+        digest = digests[obj.name] = hasher.hexdigest()
+    return digest
+
+def bake_item_hash(context, item: BakeItem, digests: dict[str, str] | None = None) -> str:
+    scene = context.scene
+    settings = BakingSolutionSettings.from_scene(scene)
+    group = item.group(settings)
+    image = item.image(settings)
+    exclude_images = {target.image.name for g in settings.groups for target in
+        (getattr(g.image_targets, mode) for mode, _, _ in enum_solution_modes) if target.image is not None}
+    hasher = hashlib.sha1()
+    hasher.update(repr((item.mode, item.aa_scale, item.filter, item.tiled is not None and item.tiled.region)).encode())
+    hasher.update(repr((tuple(image.size), image.is_float, image.alpha_mode, image.colorspace_settings.name)).encode())
+    hasher.update(repr(sorted(bake_properties(settings, item).items())).encode())
+    solution_settings = group.solution_settings
+    node_settings = {name: getattr(solution_settings, name) for name in BakingSolutionNodeSettings.__annotations__}
+    canonical = canonical_solution_settings(settings, item)
+    if canonical is not None:
+        node_settings.update(vars(canonical))
+    hasher.update(repr(sorted(node_settings.items())).encode())
+    cycles = getattr(scene, 'cycles', None)
+    hasher.update(repr([(name, getattr(cycles, name, None)) for name in CACHE_CYCLES_SETTINGS]).encode())
+    hasher.update(repr(sorted(render_profile_values(settings, item).items())).encode())
+    hasher.update(repr((scene.render.bake.margin, scene.render.bake.margin_type)).encode())
+    if scene.world is not None:
+        hash_rna(hasher, scene.world)  # color shades without nodes
+        if scene.world.use_nodes:
+            hash_node_tree(hasher, scene.world.node_tree, exclude_images)
+    digests = digests if digests is not None else {}
+    depsgraph = context.evaluated_depsgraph_get()
+    group_objects = [obj for obj in [group.target, group.cage_object] + group.enabled_sources() if obj is not None]
+    for obj in group_objects:
+        hasher.update(object_digest(obj, exclude_images, depsgraph, digests).encode())
+    if solution_bake_modes[item.mode] == 'COMBINED' or item.masks_ao:
+        # Lights and every other rendered object shade COMBINED and occlude AO
+        names = {obj.name for obj in group_objects}
+        for obj in sorted(context.view_layer.objects, key = lambda obj: obj.name):
+            if obj.name not in names and not obj.hide_render and (obj.type in SOURCE_TYPES or obj.type == 'LIGHT'):
+                hasher.update(object_digest(obj, exclude_images, depsgraph, digests).encode())
+    return hasher.hexdigest()
+
+def cache_path(settings: BakingSolutionSettings, key: str, image: bpy.types.Image) -> str:
+    return os.path.join(bpy.path.abspath(settings.cache_dir), key + (image.is_float and '.exr' or '.png'))
+
+def store_in_cache(settings: BakingSolutionSettings, key: str, image: bpy.types.Image):
+    """ Writes to a temporary name first, parallel workers sharing the cache never read half an entry """
+    path = cache_path(settings, key, image)
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    copy = bpy.data.images.new("BakingSolution Cache", image.size[0], image.size[1], alpha = True, float_buffer = image.is_float)
+    try:
+        copy.colorspace_settings.name = image.colorspace_settings.name
+        copy.pixels.foreach_set(read_pixels(image).ravel())
+        copy.filepath_raw = temporary
+        copy.file_format = image.is_float and 'OPEN_EXR' or 'PNG'
+        copy.save()
+    finally:
+        bpy.data.images.remove(copy)
+    os.replace(temporary, path)
+    evict_bake_cache(settings)
+
+def load_from_cache(settings: BakingSolutionSettings, key: str, image: bpy.types.Image) -> np.ndarray | None:
+    """ Cached pixels for the image, None on a miss """
+    path = cache_path(settings, key, image)
+    if not os.path.exists(path):
+        return None
+    try:
+        cached = bpy.data.images.load(path, check_existing = False)
+    except RuntimeError:
+        return None  # evicted by another worker in between
+    try:
+        cached.colorspace_settings.name = image.colorspace_settings.name
+        if tuple(cached.size) != tuple(image.size):
+            return None
+        pixels = read_pixels(cached).copy()
+    finally:
+        bpy.data.images.remove(cached)
+    try:
+        os.utime(path)  # keeps recently used entries on eviction
+    except FileNotFoundError:
+        pass
+    return pixels
+
+def restore_from_cache(settings: BakingSolutionSettings, key: str, image: bpy.types.Image) -> bool:
+    pixels = load_from_cache(settings, key, image)
+    if pixels is None:
+        return False
+    write_pixels(image, pixels)
+    return True
+
+def evict_bake_cache(settings: BakingSolutionSettings):
+    """ Removes entries older than max age, then least recently used ones over max size """
+    directory = bpy.path.abspath(settings.cache_dir)
+    if not os.path.isdir(directory):
+        return
+    now = time.time()
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or os.path.splitext(name)[1] not in ('.exr', '.png'):
+            continue
+        try:
+            stat = os.stat(path)
+            if settings.cache_max_age > 0 and now - stat.st_mtime > settings.cache_max_age * 86400:
+                os.remove(path)
+                continue
+        except FileNotFoundError:
+            continue  # another worker evicted it
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= settings.cache_max_size * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def apply_bake_cache(context, items: list[BakeItem]) -> list[BakeItem]:
+    """ Restores cached items, returns the ones that still need baking """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    pending = []
+    digests = {}
+    for item in items:
+        image = item.image(settings)
+        if image is None or item.draft or not settings.use_cache:
+            pending.append(item)
+            continue
+        with bake_stage(item, 'cache'):
+            item.cache_key = bake_item_hash(context, item, digests)
+            restored = item.mode in CANONICAL_MODES and apply_canonical(context, item)
+            if not restored and not item.canonical:
+                restored = restore_from_cache(settings, item.cache_key, image)
+        if restored:
+            item.status = 'CACHED'
+            export_bake_item(context, item)
+            record_bake_stats(context, item)
+        else:
+            pending.append(item)
+    return pending
 
-def register_class(cls: type):
-    if hasattr(bpy.types, cls.__name__):
-        bpy.utils.unregister_class(getattr(bpy.types, cls.__name__))
+# Canonical Bakes
 
-    bpy.utils.register_class(cls)
-    return getattr(bpy.types, cls.__name__)
+""" Modes in CANONICAL_MODES always bake one fixed layout, the output layout is produced from
+it in NumPy, so changing the layout only converts the kept canonical pixels again (Repack,
+or a bake with the bake cache on). MASKS bake AO, roughness and metallic as RGB, NORMAL bakes object space +X+Y+Z.
+Tangent space normals are baked by Cycles directly, converting them from object space would quantize
+8-bit images twice, they are only converted from a kept object space bake """
 
-""" Thanks
-https://devtalk.blender.org/t/question-about-ui-lock-ups-when-running-a-python-script/6406/8 """
+CANONICAL_MODES = ('MASKS', 'NORMAL')
 
-def init_bake_macro():
+MASK_CHANNELS = ('AO', 'ROUGHNESS', 'METALLIC')
 
-    class BAKING_SOLUTION_OT_bake_macro(bpy.types.Macro):
-        bl_idname = "baking_solution.bake_macro"
-        bl_label = "Bake Macro"
-        bl_options = {'INTERNAL'}
+# (target name, mode) -> (bake hash, canonical pixels at output resolution)
+canonical_bakes: dict[tuple[str, str], tuple[str, np.ndarray]] = {}
 
-    class BAKING_SOLUTION_OT_set_bake_finished(bpy.types.Operator):
-        bl_idname = "baking_solution.set_bake_finished"
-        bl_label = "Bake Set Finished"
-        bl_options = {'INTERNAL'}
+# Target name -> (bake hash, image size, rasterized tangent frames)
+tangent_frame_cache: dict[str, tuple[str, tuple[int, int], np.ndarray]] = {}
 
-        def execute(self, context):
-            dns = bpy.app.driver_namespace
-            dns['bake_set_finished'] = True
+def canonical_solution_settings(settings: BakingSolutionSettings, item: BakeItem) -> SimpleNamespace | None:
+    """ Node settings the item is baked with, None when it bakes the group's own settings """
+    if not item.canonical:
+        return None
+    if item.mode == 'MASKS':
+        overrides = dict(mask_r = item.masks_ao and 'AO' or 'NONE', mask_g = 'ROUGHNESS', mask_b = 'METALLIC')
+    else:
+        overrides = dict(normal_r = 'POS_X', normal_g = 'POS_Y', normal_b = 'POS_Z', normal_tangent_space = False)
+    solution_settings = item.group(settings).solution_settings
+    values = {name: getattr(solution_settings, name) for name in BakingSolutionNodeSettings.__annotations__}
+    values.update(overrides)
+    return SimpleNamespace(**values)
+
+def target_tangent_frames(context, item: BakeItem, width: int, height: int) -> np.ndarray:
+    """ Tangent frames of the target rasterized in UV space, grown past UV islands by the bake margin """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    target = item.group(settings).target
+    cached = tangent_frame_cache.get(target.name)
+    if cached is not None and item.cache_key and cached[0] == item.cache_key and cached[1] == (width, height):
+        return cached[2]
+    uvs, corner_frames = uv_tangent_frames(target, context.evaluated_depsgraph_get())
+    frames, covered = rasterize_triangles(uvs, corner_frames, width, height)
+    frames, covered = grow_coverage(frames, covered, context.scene.render.bake.margin + 2)
+    frames[~covered] = (1, 0, 0, 1, 0, 0, 1)
+    if not item.cache_key:
+        return frames  # drafts have no key to check the frames against later
+    tangent_frame_cache.pop(target.name, None)
+    tangent_frame_cache[target.name] = (item.cache_key, (width, height), frames)
+    trim_canonical_memory(settings)
+    return frames
+
+def pack_mask_channels(channels: np.ndarray, mapping) -> np.ndarray:
+    """ Packs canonical AO/roughness/metallic pixels into the given (r, g, b) channel masks """
+    packed = np.zeros_like(channels)
+    packed[..., 3] = channels[..., 3]
+    for index, mask in enumerate(mapping):
+        if mask != 'NONE':
+            packed[..., index] = channels[..., MASK_CHANNELS.index(mask)]
+    return packed
+
+def convert_canonical(context, item: BakeItem, pixels: np.ndarray) -> np.ndarray:
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    solution_settings = item.group(settings).solution_settings
+    if item.mode == 'MASKS':
+        return pack_mask_channels(pixels, (solution_settings.mask_r, solution_settings.mask_g, solution_settings.mask_b))
+    if item.mode == 'NORMAL':
+        frames = None
+        if solution_settings.normal_tangent_space:
+            frames = target_tangent_frames(context, item, pixels.shape[1], pixels.shape[0])
+        return convert_normals(pixels, solution_settings, frames)
+    raise Exception("Unknown canonical mode {}".format(item.mode))
+
+def keep_canonical(context, item: BakeItem, pixels: np.ndarray):
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    if not item.cache_key:
+        if not settings.keep_canonical_bakes:
+            return  # nothing would read the key, skip hashing the scene
+        item.cache_key = bake_item_hash(context, item)
+    key = (item.group(settings).target.name, item.mode)
+    canonical_bakes.pop(key, None)  # newest last, trimmed first to last
+    canonical_bakes[key] = (item.cache_key, pixels)
+    trim_canonical_memory(settings)
+
+def find_canonical(settings: BakingSolutionSettings, item: BakeItem, key: str, image: bpy.types.Image) -> np.ndarray | None:
+    """ Canonical pixels baked under key, from memory or the disk cache """
+    entry = canonical_bakes.get((item.group(settings).target.name, item.mode))
+    if entry is not None and entry[0] == key and entry[1].shape[:2] == (image.size[1], image.size[0]):
+        return entry[1]
+    if not settings.use_cache:
+        return None
+    pixels = load_from_cache(settings, key, image)
+    if pixels is not None:
+        canonical_bakes[(item.group(settings).target.name, item.mode)] = (key, pixels)
+        trim_canonical_memory(settings)
+    return pixels
+
+def apply_canonical(context, item: BakeItem) -> bool:
+    """ Writes the item's output converted from a kept canonical bake, False if there is none """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    image = item.image(settings)
+    variants = [item]
+    if not item.canonical:
+        variants = [new_bake_item(settings, item.group_index, item.mode, canonical = True)]  # object space bakes convert to tangent space
+    if item.mode == 'MASKS' and not item.masks_ao:
+        variants.append(new_bake_item(settings, item.group_index, item.mode, masks_ao = True))  # AO bakes hold the rest too
+    for variant in variants:
+        key = variant is item and item.cache_key or bake_item_hash(context, variant)
+        pixels = find_canonical(settings, item, key, image)
+        if pixels is not None:
+            write_pixels(image, convert_canonical(context, item, pixels))
+            return True
+    return False
+
+# Draft Bakes
+
+""" Drafts bake one group and mode at a fraction of the output resolution with a few samples and
+no supersampling. They write into a preview image that takes the output image's place on the
+target, the output image itself is left alone. Drafts are swapped out again by the next full bake,
+Clear Drafts, or before the file is saved """
+
+# (target name, mode) -> (output image name, draft image name)
+draft_previews: dict[tuple[str, str], tuple[str, str]] = {}
+
+def draft_preview(settings: BakingSolutionSettings, target: bpy.types.Object, image: bpy.types.Image, mode: str) -> bpy.types.Image:
+    """ Draft image of the output image, created and put on the target the first time """
+    width = max(8, int(image.size[0] * settings.draft_scale))
+    height = max(8, int(image.size[1] * settings.draft_scale))
+    entry = draft_previews.get((target.name, mode))
+    draft = entry and bpy.data.images.get(entry[1])
+    if draft is None:
+        draft = bpy.data.images.new("BakingSolution Draft", width, height, alpha = True, float_buffer = image.is_float)
+        draft.colorspace_settings.name = image.colorspace_settings.name
+        swap_node_images(target, image, draft)
+        draft_previews[(target.name, mode)] = (image.name, draft.name)
+    elif tuple(draft.size) != (width, height):
+        resize_image(draft, width, height)
+    return draft
+
+def new_draft_item(settings: BakingSolutionSettings, group_index: int, mode: str) -> BakeItem:
+    item = new_bake_item(settings, group_index, mode)
+    image = item.image(settings)
+    item.label = "{} [{} draft]".format(item.group(settings).target.name, mode)
+    item.aa_scale = 1.0
+    item.tiled = None
+    item.denoise = False
+    item.draft = True
+    if image is not None:
+        item.draft_image = draft_preview(settings, item.group(settings).target, image, mode).name
+    return item
+
+def clear_draft_previews():
+    """ Puts the output images back on the targets and removes the drafts """
+    for (target_name, _), (image_name, draft_name) in draft_previews.items():
+        target = bpy.data.objects.get(target_name)
+        image = bpy.data.images.get(image_name)
+        draft = bpy.data.images.get(draft_name)
+        if draft is None:
+            continue
+        if target is not None and image is not None:
+            swap_node_images(target, draft, image)
+        bpy.data.images.remove(draft)
+    draft_previews.clear()
+
+@persistent
+def on_file_change(*args):
+    """ Drafts never reach a saved file """
+    clear_draft_previews()
+
+# Export
+
+""" Baked images are written by a thread pool: the main thread only copies the pixels out,
+PNG/TGA/EXR encoding and zlib run in the workers so the next bake starts right away """
+
+EXPORT_EXTENSIONS = {'PNG': '.png', 'OPEN_EXR': '.exr', 'TARGA': '.tga'}
+# Color depths each format can be written with
+EXPORT_DEPTHS = {'PNG': ('8', '16'), 'OPEN_EXR': ('16', '32'), 'TARGA': ('8',)}
+# Placeholders of the export path
+EXPORT_PATH_FIELDS = ('blend', 'group', 'target', 'mode', 'image')
+
+export_executor: ThreadPoolExecutor | None = None
+export_workers = 0
+# Futures of queued exports, path -> future
+export_futures: dict[str, Future] = {}
+# Errors of exports replaced by a newer export of the same path, reported with the others
+export_errors: list[str] = []
+
+def srgb_from_linear(values: np.ndarray) -> np.ndarray:
+    return np.where(values <= 0.0031308, values * 12.92, 1.055 * np.power(np.maximum(values, 0.0031308), 1 / 2.4) - 0.055)
+
+def linear_from_srgb(values: np.ndarray) -> np.ndarray:
+    return np.where(values <= 0.04045, values / 12.92, np.power((np.maximum(values, 0.04045) + 0.055) / 1.055, 2.4))
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def encode_png(pixels: np.ndarray, depth: int, level: int) -> bytes:
+    """ RGBA PNG of (h, w, 4) pixels in 0..1, bottom row first like Blender, Sub filtered """
+    height, width = pixels.shape[:2]
+    maximum = depth == 16 and 65535 or 255
+    values = np.round(np.clip(pixels[::-1], 0, 1) * maximum).astype(depth == 16 and '>u2' or np.uint8)
+    rows = values.reshape(height, -1).view(np.uint8)
+    bpp = 4 * depth // 8
+    filtered = rows.copy()
+    filtered[:, bpp:] = rows[:, bpp:] - rows[:, :-bpp]  # wraps around like PNG's modulo 256
+    data = np.concatenate((np.ones((height, 1), dtype = np.uint8), filtered), axis = 1)
+    header = struct.pack(">IIBBBBB", width, height, depth, 6, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", header) + png_chunk(b"IDAT", zlib.compress(data.tobytes(), level)) + png_chunk(b"IEND", b"")
+
+def encode_tga(pixels: np.ndarray) -> bytes:
+    """ Uncompressed 32 bit BGRA TGA, bottom row first matches Blender's order """
+    height, width = pixels.shape[:2]
+    values = np.round(np.clip(pixels, 0, 1) * 255).astype(np.uint8)[..., (2, 1, 0, 3)]
+    header = struct.pack("<BBBHHBHHHHBB", 0, 0, 2, 0, 0, 0, 0, 0, width, height, 32, 8)
+    return header + values.tobytes()
+
+def exr_attribute(name: str, kind: str, data: bytes) -> bytes:
+    return name.encode() + b"\0" + kind.encode() + b"\0" + struct.pack("<i", len(data)) + data
+
+def encode_exr(pixels: np.ndarray, half: bool, zip: bool, level: int) -> bytes:
+    """ Scanline RGBA OpenEXR, ZIP compressed in blocks of 16 lines or uncompressed """
+    height, width = pixels.shape[:2]
+    dtype, pixel_type = half and ('<f2', 1) or ('<f4', 2)
+    lines_per_block = zip and 16 or 1
+    channels = b"".join(name + b"\0" + struct.pack("<iB3xii", pixel_type, 0, 1, 1) for name in (b"A", b"B", b"G", b"R")) + b"\0"
+    window = struct.pack("<iiii", 0, 0, width - 1, height - 1)
+    header = b"\x76\x2f\x31\x01" + struct.pack("<i", 2) + \
+        exr_attribute("channels", "chlist", channels) + \
+        exr_attribute("compression", "compression", struct.pack("<B", zip and 3 or 0)) + \
+        exr_attribute("dataWindow", "box2i", window) + \
+        exr_attribute("displayWindow", "box2i", window) + \
+        exr_attribute("lineOrder", "lineOrder", struct.pack("<B", 0)) + \
+        exr_attribute("pixelAspectRatio", "float", struct.pack("<f", 1.0)) + \
+        exr_attribute("screenWindowCenter", "v2f", struct.pack("<ff", 0.0, 0.0)) + \
+        exr_attribute("screenWindowWidth", "float", struct.pack("<f", 1.0)) + b"\0"
+    # Top row first, each line holds all A values, then B, G and R
+    lines = np.ascontiguousarray(pixels[::-1][..., (3, 2, 1, 0)].transpose(0, 2, 1)).astype(dtype)
+    blocks = []
+    for y in range(0, height, lines_per_block):
+        raw = lines[y:y + lines_per_block].tobytes()
+        data = raw
+        if zip:
+            values = np.frombuffer(raw, dtype = np.uint8)
+            reordered = np.concatenate((values[0::2], values[1::2]))
+            predicted = reordered.copy()
+            predicted[1:] = reordered[1:] - reordered[:-1] + 128  # wraps around like OpenEXR's predictor
+            compressed = zlib.compress(predicted.tobytes(), level)
+            if len(compressed) < len(raw):
+                data = compressed
+        blocks.append(struct.pack("<ii", y, len(data)) + data)
+    offset = len(header) + 8 * len(blocks)
+    offsets = []
+    for block in blocks:
+        offsets.append(offset)
+        offset += len(block)
+    return header + struct.pack("<{}Q".format(len(offsets)), *offsets) + b"".join(blocks)
+
+def write_export(path: str, pixels: np.ndarray, options: dict) -> str:
+    """ Encodes and writes one image, runs in an export thread """
+    file_format = options['file_format']
+    level = int(round(options['compression'] / 100 * 9))
+    if file_format == 'OPEN_EXR':
+        data = encode_exr(pixels, options['color_depth'] != '32', options['exr_codec'] == 'ZIP', level)
+    elif file_format == 'TARGA':
+        data = encode_tga(pixels)
+    else:
+        data = encode_png(pixels, options['color_depth'] == '8' and 8 or 16, level)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    temporary = path + ".tmp"
+    with open(temporary, 'wb') as file:
+        file.write(data)
+    os.replace(temporary, path)
+    return path
+
+def export_options(settings: BakingSolutionSettings) -> dict:
+    return {
+        'file_format': settings.export_format,
+        'color_depth': settings.export_color_depth,
+        'compression': settings.export_compression,
+        'exr_codec': settings.export_exr_codec }
+
+def auto_export_options(image: bpy.types.Image) -> dict:
+    """ EXR for float images and PNG otherwise, like Blender saves generated images """
+    return {
+        'file_format': image.is_float and 'OPEN_EXR' or 'PNG',
+        'color_depth': image.is_float and '32' or '8',
+        'compression': 15,
+        'exr_codec': 'ZIP' }
+
+def export_settings_error(settings: BakingSolutionSettings) -> str:
+    """ Why the export settings can't be written, empty when they can """
+    try:
+        settings.export_path.format(**{key: "" for key in EXPORT_PATH_FIELDS})
+    except (KeyError, IndexError, ValueError, AttributeError) as error:
+        return "Export path has an unknown or malformed placeholder ({}), use {}".format(error, " ".join("{" + key + "}" for key in EXPORT_PATH_FIELDS))
+    if settings.export_color_depth not in EXPORT_DEPTHS[settings.export_format]:
+        return "{} can't be written with {} bit color, use {} bit".format(EXPORT_EXTENSIONS[settings.export_format][1:].upper(),
+            settings.export_color_depth, " or ".join(EXPORT_DEPTHS[settings.export_format]))
+    return ""
+
+def export_path(settings: BakingSolutionSettings, item: BakeItem, image: bpy.types.Image) -> str:
+    """ Expands export_path, {blend} {group} {target} {mode} and {image} are replaced """
+    fields = {
+        'blend': os.path.splitext(os.path.basename(bpy.data.filepath))[0] or "untitled",
+        'group': item.group_index,
+        'target': item.group(settings).target.name,
+        'mode': item.mode.lower(),
+        'image': image.name }
+    path = settings.export_path.format(**{key: bpy.path.clean_name(str(value)) for key, value in fields.items()})
+    return bpy.path.abspath(path) + EXPORT_EXTENSIONS[settings.export_format]
+
+def queue_export(image: bpy.types.Image, path: str, options: dict, threads: int = 0) -> Future:
+    """ Copies the pixels in the calling (main) thread, the rest runs in the export pool """
+    global export_executor, export_workers
+    pixels = read_pixels(image).copy()
+    if options['file_format'] == 'OPEN_EXR' and not image.is_float and not image.colorspace_settings.is_data:
+        pixels[..., :3] = linear_from_srgb(pixels[..., :3])
+    elif options['file_format'] != 'OPEN_EXR' and image.is_float and not image.colorspace_settings.is_data:
+        pixels[..., :3] = srgb_from_linear(pixels[..., :3])
+    workers = threads or os.cpu_count() or 1
+    if export_executor is None or export_workers != workers:
+        if export_executor is not None:
+            export_executor.shutdown(wait = False)  # queued exports still finish
+        export_executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "baking_solution_export")
+        export_workers = workers
+    previous = export_futures.get(path)
+    if previous is not None:
+        error = previous.exception()  # waits, an older export of the same file must not land last
+        if error is not None:
+            export_errors.append("{}: {}".format(path, error))
+    future = export_executor.submit(write_export, path, pixels, dict(options))
+    export_futures[path] = future
+    return future
+
+def export_bake_item(context, item: BakeItem):
+    """ Export stage of a baked or cached item """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    image = item.image(settings)
+    if not settings.use_export or image is None or item.draft:
+        return
+    with bake_stage(item, 'export'):
+        item.export_path = export_path(settings, item, image)
+        queue_export(image, item.export_path, export_options(settings), settings.export_threads)
+
+def wait_for_exports() -> list[str]:
+    """ Blocks until queued exports are written, returns their errors """
+    errors = export_errors[:]
+    export_errors.clear()
+    for path, future in list(export_futures.items()):
+        try:
+            future.result()
+        except Exception as error:
+            errors.append("{}: {}".format(path, error))
+    export_futures.clear()
+    return errors
+
+def pending_exports() -> int:
+    for error in export_errors:
+        print("Export failed: {}".format(error))
+    export_errors.clear()
+    for path, future in list(export_futures.items()):
+        if future.done():
+            if future.exception() is not None:
+                print("Export of {} failed: {}".format(path, future.exception()))
+            del export_futures[path]
+    return len(export_futures)
+
+# Synchronous bake path, safe to use without a window (blender -b)
+
+def resolve_group_indices(settings: BakingSolutionSettings, tokens) -> list[int]:
+    """ Group indices from a list of indices or target names """
+    indices = []
+    for token in tokens:
+        token = str(token).strip()
+        if token.isdigit():
+            index = int(token)
+            if index >= len(settings.groups):
+                raise ValueError("Group index {} out of range".format(index))
+            indices.append(index)
+            continue
+        matches = [i for i, group in enumerate(settings.groups) if group.target is not None and group.target.name == token]
+        if len(matches) == 0:
+            raise ValueError("No group with target '{}'".format(token))
+        indices.extend(matches)
+    return indices
+
+def save_bake_image(image: bpy.types.Image, directory: str) -> str:
+    """ Queues the baked image for export next to others as EXR (float) or PNG """
+    options = auto_export_options(image)
+    path = os.path.join(bpy.path.abspath(directory), bpy.path.clean_name(image.name) + EXPORT_EXTENSIONS[options['file_format']])
+    queue_export(image, path, options)
+    return path
+
+def bake_item_sync(context, item: BakeItem, pending: bool, output_dir: str = "") -> dict:
+    """ Bakes one item unless it came from the cache, post_bake_item rolls back whatever step fails """
+    settings = BakingSolutionSettings.from_scene(context.scene)
+    image = item.image(settings)
+    entry = {
+        'group': item.group_index,
+        'target': item.group(settings).target.name,
+        'mode': item.mode,
+        'image': image and image.name,
+        'resolution': image and [image.size[0], image.size[1]],
+        'aa_scale': item.aa_scale,
+        'memory_estimate': item.memory_estimate }
+    if item.memory_note:
+        entry['memory_note'] = item.memory_note
+    if not pending:
+        if output_dir and image is not None:
+            entry['output'] = save_bake_image(image, output_dir)
+        entry['status'] = item.status
+        entry['wall_time'] = 0.0
+        return entry
+    start = time.perf_counter()
+    try:
+        prepare_bake_item(context, item)
+        pre_bake_item(context, item)
+        for function, properties in bake_steps(settings, item):
+            if function is None:
+                bpy.ops.object.bake(**properties)  # pyright: ignore
+            else:
+                function(context, item, **properties)
+    except Exception as error:
+        entry['error'] = str(error)
+        item.status = 'FAILED'
+    finally:
+        try:
+            post_bake_item(context, item)
+        except Exception as error:
+            entry.setdefault('error', str(error))
+            item.status = 'FAILED'
+    if item.status == 'DONE' and output_dir and image is not None:
+        with bake_stage(item, 'save'):
+            entry['output'] = save_bake_image(image, output_dir)
+    record = record_bake_stats(context, item)
+    entry['bake_time'] = item.stages.get('bake', 0.0)
+    entry['downsample_time'] = item.downsample_time
+    entry['stages'] = record['stages']
+    entry['peak_image_memory'] = record['peak_image_memory']
+    entry['status'] = item.status
+    entry['wall_time'] = time.perf_counter() - start
+    if item.export_path:
+        entry['export'] = item.export_path
+    return entry
+
+def bake_items_sync(context, items: list[BakeItem], output_dir: str = "") -> list[dict]:
+    """ Bakes items one after another with blocking OBJECT_OT_bake calls """
+    clear_draft_previews()
+    bake_queue[:] = items
+    fit_memory_budget(context, items)
+    pending = apply_bake_cache(context, items)
+    report = []
+    try:
+        for item in items:
+            report.append(bake_item_sync(context, item, item in pending, output_dir))
+    finally:
+        release_source_proxies()
+        restore_solution_nodes()
+    for error in wait_for_exports():
+        print("Export failed: {}".format(error))
+        for entry in report:
+            if any(error.startswith(entry[key] + ":") for key in ('output', 'export') if entry.get(key)):
+                entry['status'] = 'FAILED'
+                entry['error'] = error
+    return report
+
+class BAKING_SOLUTION_OT_bake_batch(bpy.types.Operator):
+    bl_idname = 'baking_solution.bake_batch'
+    bl_label = "Bake Batch"
+    bl_description = "Bake groups and modes synchronously, works in background mode"
+
+    groups: StringProperty(name = "Groups", description = "Comma separated group indices or target names, empty for all enabled groups")
+    modes: StringProperty(name = "Modes", description = "Comma separated solution modes, empty for all")
+    output_dir: StringProperty(name = "Output Directory", subtype = 'DIR_PATH')
+    report_path: StringProperty(name = "Report", subtype = 'FILE_PATH', description = "JSON timing report")
+
+    @classmethod
+    def poll(cls, context):  # pyright: ignore
+        return context.scene.render.engine == 'CYCLES'
+
+    def execute(self, context):
+        settings = BakingSolutionSettings.from_scene(context.scene)
+        try:
+            group_indices = self.groups and resolve_group_indices(settings, self.groups.split(',')) or None
+        except ValueError as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+        modes = self.modes and [mode.strip().upper() for mode in self.modes.split(',')] or None
+        known = [mode for mode, _, _ in enum_solution_modes]
+        unknown = [mode for mode in modes or () if mode not in known]
+        if unknown:
+            self.report({'ERROR'}, "Unknown solution mode {}, expected {}".format(", ".join(unknown), ", ".join(known)))
+            return {'CANCELLED'}
+        error = settings.use_export and export_settings_error(settings)
+        if error:
+            self.report({'ERROR'}, error)
+            return {'CANCELLED'}
+        items = collect_bake_items(settings, group_indices, modes)
+        start = time.perf_counter()
+        entries = bake_items_sync(context, items, self.output_dir)
+        report = {
+            'blend': bpy.data.filepath,
+            'blender': bpy.app.version_string,
+            'items': entries,
+            'total_time': time.perf_counter() - start }
+        if self.report_path:
+            with open(bpy.path.abspath(self.report_path), 'w') as file:
+                json.dump(report, file, indent = 2)
+        failed = len([entry for entry in entries if entry['status'] != 'DONE'])
+        self.report({failed and 'WARNING' or 'INFO'}, "Baked {}/{} in {:.1f}s".format(len(entries) - failed, len(entries), report['total_time']))
+        return failed and {'CANCELLED'} or {'FINISHED'}  # non-zero exit of batch_bake.py
+
+# Bake Job
+
+""" The modal bake runs its steps from a timer a few at a time, Cycles bakes run as
+Blender jobs (OBJECT_OT_bake invoked), so the UI stays responsive during long queues """
+
+class BakeJob:
+    """ Steps of the pending bake items with progress, cancellation and cleanup """
+
+    # Time one timer tick may spend on steps between Cycles bakes
+    TICK_BUDGET = 0.05
+
+    def __init__(self, context, items: list[BakeItem]):
+        settings = BakingSolutionSettings.from_scene(context.scene)
+        self.items = items
+        self.steps: list[tuple[BakeItem, object, dict, float]] = []
+        self.index = 0
+        self.done_weight = 0.0
+        self.total_weight = 0.0
+        self.bake_running = False
+        self.bake_count = 0
+        self.cancel_requested = False
+        self.cancelled = False
+        self.start_time = time.perf_counter()
+        self.restore_group_index = settings.group_index
+        self.restore_mode = settings.solution_mode
+        self.restore_selection = [obj.name for obj in context.selected_objects]
+        active = context.view_layer.objects.active
+        self.restore_active = active and active.name
+
+    def add_item(self, settings: BakingSolutionSettings, item: BakeItem):
+        """ Queues the steps of an item, Cycles bakes weigh by their baked pixels """
+        image = item.image(settings)
+        weight = image is not None and image.size[0] * image.size[1] * item.aa_scale * item.aa_scale or 1.0
+        self.steps.append((item, prepare_bake_item, {}, weight * 0.05))
+        self.steps.append((item, pre_bake_item, {}, weight * 0.05))
+        for function, properties in bake_steps(settings, item):
+            self.steps.append((item, function, properties, function is None and weight or weight * 0.05))
+        self.steps.append((item, post_bake_item, {}, weight * 0.05))
+        self.total_weight = sum(step[3] for step in self.steps)
+
+    @property
+    def fraction(self) -> float:
+        return self.total_weight > 0 and min(1.0, self.done_weight / self.total_weight) or 0.0
+
+    def update_progress(self):
+        elapsed = time.perf_counter() - self.start_time
+        fraction = self.fraction
+        bake_progress.update(fraction = fraction, elapsed = elapsed, eta = fraction > 0 and elapsed * (1 - fraction) / fraction or -1.0)
+
+    def on_bake_end(self, success: bool):
+        """ Called by object_bake_complete and object_bake_cancel """
+        if not self.bake_running:
+            return
+        self.bake_running = False
+        item = self.steps[self.index - 1][0]
+        self.done_weight += self.steps[self.index - 1][3]
+        if not success:
+            # Esc seen by watch_bake_escape has set cancel_requested, then the next step cancels the queue
+            print("{}: bake {}".format(item.label, self.cancel_requested and "cancelled" or "failed"))
+            item.status = 'FAILED'
+
+    def step(self, context) -> bool:
+        """ Runs steps until a Cycles bake starts or the tick budget is spent, False once the job is over """
+        if self.bake_running:
+            if bpy.app.is_job_running('OBJECT_BAKE'):
+                return True
+            self.on_bake_end(False)  # job ended without reporting back
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.TICK_BUDGET:
+            if self.cancel_requested and not self.cancelled:
+                self.cancel(context)
+            if self.cancelled or self.index >= len(self.steps):
+                return False
+            item, function, properties, weight = self.steps[self.index]
+            if item.status == 'FAILED':
+                self.abort_item(context, item)
+                continue
+            self.index += 1
+            try:
+                if function is None:
+                    result = bpy.ops.object.bake('INVOKE_DEFAULT', **properties)  # pyright: ignore
+                    if 'RUNNING_MODAL' not in result:
+                        raise RuntimeError("Bake did not start")
+                    self.bake_running = True
+                    self.bake_count += 1
+                    bpy.ops.baking_solution.watch_bake_escape('INVOKE_DEFAULT')  # Cycles takes Esc before our modal
+                    return True
+                function(context, item, **properties)
+                if function is post_bake_item:
+                    record_bake_stats(context, item)
+            except Exception as error:
+                print("{}: {}".format(item.label, error))
+                item.status = 'FAILED'
+                if function is post_bake_item:
+                    record_bake_stats(context, item)
+                continue
+            self.done_weight += weight
+        return True
+
+    def abort_item(self, context, item: BakeItem):
+        """ Rolls back a failed item and skips its remaining steps """
+        item.status = 'FAILED'
+        post_bake_item(context, item)
+        record_bake_stats(context, item)
+        while self.index < len(self.steps) and self.steps[self.index][0] is item:
+            self.done_weight += self.steps[self.index][3]
+            self.index += 1
+
+    def cancel(self, context):
+        """ Rolls back the item in progress, items not started are left as they are """
+        self.cancelled = True
+        if self.index > 0:
+            item, function, _, _ = self.steps[self.index - 1]
+            if function is not post_bake_item and item.status in ('BAKING', 'FAILED'):
+                self.abort_item(context, item)
+        for item in self.items:
+            if item.status == 'PENDING':
+                item.status = 'CANCELLED'
+
+    def finish(self, context):
+        """ Restores what the job changed outside the baked images, safe to call in any state """
+        settings = BakingSolutionSettings.from_scene(context.scene)
+        restore_render_settings(context.scene)
+        for item in self.items:
+            if item.status == 'BAKING':
+                item.status = 'FAILED'
+                post_bake_item(context, item)
+                record_bake_stats(context, item)
+        release_source_proxies()
+        restore_solution_nodes()
+        if self.restore_group_index < len(settings.groups):
+            settings.group_index = self.restore_group_index
+        settings.solution_mode = self.restore_mode
+        update_node_solution()
+        view_layer = context.view_layer
+        for obj in view_layer.objects:
+            obj.select_set(obj.name in self.restore_selection)
+        if self.restore_active is not None and self.restore_active in view_layer.objects:
+            view_layer.objects.active = view_layer.objects[self.restore_active]
+
+# Job of the running modal bake, None when idle
+bake_job: BakeJob | None = None
+
+@persistent
+def on_bake_complete(*args):
+    if bake_job is not None:
+        bake_job.on_bake_end(True)
+
+@persistent
+def on_bake_cancel(*args):
+    """ Cycles bake was cancelled (Esc) or failed, Esc is told apart by watch_bake_escape """
+    if bake_job is not None:
+        bake_job.on_bake_end(False)
+
+class BakeQueueRunner:
+    """ Runs bake_queue as a BakeJob driven from modal """
+
+    def start_queue(self, context, items: list[BakeItem]):
+        global bake_job
+        settings = BakingSolutionSettings.from_scene(context.scene)
+        if len(items) == 0:
+            self.report({'WARNING'}, "Nothing to bake")
+            return {'CANCELLED'}
+        if not all(item.draft for item in items):
+            error = settings.use_export and export_settings_error(settings)
+            if error:
+                self.report({'ERROR'}, error)
+                return {'CANCELLED'}
+            clear_draft_previews()
+        bake_queue[:] = items
+        messages = fit_memory_budget(context, items)
+        if len(messages) > 0:
+            self.report({'WARNING'}, "{} bakes changed to fit the memory budget, see console".format(len(messages)))
+        job = BakeJob(context, items)
+        for item in apply_bake_cache(context, items):
+            job.add_item(settings, item)
+        bake_job = job
+        if len(job.steps) == 0:
+            self.finish_queue(context)
             return {'FINISHED'}
+        bake_progress.update(index = 0, total = len(items), label = "", stage = "", fraction = 0.0, elapsed = 0.0, eta = -1.0)
+
+        wm = context.window_manager
+        self.refresh = wm.event_timer_add(0.05, window = context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
 
-    register_class(BAKING_SOLUTION_OT_set_bake_finished)
-    return register_class(BAKING_SOLUTION_OT_bake_macro)
-    #if hasattr(bpy.types, 'BAKING_SOLUTION_OT_bake_macro'):
-    #    bpy.utils.unregister_class(bpy.types.BAKING_SOLUTION_OT_bake_macro)
-    #
-    #bpy.utils.register_class(BAKING_SOLUTION_OT_bake_macro)
-    #if not hasattr(bpy.types, 'BAKING_SOLUTION_OT_set_bake_finished'):
-    #    bpy.utils.register_class(BAKING_SOLUTION_OT_set_bake_finished)
-    #
-    #return bpy.types.BAKING_SOLUTION_OT_bake_macro
-
-class BAKING_SOLUTION_OT_pre_bake(bpy.types.Operator):
-    bl_idname = 'baking_solution.pre_bake'
-    bl_label = "Pre Bake"
+    def finish_queue(self, context):
+        global bake_job
+        job = bake_job
+        try:
+            job.finish(context)
+        finally:
+            bake_job = None
+        counts = {}
+        culled = 0
+        for item in bake_queue:
+            print("{}: {}".format(item.label, item.status))
+            culled += item.culled_sources
+            counts[item.status] = counts.get(item.status, 0) + 1
+        message = "Baking {}: {}/{} baked, {} from cache, {} failed, {} sources culled in {:.1f}s".format(
+            job.cancelled and "Cancelled" or "Finished", counts.get('DONE', 0), len(bake_queue),
+            counts.get('CACHED', 0), counts.get('FAILED', 0), culled, time.perf_counter() - job.start_time)
+        self.report({(job.cancelled or counts.get('FAILED')) and 'WARNING' or 'INFO'}, message)
+
+    def stop_modal(self, context):
+        context.window_manager.event_timer_remove(self.refresh)
+        self.finish_queue(context)
+        for area in context.screen.areas:
+            if area.type == 'PROPERTIES':
+                area.tag_redraw()
+
+    def modal(self, context, event):
+        job = bake_job
+        if job is None:
+            context.window_manager.event_timer_remove(self.refresh)
+            return {'CANCELLED'}
+        if event.type == 'ESC' and event.value == 'PRESS':
+            job.cancel_requested = True  # during a Cycles bake watch_bake_escape sees ESC instead
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+        try:
+            running = job.step(context)
+        except Exception:
+            self.stop_modal(context)
+            raise
+        job.update_progress()
+        if not running:
+            self.stop_modal(context)
+            return {'FINISHED'}
+        for area in context.screen.areas:
+            if area.type == 'PROPERTIES':
+                area.tag_redraw()
+        return {'PASS_THROUGH'}
+
+    def cancel(self, context):
+        """ Blender ends the modal on file load or quit """
+        if bake_job is not None:
+            bake_job.cancel_requested = True
+            bake_job.cancelled = True
+            context.window_manager.event_timer_remove(self.refresh)
+            self.finish_queue(context)
+
+class BAKING_SOLUTION_OT_watch_bake_escape(bpy.types.Operator):
+    """ Modal handlers added later run first, so this one sees Esc before the Cycles bake it
+    was started after swallows it, and passes it on to cancel that bake too """
+    bl_idname = 'baking_solution.watch_bake_escape'
+    bl_label = "Watch Bake Escape"
     bl_options = {'INTERNAL'}
 
-    image: bpy.types.Image
-    scale_w = 0
-    scale_h = 0
-    do_rescale = False
+    @classmethod
+    def poll(cls, context):  # pyright: ignore
+        return bake_job is not None
 
-    def execute(self, context):
-        print("Pre-Bake stage")
-        if self.do_rescale:
-            print("Resolution before upscale: {} {}".format(self.image.size[0], self.image.size[1]))
-            print("Scaling to: {} {}".format(self.scale_w, self.scale_h))
-            self.image.scale(self.scale_w, self.scale_h)
-            print("Resolution after upscale: {} {}".format(self.image.size[0], self.image.size[1]))
-        return {'FINISHED'}
+    def invoke(self, context, event):
+        self.job = bake_job
+        self.bake_count = bake_job.bake_count
+        context.window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        job = self.job
+        if bake_job is not job or not job.bake_running or job.bake_count != self.bake_count:
+            return {'FINISHED', 'PASS_THROUGH'}
+        if event.type == 'ESC' and event.value == 'PRESS':
+            job.cancel_requested = True
+        return {'PASS_THROUGH'}
 
-class BAKING_SOLUTION_OT_post_bake(bpy.types.Operator):
-    bl_idname = 'baking_solution.post_bake'
-    bl_label = "Post Bake"
+class BAKING_SOLUTION_OT_cancel_bake(bpy.types.Operator):
+    bl_idname = 'baking_solution.cancel_bake'
+    bl_label = "Cancel"
+    bl_description = "Stop the running bake after the current Cycles bake, Esc cancels that one too"
     bl_options = {'INTERNAL'}
 
-    image: bpy.types.Image
-    scale_w = 0
-    scale_h = 0
-    do_rescale = False
+    @classmethod
+    def poll(cls, context):  # pyright: ignore
+        return bake_job is not None
 
     def execute(self, context):
-        print("Post-Bake stage")
-        if self.do_rescale:
-            print("Resolution before downscale: {} {}".format(self.image.size[0], self.image.size[1]))
-            print("Scaling to: {} {}".format(self.scale_w, self.scale_h))
-            self.image.scale(self.scale_w, self.scale_h)
-            print("Resolution after downscale: {} {}".format(self.image.size[0], self.image.size[1]))
+        bake_job.cancel_requested = True
         return {'FINISHED'}
 
-class BAKING_SOLUTION_OT_bake_modal(bpy.types.Operator):
+class BAKING_SOLUTION_OT_bake_modal(BakeQueueRunner, bpy.types.Operator):
     bl_idname = 'baking_solution.bake_modal'
     bl_label = 'Bake'
 
+    draft: BoolProperty(name = "Draft", default = False, options = {'SKIP_SAVE'},
+        description = "Quick low resolution, low sample bake into a preview image on the target, the output image is left alone")
+
     @classmethod
     def poll(cls, context):  # pyright: ignore
-        if bpy.app.driver_namespace.get('bake_set_finished') is not None:
+        if bake_job is not None:
             return False
         if context.scene.render.engine != 'CYCLES':
             return False
         return context.scene.baking_solution.active_group is not None
 
-    def modal(self, context, event):
-        if self.dns.get('bake_set_finished'):
-            wm = context.window_manager
-            wm.event_timer_remove(self.refresh)
-            self.report({'INFO'}, "Baking Finished")
-            del bpy.app.driver_namespace['bake_set_finished']
-            return {'FINISHED'}
-        return {'PASS_THROUGH'}
-
     def invoke(self, context, event):
         settings = BakingSolutionSettings.from_scene(context.scene)
-        render = context.scene.render
         group = settings.groups[settings.group_index]
-        solution_settings = settings.active_solution_settings
-        bpy.ops.object.mode_set(mode = 'OBJECT')
-        bpy.ops.object.select_all(action = 'DESELECT')
-        for source in group.sources:
-            if source.object is not None:
-                source.object.select_set(source.is_enabled)
-        group.target.select_set(True)
-        context.view_layer.objects.active = group.target
-        # Find target image and select its node
-        target_image = getattr(group.image_targets, settings.solution_mode, None)
-        if target_image is not None:
-            node, mat = find_image_node(group.target, target_image.image)
-            if node is not None:
-                mat.node_tree.nodes.active = node
-
-        macro = init_bake_macro()
+        if group.target is None:
+            self.report({'WARNING'}, "Group has no target")
+            return {'CANCELLED'}
+        if self.draft:
+            return self.start_queue(context, [new_draft_item(settings, settings.group_index, settings.solution_mode)])
+        return self.start_queue(context, [new_bake_item(settings, settings.group_index, settings.solution_mode)])
+
+class BAKING_SOLUTION_OT_bake_all(BakeQueueRunner, bpy.types.Operator):
+    bl_idname = 'baking_solution.bake_all'
+    bl_label = 'Bake All'
+    bl_description = "Bake every enabled group in every mode that has an output image"
 
-        dns = bpy.app.driver_namespace
-        dns['bake_set_finished'] = False
-        self.dns = dns
-
-        define = _bpy.ops.macro_define
-
-        aa_scale = settings.aa_scale
-        print(settings.aa_scale)
-
-        original_w, original_h = 1, 1
-
-        prebake = BAKING_SOLUTION_OT_pre_bake
-        prebake.do_rescale = False
-        if target_image is not None and aa_scale != 1:
-            prebake.image = target_image.image
-            prebake.scale_w = target_image.image.size[0] * aa_scale
-            prebake.scale_h = target_image.image.size[1] * aa_scale
-            prebake.do_rescale = True
-        macro.define('BAKING_SOLUTION_OT_pre_bake')
-
-        bake = macro.define('OBJECT_OT_bake')
-        bake_props = bake.properties
-
-        bake_props.type=solution_bake_modes[settings.solution_mode]
-        bake_props.use_selected_to_active = True
-        bake_props.cage_extrusion = group.cage_extrusion
-        bake_props.max_ray_distance = group.max_ray_distance
-        bake_props.use_clear = True
-        bake_props.normal_r = solution_settings.normal_r
-        bake_props.normal_g = solution_settings.normal_g
-        bake_props.normal_b = solution_settings.normal_b
-        bake_props.normal_space = solution_settings.normal_tangent_space and 'TANGENT' or 'OBJECT'
-        bake_props.cage_object = group.cage_object and group.cage_object.name or ""
-        bake_props.use_cage = group.cage_object is not None
-
-        postbake = BAKING_SOLUTION_OT_post_bake
-        postbake.do_rescale = False
-        if target_image is not None and aa_scale != 1:
-            postbake.image = target_image.image
-            postbake.scale_w = target_image.image.size[0]
-            postbake.scale_h = target_image.image.size[1]
-            postbake.do_rescale = True
-        macro.define('BAKING_SOLUTION_OT_post_bake')
-
-        define(macro, 'BAKING_SOLUTION_OT_set_bake_finished')
-
-        bpy.ops.baking_solution.bake_macro('INVOKE_DEFAULT')  # pyright: ignore
+    @classmethod
+    def poll(cls, context):  # pyright: ignore
+        if bake_job is not None:
+            return False
+        if context.scene.render.engine != 'CYCLES':
+            return False
+        return len(context.scene.baking_solution.groups) > 0
 
-        wm = context.window_manager
-        self.refresh = wm.event_timer_add(0.1, window=context.window)
-        wm.modal_handler_add(self)
-        return {'RUNNING_MODAL'}
-#"""
+    def invoke(self, context, event):
+        settings = BakingSolutionSettings.from_scene(context.scene)
+        return self.start_queue(context, collect_bake_items(settings))
 
 class OperatorResetNodePropToDefaults(bpy.types.Operator):
     bl_idname = 'baking_solution.reset_node_prop'
@@ -446,7 +2963,97 @@ class OperatorUpdateNodeSolution(bpy.types.Operator):
     bl_label = "Update Solution Node"
 
     def execute(self, context):
-        update_node_solution()
+        update_node_solution(force = True)
+        return {'FINISHED'}
+
+class OperatorEstimateRaySettings(bpy.types.Operator):
+    bl_idname = 'baking_solution.estimate_ray_settings'
+    bl_label = "Estimate Ray Settings"
+    bl_description = "Set the shortest cage extrusion and ray length that still cover the chosen percentile of the target surface"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    percentile: FloatProperty(name = "Coverage", default = 99.0, min = 50.0, max = 100.0, subtype = 'PERCENTAGE')
+    samples: IntProperty(name = "Samples", default = 4096, min = 64, soft_max = 65536)
+    margin: FloatProperty(name = "Safety Margin", default = 0.05, min = 0.0, max = 1.0, subtype = 'FACTOR')
+
+    @classmethod
+    def poll(cls, context):  # pyright: ignore
+        group = BakingSolutionSettings.from_scene(context.scene).active_group
+        return group is not None and group.target is not None and group.target.type == 'MESH'
+
+    def execute(self, context):
+        group = BakingSolutionSettings.from_scene(context.scene).active_group
+        try:
+            extrusion, ray_distance, misses = estimate_ray_settings(context, group, self.samples, self.percentile, self.margin)
+        except ValueError as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+        if group.cage_object is None:
+            group.cage_extrusion = extrusion
+        group.max_ray_distance = ray_distance
+        self.report({misses and 'WARNING' or 'INFO'}, "Extrusion {:.4f}, ray length {:.4f}, {} of {} samples found no source".format(
+            extrusion, ray_distance, misses, self.samples))
+        return {'FINISHED'}
+
+class OperatorClearDraftBakes(bpy.types.Operator):
+    bl_idname = 'baking_solution.clear_draft_bakes'
+    bl_label = "Clear Drafts"
+    bl_description = "Put the output images back on the targets and remove the draft images"
+    bl_options = {'INTERNAL'}
+
+    @classmethod
+    def poll(cls, context):  # pyright: ignore
+        return bake_job is None and len(draft_previews) > 0
+
+    def execute(self, context):
+        count = len(draft_previews)
+        clear_draft_previews()
+        self.report({'INFO'}, "Removed {} drafts".format(count))
+        return {'FINISHED'}
+
+class OperatorClearBakeCache(bpy.types.Operator):
+    bl_idname = 'baking_solution.clear_bake_cache'
+    bl_label = "Clear Cache"
+    bl_options = {'INTERNAL'}
+
+    def execute(self, context):
+        settings = BakingSolutionSettings.from_scene(context.scene)
+        directory = bpy.path.abspath(settings.cache_dir)
+        removed = 0
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if os.path.splitext(name)[1] in ('.exr', '.png'):
+                    os.remove(os.path.join(directory, name))
+                    removed += 1
+        canonical_bakes.clear()
+        tangent_frame_cache.clear()
+        self.report({'INFO'}, "Removed {} cached bakes".format(removed))
+        return {'FINISHED'}
+
+class OperatorRepackCanonicalBake(bpy.types.Operator):
+    bl_idname = 'baking_solution.repack_canonical'
+    bl_label = "Repack"
+    bl_description = "Rebuild the output image of the active mode from its last bake without baking again"
+    bl_options = {'INTERNAL'}
+
+    @classmethod
+    def poll(cls, context):  # pyright: ignore
+        settings = BakingSolutionSettings.from_scene(context.scene)
+        return settings.solution_mode in CANONICAL_MODES and settings.active_group is not None and settings.active_group.target is not None
+
+    def execute(self, context):
+        settings = BakingSolutionSettings.from_scene(context.scene)
+        item = new_bake_item(settings, settings.group_index, settings.solution_mode)
+        if item.image(settings) is None:
+            self.report({'ERROR'}, "No image set for {}".format(item.label))
+            return {'CANCELLED'}
+        start = time.perf_counter()
+        item.cache_key = bake_item_hash(context, item)
+        if not apply_canonical(context, item):
+            hint = not (settings.use_cache or settings.keep_canonical_bakes) and ", with Keep for Repack or the bake cache on" or ""
+            self.report({'WARNING'}, "No bake of {} matches the current scene, bake it first{}".format(item.label, hint))
+            return {'CANCELLED'}
+        self.report({'INFO'}, "Repacked {} in {:.3f}s".format(item.label, time.perf_counter() - start))
         return {'FINISHED'}
 
 class OperatorSelectGroup(bpy.types.Operator):
@@ -461,16 +3068,107 @@ class OperatorSelectGroup(bpy.types.Operator):
 
 # Node Graph
 
-def update_node_solution():
+""" Every mode has its own subgraph prebuilt in the "BakingSolution" group, updates only
+relink the group output and patch values, so unchanged settings don't trigger shader recompiles """
+
+SOLUTION_LAYOUT_VERSION = 1
+
+SOLUTION_NODE_NAMES = (
+    "Group Input", "Group Output",
+    "COMBINED.Preview", "COMBINED.EmissionMul", "COMBINED.EmissionClamp",
+    "DIFFUSE.Emission",
+    "MASKS.AO", "MASKS.MixAO", "MASKS.Combine",
+    "NORMAL.Bump", "NORMAL.Geometry", "NORMAL.Bitangent", "NORMAL.DotX", "NORMAL.DotY", "NORMAL.DotZ",
+    "NORMAL.Separate", "NORMAL.SignR", "NORMAL.SignG", "NORMAL.SignB", "NORMAL.Combine",
+    "NORMAL.LowRangeAdd", "NORMAL.LowRangeMul", "NORMAL.Emission")
+
+def relink(links, from_socket, to_socket):
+    for link in to_socket.links:
+        if link.from_socket == from_socket:
+            return
+    unlink(links, to_socket)
+    links.new(from_socket, to_socket)
+
+def unlink(links, to_socket):
+    for link in list(to_socket.links):
+        links.remove(link)
+
+def set_default(socket, value):
+    current = socket.default_value
+    if isinstance(value, tuple):
+        if all(abs(a - b) < 1e-6 for a, b in zip(current, value)):
+            return
+    elif abs(current - value) < 1e-6:
+        return
+    socket.default_value = value
+
+def solution_state(mode, solution_settings) -> str:
+    """ Settings the graph depends on in given mode """
+    if mode == 'COMBINED':
+        values = (solution_settings.combined_emission_mul, solution_settings.combined_emission_clamp)
+    elif mode == 'MASKS':
+        values = (solution_settings.mask_r, solution_settings.mask_g, solution_settings.mask_b)
+    elif mode == 'NORMAL':
+        values = (solution_settings.normal_r, solution_settings.normal_g, solution_settings.normal_b,
+            solution_settings.normal_tangent_space, solution_settings.normal_preview_low_range)
+    elif mode in ('DIFFUSE', 'EMISSION'):
+        values = ()
+    else:
+        raise Exception("Unknown solution mode {}".format(mode))
+    return repr((mode,) + values)
+
+def update_node_solution(force = False):
+    """ Updates the node group right away, edits in the UI go through schedule_node_update """
+    global node_update_due
+    node_update_due = None  # a scheduled update would find nothing left to do
     context = bpy.context
     scene = getattr(context, "scene", bpy.data.scenes[0])
     settings = BakingSolutionSettings.from_scene(scene)
     solution_settings = settings.active_solution_settings
+    mode = settings.solution_mode
+
+    node_bake_solution = solution_base_tree(force)
+    state = solution_state(mode, solution_settings)
+    if node_bake_solution.get("baking_solution_state") == state:
+        return
+    patch_solution_tree(node_bake_solution, mode, solution_settings)
+    node_bake_solution["baking_solution_state"] = state
 
+def solution_base_tree(force = False) -> bpy.types.NodeTree:
+    """ The shared "BakingSolution" group, built when it is missing or its layout is outdated """
     node_bake_solution = bpy.data.node_groups.get("BakingSolution")
     if node_bake_solution is None:
         node_bake_solution = bpy.data.node_groups.new("BakingSolution", "ShaderNodeTree")
+    nodes = node_bake_solution.nodes
+    if force or node_bake_solution.get("baking_solution_layout") != SOLUTION_LAYOUT_VERSION or any(nodes.get(name) is None for name in SOLUTION_NODE_NAMES):
+        build_solution_tree(node_bake_solution)
+    return node_bake_solution
+
+# perf_counter time the scheduled node update is due, None when nothing is scheduled
+node_update_due: float | None = None
+
+def schedule_node_update(delay: float):
+    """ Coalesces a burst of edits into one update_node_solution after delay seconds without edits """
+    global node_update_due
+    if delay <= 0 or bpy.app.background:  # app timers never run in blender -b
+        update_node_solution()
+        return
+    node_update_due = time.perf_counter() + delay
+    if not bpy.app.timers.is_registered(run_scheduled_node_update):
+        bpy.app.timers.register(run_scheduled_node_update, first_interval = delay)
+
+def run_scheduled_node_update():
+    global node_update_due
+    if node_update_due is None or bake_job is not None:
+        node_update_due = None  # the bake job updates the nodes when it finishes
+        return None
+    remaining = node_update_due - time.perf_counter()
+    if remaining > 0:
+        return remaining
+    update_node_solution()
+    return None
 
+def build_solution_tree(node_bake_solution):
     interface = node_bake_solution.interface
 
     def clear_tree(tree):
@@ -499,10 +3197,10 @@ def update_node_solution():
         return cast(NodeTreeInterfaceSocketShader, pin('NodeSocketShader', in_out, name, description))
 
     nodes = node_bake_solution.nodes
-    #inputs = node_bake_solution.inputs
-    #outputs = node_bake_solution.outputs
     links = node_bake_solution.links
     clear_tree(nodes)
+    if "baking_solution_state" in node_bake_solution:
+        del node_bake_solution["baking_solution_state"]
 
     in_diffuse = color_pin('INPUT', "Diffuse", "Material's base color")
     in_diffuse.default_value = (0.5, 0.5, 0.5, 1.0)
@@ -520,144 +3218,214 @@ def update_node_solution():
     in_metallic.max_value = 1.0
     in_emission = color_pin('INPUT', "Emission", "Colored emission")
     in_emission.default_value = (0.0, 0.0, 0.0, 1.0)
-    out_shader = shader_pin('OUTPUT', "Shader", "Connect this to material output node as surface")
-    # print(node_bake_solution.inputs.keys())
-    node_in = nodes.new("NodeGroupInput")
-    node_out = nodes.new("NodeGroupOutput")
-    node_out.location = (1000, 0)
+    shader_pin('OUTPUT', "Shader", "Connect this to material output node as surface")
 
     T = TypeVar("T")
-    def new_node(cls: Type[T]) -> T:
-        return cast(cls, nodes.new(cls.__name__))
+    def new_node(cls: Type[T] | str, name, location) -> T:
+        node = nodes.new(isinstance(cls, str) and cls or cls.__name__)
+        node.name = name
+        node.location = location
+        return cast(cls, node)
+
+    node_in = new_node("NodeGroupInput", "Group Input", (-200, 0))
+    new_node("NodeGroupOutput", "Group Output", (2000, 0))
+
+    # Preview shader pipeline
+    node_principled = new_node("ShaderNodeBsdfPrincipled", "COMBINED.Preview", (300, 0))
+    node_principled.label = "Preview"
+    node_emission_mul = new_node(ShaderNodeMixRGB, "COMBINED.EmissionMul", (100, -400))
+    node_emission_mul.blend_type = 'MULTIPLY'
+    cast(NodeSocketFloat, node_emission_mul.inputs[0]).default_value = 1.0
+    node_emission_clamp = new_node(ShaderNodeMixRGB, "COMBINED.EmissionClamp", (-100, -400))
+    node_emission_clamp.blend_type = 'MULTIPLY'
+    cast(NodeSocketFloat, node_emission_clamp.inputs[0]).default_value = 0.0
+    node_emission_clamp.use_clamp = True
+    links.new(node_in.outputs[in_emission.name], node_emission_clamp.inputs[1])
+    links.new(node_in.outputs[in_diffuse.name], node_principled.inputs["Base Color"])
+    links.new(node_in.outputs[in_roughness.name], node_principled.inputs["Roughness"])
+    links.new(node_in.outputs[in_metallic.name], node_principled.inputs["Metallic"])
+    links.new(node_emission_mul.outputs[0], node_principled.inputs["Emission Color"])
+
+    # Diffuse bake shader pipeline (it is needed because metallic kills diffuse)
+    node_emit = new_node(ShaderNodeEmission, "DIFFUSE.Emission", (300, -800))
+    links.new(node_in.outputs[in_diffuse.name], node_emit.inputs["Color"])
+
+    # Masks bake shader pipeline
+    node_ao = new_node(ShaderNodeAmbientOcclusion, "MASKS.AO", (300, -1200))
+    node_mixao = new_node(ShaderNodeMath, "MASKS.MixAO", (500, -1200))
+    node_mixao.operation = 'MULTIPLY'
+    links.new(node_ao.outputs["AO"], node_mixao.inputs[0])
+    links.new(node_in.outputs[in_ao.name], node_mixao.inputs[1])
+    new_node("ShaderNodeCombineRGB", "MASKS.Combine", (700, -1000))
+
+    # Normal map preview
+    node_bump = new_node("ShaderNodeBump", "NORMAL.Bump", (400, -1600))
+    node_geometry = new_node(ShaderNodeNewGeometry, "NORMAL.Geometry", (200, -2000))
+    node_tgv = new_node(ShaderNodeVectorMath, "NORMAL.Bitangent", (400, -1800))
+    node_tgv.operation = 'CROSS_PRODUCT'
+    links.new(node_geometry.outputs["Tangent"], node_tgv.inputs[0])
+    links.new(node_geometry.outputs["Normal"], node_tgv.inputs[1])
+    for name, location, axis_socket in (
+            ("NORMAL.DotX", (600, -1600), node_geometry.outputs["Tangent"]),
+            ("NORMAL.DotY", (600, -1800), node_tgv.outputs[0]),
+            ("NORMAL.DotZ", (600, -2000), node_geometry.outputs["Normal"])):
+        node_dot = new_node(ShaderNodeVectorMath, name, location)
+        node_dot.operation = 'DOT_PRODUCT'
+        links.new(node_bump.outputs["Normal"], node_dot.inputs[0])
+        links.new(axis_socket, node_dot.inputs[1])
+    node_separate = new_node(ShaderNodeSeparateXYZ, "NORMAL.Separate", (600, -2200))
+    links.new(node_bump.outputs["Normal"], node_separate.inputs[0])
+    node_combine = new_node("ShaderNodeCombineRGB", "NORMAL.Combine", (1000, -1800))
+    loc_y = -1600
+    for link_name in ("R", "G", "B"):
+        node_sign = new_node(ShaderNodeMath, "NORMAL.Sign" + link_name, (800, loc_y))
+        node_sign.operation = 'MULTIPLY'
+        cast(NodeSocketFloat, node_sign.inputs[1]).default_value = 1
+        links.new(node_sign.outputs[0], node_combine.inputs[link_name])
+        loc_y -= 200
+    node_norm1 = new_node(ShaderNodeMixRGB, "NORMAL.LowRangeAdd", (1200, -1800))
+    cast(NodeSocketFloat, node_norm1.inputs[0]).default_value = 1
+    cast(NodeSocketColor, node_norm1.inputs[2]).default_value = (1,1,1,1)
+    node_norm1.blend_type = 'ADD'
+    node_norm2 = new_node(ShaderNodeMixRGB, "NORMAL.LowRangeMul", (1400, -1800))
+    cast(NodeSocketFloat ,node_norm2.inputs[0]).default_value = 1
+    cast(NodeSocketColor ,node_norm2.inputs[2]).default_value = (0.5,0.5,0.5,1)
+    node_norm2.blend_type = 'MULTIPLY'
+    links.new(node_combine.outputs["Image"], node_norm1.inputs[1])
+    links.new(node_norm1.outputs["Color"], node_norm2.inputs[1])
+    new_node(ShaderNodeEmission, "NORMAL.Emission", (1600, -1800))
+
+    node_bake_solution["baking_solution_layout"] = SOLUTION_LAYOUT_VERSION
+
+def patch_solution_tree(node_bake_solution, mode, solution_settings):
+    nodes = node_bake_solution.nodes
+    links = node_bake_solution.links
+    node_in = nodes["Group Input"]
+    node_out = nodes["Group Output"]
 
-    mode = settings.solution_mode
-    if mode == 'COMBINED':  # Preview shader pipeline
-        node_principled = nodes.new("ShaderNodeBsdfPrincipled")
-        node_principled.location = (300, 0)
-        node_principled.label = "Preview"
-
-        node_emission_mul = new_node(ShaderNodeMixRGB)
-        node_emission_mul.blend_type = 'MULTIPLY'
-        cast(NodeSocketFloat, node_emission_mul.inputs[0]).default_value = 1.0
+    if mode == 'COMBINED':
+        node_emission_mul = nodes["COMBINED.EmissionMul"]
         if solution_settings.combined_emission_clamp:
-            node_emission_clamp = new_node(ShaderNodeMixRGB)
-            node_emission_clamp.blend_type = 'MULTIPLY'
-            cast(NodeSocketFloat, node_emission_clamp.inputs[0]).default_value = 0.0
-            node_emission_clamp.use_clamp = True
-            links.new(node_in.outputs[in_emission.name], node_emission_clamp.inputs[1])
-            links.new(node_emission_clamp.outputs[0], node_emission_mul.inputs[1])
+            relink(links, nodes["COMBINED.EmissionClamp"].outputs[0], node_emission_mul.inputs[1])
         else:
-            links.new(node_in.outputs[in_emission.name], node_emission_mul.inputs[1])
+            relink(links, node_in.outputs["Emission"], node_emission_mul.inputs[1])
         emit_mul = solution_settings.combined_emission_mul
-        cast(NodeSocketColor, node_emission_mul.inputs[2]).default_value = (emit_mul, emit_mul, emit_mul, 1.0)
-        links.new(node_in.outputs[in_diffuse.name], node_principled.inputs["Base Color"])
-        links.new(node_in.outputs[in_roughness.name], node_principled.inputs["Roughness"])
-        links.new(node_in.outputs[in_metallic.name], node_principled.inputs["Metallic"])
-        links.new(node_emission_mul.outputs[0], node_principled.inputs["Emission Color"])
-        links.new(node_out.inputs[out_shader.name], node_principled.outputs["BSDF"])
-    elif mode == 'DIFFUSE':  # Diffuse bake shader pipeline (it is needed because metallic kills diffuse)
-        node_emit = nodes.new("ShaderNodeEmission")
-        node_emit.location = (300, 0)
-        links.new(node_in.outputs[in_diffuse.name], node_emit.inputs["Color"])
-        links.new(node_emit.outputs["Emission"], node_out.inputs[out_shader.name])
-    elif mode == 'MASKS':  # Masks bake shader pipeline
-        node_ao = new_node(ShaderNodeAmbientOcclusion)
-        node_ao.location = (300, -200)
-        node_mixao = new_node(ShaderNodeMath)
-        node_mixao.location = (500, -200)
-        node_mixao.operation = 'MULTIPLY'
-        links.new(node_mixao.inputs[0], node_ao.outputs["AO"])
-        links.new(node_mixao.inputs[1], node_in.outputs[in_ao.name])
-        node_combine = nodes.new("ShaderNodeCombineRGB")
-        node_combine.location = (700, 0)
+        set_default(node_emission_mul.inputs[2], (emit_mul, emit_mul, emit_mul, 1.0))
+        shader = nodes["COMBINED.Preview"].outputs["BSDF"]
+    elif mode == 'DIFFUSE':
+        shader = nodes["DIFFUSE.Emission"].outputs["Emission"]
+    elif mode == 'MASKS':
+        node_combine = nodes["MASKS.Combine"]
         out_links = {
-            'ROUGHNESS': node_in.outputs[in_roughness.name],
-            'METALLIC': node_in.outputs[in_metallic.name],
-            'AO': node_mixao.outputs[0]}
-        if solution_settings.mask_r != 'NONE':
-            links.new(out_links[solution_settings.mask_r], node_combine.inputs["R"])
-        if solution_settings.mask_g != 'NONE':
-            links.new(out_links[solution_settings.mask_g], node_combine.inputs["G"])
-        if solution_settings.mask_b != 'NONE':
-            links.new(out_links[solution_settings.mask_b], node_combine.inputs["B"])
-        links.new(node_out.inputs[out_shader.name], node_combine.outputs["Image"])
-    elif mode == 'NORMAL':  # Normal map preview
-        node_bump = nodes.new("ShaderNodeBump")
-        node_bump.location = (400, 400)
-        node_combine = nodes.new("ShaderNodeCombineRGB")
-        node_combine.location = (1000, 0)
-        color_links = {}
+            'ROUGHNESS': node_in.outputs["Roughness"],
+            'METALLIC': node_in.outputs["Metallic"],
+            'AO': nodes["MASKS.MixAO"].outputs[0]}
+        for mask, link_name in ((solution_settings.mask_r, "R"), (solution_settings.mask_g, "G"), (solution_settings.mask_b, "B")):
+            if mask == 'NONE':
+                unlink(links, node_combine.inputs[link_name])
+            else:
+                relink(links, out_links[mask], node_combine.inputs[link_name])
+        shader = node_combine.outputs["Image"]
+    elif mode == 'NORMAL':
         if solution_settings.normal_tangent_space:
-            node_geometry = new_node(ShaderNodeNewGeometry)
-            node_geometry.location = (200, 0)
-            node_tgv = new_node(ShaderNodeVectorMath)
-            node_tgv.location = (400, 200)
-            node_tgv.operation = 'CROSS_PRODUCT'
-            node_nx = new_node(ShaderNodeVectorMath)
-            node_nx.location = (600, 400)
-            node_nx.operation = 'DOT_PRODUCT'
-            node_ny = new_node(ShaderNodeVectorMath)
-            node_ny.location = (600, 200)
-            node_ny.operation = 'DOT_PRODUCT'
-            node_nz = new_node(ShaderNodeVectorMath)
-            node_nz.location = (600, 0)
-            node_nz.operation = 'DOT_PRODUCT'
-            links.new(node_tgv.inputs[0], node_geometry.outputs["Tangent"])
-            links.new(node_tgv.inputs[1], node_geometry.outputs["Normal"])
-            links.new(node_nx.inputs[0], node_bump.outputs["Normal"])
-            links.new(node_nx.inputs[1], node_geometry.outputs["Tangent"])
-            links.new(node_ny.inputs[0], node_bump.outputs["Normal"])
-            links.new(node_ny.inputs[1], node_tgv.outputs[0])
-            links.new(node_nz.inputs[0], node_bump.outputs["Normal"])
-            links.new(node_nz.inputs[1], node_geometry.outputs["Normal"])
-            color_links["X"] = node_nx.outputs[1]
-            color_links["Y"] = node_ny.outputs[1]
-            color_links["Z"] = node_nz.outputs[1]
+            color_links = {
+                "X": nodes["NORMAL.DotX"].outputs[1],
+                "Y": nodes["NORMAL.DotY"].outputs[1],
+                "Z": nodes["NORMAL.DotZ"].outputs[1]}
         else:
-            node_separate = new_node(ShaderNodeSeparateXYZ)
-            node_separate.location = (600,0)
-            links.new(node_bump.outputs["Normal"], node_separate.inputs[0])
-            color_links["X"] = node_separate.outputs["X"]
-            color_links["Y"] = node_separate.outputs["Y"]
-            color_links["Z"] = node_separate.outputs["Z"]
+            node_separate = nodes["NORMAL.Separate"]
+            color_links = {axis: node_separate.outputs[axis] for axis in ("X", "Y", "Z")}
         axis_map = {'POS_X':'X','POS_Y':'Y','POS_Z':'Z','NEG_X':'X','NEG_Y':'Y','NEG_Z':'Z'}
-        loc_y = 200
         for normal_dir, link_name in ((solution_settings.normal_r, "R"),(solution_settings.normal_g, "G"),(solution_settings.normal_b, "B")):
-            if normal_dir in ['NEG_X','NEG_Y','NEG_Z']:
-                node_neg = new_node(ShaderNodeMath)
-                node_neg.location = (800, loc_y)
-                node_neg.operation = 'MULTIPLY'
-                cast(NodeSocketFloat, node_neg.inputs[1]).default_value = -1
-                links.new(node_neg.inputs[0], color_links[axis_map[normal_dir]])
-                links.new(node_neg.outputs[0], node_combine.inputs[link_name])
-            else:
-                links.new(color_links[axis_map[normal_dir]], node_combine.inputs[link_name])
-            loc_y -= 200
-        node_emit = new_node(ShaderNodeEmission)
-        node_emit.location = (1600, 0)
-        node_out.location = (1800, 0)
+            node_sign = nodes["NORMAL.Sign" + link_name]
+            relink(links, color_links[axis_map[normal_dir]], node_sign.inputs[0])
+            set_default(node_sign.inputs[1], normal_dir in ['NEG_X','NEG_Y','NEG_Z'] and -1.0 or 1.0)
+        node_emit = nodes["NORMAL.Emission"]
         if solution_settings.normal_preview_low_range:
-            node_norm1 = new_node(ShaderNodeMixRGB)
-            node_norm1.location = (1200, 0)
-            cast(NodeSocketFloat, node_norm1.inputs[0]).default_value = 1
-            cast(NodeSocketColor, node_norm1.inputs[2]).default_value = (1,1,1,1)
-            node_norm1.blend_type = 'ADD'
-            node_norm2 = new_node(ShaderNodeMixRGB)
-            node_norm2.location = (1400, 0)
-            cast(NodeSocketFloat ,node_norm2.inputs[0]).default_value = 1
-            cast(NodeSocketColor ,node_norm2.inputs[2]).default_value = (0.5,0.5,0.5,1)
-            node_norm2.blend_type = 'MULTIPLY'
-            links.new(node_norm1.inputs[1], node_combine.outputs["Image"])
-            links.new(node_norm2.inputs[1], node_norm1.outputs["Color"])
-            links.new(node_emit.inputs["Color"], node_norm2.outputs["Color"])
+            relink(links, nodes["NORMAL.LowRangeMul"].outputs["Color"], node_emit.inputs["Color"])
         else:
-            links.new(node_emit.inputs["Color"], node_combine.outputs["Image"])
-        links.new(node_emit.outputs["Emission"], node_out.inputs[out_shader.name])
-        pass
-    elif mode == 'EMISSION': # Normal map preview
-        links.new(node_in.outputs[in_emission.name], node_out.inputs[out_shader.name])
+            relink(links, nodes["NORMAL.Combine"].outputs["Image"], node_emit.inputs["Color"])
+        shader = node_emit.outputs["Emission"]
+    elif mode == 'EMISSION':
+        shader = node_in.outputs["Emission"]
     else:
         raise Exception("Unknown solution mode {}".format(mode))
+    relink(links, shader, node_out.inputs["Shader"])
+
+# Solution Instances
+
+""" Bakes don't patch the shared group, which every material using it would recompile for.
+The group nodes of the materials a bake reads are pointed to an instance of the group for the
+item's mode and settings instead. Instances are named after their state and stay in the file
+data until it is saved, so bakes with the same settings find them ready """
+
+def solution_instance(mode: str, solution_settings) -> bpy.types.NodeTree:
+    state = solution_state(mode, solution_settings)
+    name = "BakingSolution {}".format(hashlib.sha1(repr((SOLUTION_LAYOUT_VERSION, state)).encode()).hexdigest()[:8])
+    instance = bpy.data.node_groups.get(name)
+    if instance is not None:
+        if instance.get("baking_solution_state") == state and instance.get("baking_solution_layout") == SOLUTION_LAYOUT_VERSION:
+            return instance
+        bpy.data.node_groups.remove(instance)
+    instance = solution_base_tree().copy()
+    instance.name = name
+    instance["baking_solution_instance"] = True
+    patch_solution_tree(instance, mode, solution_settings)
+    instance["baking_solution_state"] = state
+    return instance
+
+def tree_uses(tree: bpy.types.NodeTree, used: bpy.types.NodeTree, visited = None) -> bool:
+    """ Whether used is a group somewhere inside tree """
+    visited = visited if visited is not None else set()
+    if tree.name in visited:
+        return False
+    visited.add(tree.name)
+    for node in tree.nodes:
+        node_tree = getattr(node, 'node_tree', None)
+        if node_tree is not None and (node_tree == used or tree_uses(node_tree, used, visited)):
+            return True
+    return False
+
+# (material, node) names of group nodes pointed to a solution instance, restored once the bake session ends
+solution_node_swaps: set[tuple[str, str]] = set()
+
+def swap_solution_nodes(context, item: BakeItem, instance: bpy.types.NodeTree) -> bool:
+    """ Points the shared group nodes of the materials the bake reads to instance, those are the
+    selected objects, or every rendered object for modes that trace the scene. Nodes stay swapped
+    between items, consecutive items with the same instance don't touch the materials again.
+    False when a material reaches the shared group through another group, which can't be swapped """
+    base = bpy.data.node_groups.get("BakingSolution")
+    view_layer = context.view_layer
+    if solution_bake_modes[item.mode] == 'COMBINED':
+        objects = [obj for obj in view_layer.objects if not obj.hide_render]
+    else:
+        objects = view_layer.objects.selected
+    materials = {slot.material for obj in objects for slot in obj.material_slots
+        if slot.material is not None and slot.material.node_tree is not None}
+    nested = False
+    for mat in materials:
+        for node in mat.node_tree.nodes:
+            if node.type != 'GROUP' or node.node_tree == instance:
+                continue
+            node_tree = node.node_tree
+            swapped = (mat.name, node.name) in solution_node_swaps
+            if node_tree == base or swapped:
+                node.node_tree = instance  # the previous item's instance when swapped
+                solution_node_swaps.add((mat.name, node.name))
+            elif node_tree is not None and base is not None and tree_uses(node_tree, base):
+                nested = True
+    return not nested
+
+def restore_solution_nodes():
+    """ Points swapped group nodes back to the shared group, called when a bake session ends """
+    base = bpy.data.node_groups.get("BakingSolution")
+    for mat_name, node_name in solution_node_swaps:
+        mat = bpy.data.materials.get(mat_name)
+        node = mat and mat.node_tree and mat.node_tree.nodes.get(node_name)
+        if node is not None:
+            node.node_tree = base
+    solution_node_swaps.clear()
+
 
 def prop_defaults(layout, data, property, default_data, **kwargs):
     row = layout.row()
@@ -696,8 +3464,10 @@ class LayoutBakingPanel(bpy.types.Panel):
                 op_group = cast(OperatorSelectGroup, group_list.operator('baking_solution.select_group', text = "None", icon = 'DOT', emboss = is_selected))
                 op_group.select_id = id
             else:
-                op_group = cast(OperatorSelectGroup, group_list.operator('baking_solution.select_group', text = group.target.name, icon_value = layout.icon(group.target), emboss = is_selected))
+                group_row = group_list.row(align = True)
+                op_group = cast(OperatorSelectGroup, group_row.operator('baking_solution.select_group', text = group.target.name, icon_value = layout.icon(group.target), emboss = is_selected))
                 op_group.select_id = id
+                group_row.prop(group, 'is_enabled', text = "", icon = group.is_enabled and 'RESTRICT_RENDER_OFF' or 'RESTRICT_RENDER_ON', emboss = False)
             id += 1
 
         col = layout.column(align = True)
@@ -714,24 +3484,15 @@ class LayoutBakingPanel(bpy.types.Panel):
             box.prop(group, 'target')
             box.prop(group, 'cage_object')
             box.prop(group, 'cage_extrusion')
-            box.prop(group, 'max_ray_distance')
-            row = box.row()
-            row.label(text = "Source objects:")
+            row = box.row(align = True)
+            row.prop(group, 'max_ray_distance')
+            row.operator('baking_solution.estimate_ray_settings', text = "", icon = 'DRIVER_DISTANCE')
+            box.prop(group, 'source_collection')
+            row = box.row(align = True)
+            row.label(text = "Source objects: {}".format(len(group.sources)))
             row.operator('baking_solution.add_selected_to_active_group', text = "Add Selected", icon = 'ADD')
-            if len(group.sources) == 0:
-                box.label(text = "None")
-            else:
-                list = box.column()
-                obj_id = 0
-                for source in group.sources:
-                    object_row = list.row(align = True)
-                    #object_row.label(text = "[{}]".format(obj_id))
-                    #object_row.prop(obj, 'object', text = "")
-                    object_row.label(text = source.object.name, icon_value = layout.icon(source.object))#'OBJECT_DATA')
-                    object_row.prop(source, 'is_enabled', text="", icon = source.is_enabled and 'RESTRICT_RENDER_OFF' or 'RESTRICT_RENDER_ON', emboss = False)
-                    op_remove = cast(OperatorRemoveFromActiveGroup, object_row.operator('baking_solution.remove_from_active_group', text = "", icon = 'X', emboss = False))
-                    op_remove.remove_index = obj_id
-                    obj_id += 1
+            row.operator('baking_solution.remove_selected_from_active_group', text = "Remove Selected", icon = 'REMOVE')
+            box.template_list('BAKING_SOLUTION_UL_sources', "", group, "sources", group, "source_index", rows = 4)
 
 
         image_target = None
@@ -741,10 +3502,77 @@ class LayoutBakingPanel(bpy.types.Panel):
         row = layout.row()
         row.prop(settings, "aa_scale")
         row.label(text = "~{0:.0f}x Samples".format(settings.aa_scale * settings.aa_scale))
+        layout.prop(settings, "aa_filter")
+        row = layout.row()
+        row.prop(settings, "aa_tiled")
+        sub = row.row()
+        sub.active = settings.aa_tiled
+        sub.prop(settings, "aa_tile_size")
+        row = layout.row()
+        row.prop(settings, "use_memory_budget")
+        sub = row.row()
+        sub.active = settings.use_memory_budget
+        sub.prop(settings, "memory_budget")
+        row = layout.row()
+        row.prop(settings, "use_margin_dilation")
+        row.prop(context.scene.render.bake, "margin")
+
+        box = layout.box()
+        row = box.row()
+        row.prop(settings, "use_cache")
+        row.prop(settings, "keep_canonical_bakes")
+        row.operator('baking_solution.clear_bake_cache', icon = 'TRASH')
+        if settings.use_cache:
+            box.prop(settings, "cache_dir")
+            row = box.row()
+            row.prop(settings, "cache_max_size")
+            row.prop(settings, "cache_max_age")
+
+        box = layout.box()
+        box.prop(settings, "use_export")
+        if settings.use_export:
+            box.prop(settings, "export_path")
+            row = box.row()
+            row.prop(settings, "export_format", text = "")
+            row.prop(settings, "export_color_depth", expand = True)
+            row = box.row()
+            if settings.export_format == 'OPEN_EXR':
+                row.prop(settings, "export_exr_codec")
+            elif settings.export_format == 'PNG':
+                row.prop(settings, "export_compression")
+            row.prop(settings, "export_threads")
+            error = export_settings_error(settings)
+            if error:
+                box.label(text = error, icon = 'ERROR')
+            exporting = pending_exports()
+            if exporting > 0:
+                box.label(text = "Writing {} images".format(exporting), icon = 'EXPORT')
+
+        row = layout.row()
+        row.prop(settings, "use_source_culling")
+        row.prop(settings, "use_source_proxies")
+        layout.prop(settings, "log_path")
+        layout.prop(settings, "node_update_delay")
 
         row = layout.row()
         row.scale_y = 2
         row.operator('baking_solution.bake_modal', icon = 'RENDER_STILL')
+        row.operator('baking_solution.bake_all', icon = 'RENDER_ANIMATION')
+        row = layout.row(align = True)
+        op_draft = cast(BAKING_SOLUTION_OT_bake_modal, row.operator('baking_solution.bake_modal', text = "Draft", icon = 'SHADING_TEXTURE'))
+        op_draft.draft = True
+        row.prop(settings, "draft_scale", text = "Scale")
+        row.prop(settings, "draft_samples", text = "Samples")
+        row.operator('baking_solution.clear_draft_bakes', text = "", icon = 'X')
+
+        if bake_job is not None:
+            box = layout.box()
+            box.label(text = "Baking {index}/{total}: {label}".format(**bake_progress), icon = 'TIME')
+            box.progress(factor = bake_progress['fraction'], type = 'BAR', text = "{} {:.0%}".format(bake_progress['stage'], bake_progress['fraction']))
+            row = box.row()
+            eta = bake_progress['eta']
+            row.label(text = "Elapsed {:.0f}s, {}".format(bake_progress['elapsed'], eta < 0 and "estimating" or "{:.0f}s left".format(eta)))
+            row.operator('baking_solution.cancel_bake', icon = 'CANCEL')
 
         if context.scene.render.engine != 'CYCLES':
             box = layout.box()
@@ -752,7 +3580,10 @@ class LayoutBakingPanel(bpy.types.Panel):
 
         if group is not None and group.target is not None and image_target is not None and image_target.image is not None:
             node, _ = find_image_node(group.target, image_target.image)
-            if node is None:
+            if (group.target.name, settings.solution_mode) in draft_previews:
+                box = layout.box()
+                box.label(text = "Target shows the draft of this image", icon = 'INFO')
+            elif node is None:
                 box = layout.box()
                 box.label(text = "Unable to find Image Texture Node for this image", icon = 'ERROR')
 
@@ -762,6 +3593,27 @@ class LayoutBakingPanel(bpy.types.Panel):
         if image_target is not None:
             layout.prop(image_target, "image")
 
+        profile = getattr(settings.render_profiles, settings.solution_mode)
+        box = layout.box()
+        box.prop(profile, "use_profile")
+        if profile.use_profile:
+            col = box.column(align = True)
+            row = col.row(align = True)
+            row.prop(profile, "samples")
+            row.prop(profile, "max_bounces")
+            row = col.row(align = True)
+            row.prop(profile, "use_adaptive_sampling", toggle = True)
+            sub = row.row(align = True)
+            sub.active = profile.use_adaptive_sampling
+            sub.prop(profile, "adaptive_threshold")
+            row = col.row(align = True)
+            row.prop(profile, "threads")
+            row.prop(profile, "use_denoising", toggle = True)
+            if settings.solution_mode in ('COMBINED', 'MASKS'):
+                sub = col.row(align = True)
+                sub.active = profile.use_denoising
+                sub.prop(profile, "denoise_samples")
+
         if settings.solution_mode == 'COMBINED':
             box = layout.box()
             box.label(text = "Preview Settings:")
@@ -773,6 +3625,7 @@ class LayoutBakingPanel(bpy.types.Panel):
             prop_defaults(box, node_settings, 'mask_r', node_defaults, text = "", icon = 'COLOR_RED', expand = False)
             prop_defaults(box, node_settings, 'mask_g', node_defaults, text = "", icon = 'COLOR_GREEN', expand = False)
             prop_defaults(box, node_settings, 'mask_b', node_defaults, text = "", icon = 'COLOR_BLUE', expand = False)
+            box.operator('baking_solution.repack_canonical', icon = 'FILE_REFRESH')
         elif settings.solution_mode == 'NORMAL':
             box = layout.box()
             box.label(text = "Normal Channels:")
@@ -786,6 +3639,7 @@ class LayoutBakingPanel(bpy.types.Panel):
             row.label(text = "", icon = 'COLOR_BLUE')
             prop_defaults(row, node_settings, 'normal_b', node_defaults, expand = True)
             prop_defaults(box, node_settings, 'normal_tangent_space', node_defaults, expand = True)
+            box.operator('baking_solution.repack_canonical', text = "Convert", icon = 'FILE_REFRESH')
             box = layout.box()
             box.label(text = "Preview Settings:")
             prop_defaults(box, node_settings, 'normal_preview_low_range', node_defaults)
@@ -795,6 +3649,11 @@ class LayoutBakingPanel(bpy.types.Panel):
 def register():
     bpy.utils.register_class(BakingSolutionImageTarget)
     bpy.utils.register_class(BakingSolutionImageTargets)
+    bpy.utils.register_class(BakingRenderProfileCombined)
+    bpy.utils.register_class(BakingRenderProfileEmit)
+    bpy.utils.register_class(BakingRenderProfileMasks)
+    bpy.utils.register_class(BakingRenderProfileNormal)
+    bpy.utils.register_class(BakingSolutionRenderProfiles)
     bpy.utils.register_class(BakingSolutionNodeSettings)
     bpy.utils.register_class(BakingSource)
     bpy.utils.register_class(BakingGroup)
@@ -804,18 +3663,45 @@ def register():
     bpy.utils.register_class(OperatorRemoveCurrentGroup)
     bpy.utils.register_class(OperatorAddSelectedToActiveGroup)
     bpy.utils.register_class(OperatorRemoveFromActiveGroup)
-    bpy.utils.register_class(BAKING_SOLUTION_OT_pre_bake)
-    bpy.utils.register_class(BAKING_SOLUTION_OT_post_bake)
+    bpy.utils.register_class(OperatorRemoveSelectedFromActiveGroup)
+    bpy.utils.register_class(BAKING_SOLUTION_UL_sources)
+    bpy.utils.register_class(BAKING_SOLUTION_OT_watch_bake_escape)
+    bpy.utils.register_class(BAKING_SOLUTION_OT_cancel_bake)
     bpy.utils.register_class(BAKING_SOLUTION_OT_bake_modal)
+    bpy.utils.register_class(BAKING_SOLUTION_OT_bake_all)
+    bpy.utils.register_class(BAKING_SOLUTION_OT_bake_batch)
     bpy.utils.register_class(OperatorResetNodePropToDefaults)
     bpy.utils.register_class(OperatorUpdateNodeSolution)
+    bpy.utils.register_class(OperatorEstimateRaySettings)
+    bpy.utils.register_class(OperatorClearDraftBakes)
+    bpy.utils.register_class(OperatorClearBakeCache)
+    bpy.utils.register_class(OperatorRepackCanonicalBake)
     bpy.utils.register_class(OperatorSelectGroup)
     bpy.utils.register_class(LayoutBakingPanel)
     BakingSolutionSettings.register_in_scene_class()
+    bpy.app.handlers.depsgraph_update_post.append(invalidate_image_node_index)
+    bpy.app.handlers.load_post.append(invalidate_image_node_index)
+    bpy.app.handlers.object_bake_complete.append(on_bake_complete)
+    bpy.app.handlers.object_bake_cancel.append(on_bake_cancel)
+    bpy.app.handlers.save_pre.append(on_file_change)
+    bpy.app.handlers.load_pre.append(on_file_change)
 
 def unregister():
+    if bpy.app.timers.is_registered(run_scheduled_node_update):
+        bpy.app.timers.unregister(run_scheduled_node_update)
+    bpy.app.handlers.depsgraph_update_post.remove(invalidate_image_node_index)
+    bpy.app.handlers.load_post.remove(invalidate_image_node_index)
+    bpy.app.handlers.object_bake_complete.remove(on_bake_complete)
+    bpy.app.handlers.object_bake_cancel.remove(on_bake_cancel)
+    bpy.app.handlers.save_pre.remove(on_file_change)
+    bpy.app.handlers.load_pre.remove(on_file_change)
     bpy.utils.unregister_class(BakingSolutionImageTarget)
     bpy.utils.unregister_class(BakingSolutionImageTargets)
+    bpy.utils.unregister_class(BakingRenderProfileCombined)
+    bpy.utils.unregister_class(BakingRenderProfileEmit)
+    bpy.utils.unregister_class(BakingRenderProfileMasks)
+    bpy.utils.unregister_class(BakingRenderProfileNormal)
+    bpy.utils.unregister_class(BakingSolutionRenderProfiles)
     bpy.utils.unregister_class(BakingSolutionNodeSettings)
     bpy.utils.unregister_class(BakingSource)
     bpy.utils.unregister_class(BakingGroup)
@@ -825,11 +3711,19 @@ def unregister():
     bpy.utils.unregister_class(OperatorRemoveCurrentGroup)
     bpy.utils.unregister_class(OperatorAddSelectedToActiveGroup)
     bpy.utils.unregister_class(OperatorRemoveFromActiveGroup)
-    bpy.utils.unregister_class(BAKING_SOLUTION_OT_pre_bake)
-    bpy.utils.unregister_class(BAKING_SOLUTION_OT_post_bake)
+    bpy.utils.unregister_class(OperatorRemoveSelectedFromActiveGroup)
+    bpy.utils.unregister_class(BAKING_SOLUTION_UL_sources)
+    bpy.utils.unregister_class(BAKING_SOLUTION_OT_watch_bake_escape)
+    bpy.utils.unregister_class(BAKING_SOLUTION_OT_cancel_bake)
     bpy.utils.unregister_class(BAKING_SOLUTION_OT_bake_modal)
+    bpy.utils.unregister_class(BAKING_SOLUTION_OT_bake_all)
+    bpy.utils.unregister_class(BAKING_SOLUTION_OT_bake_batch)
     bpy.utils.unregister_class(OperatorResetNodePropToDefaults)
     bpy.utils.unregister_class(OperatorUpdateNodeSolution)
+    bpy.utils.unregister_class(OperatorEstimateRaySettings)
+    bpy.utils.unregister_class(OperatorClearDraftBakes)
+    bpy.utils.unregister_class(OperatorClearBakeCache)
+    bpy.utils.unregister_class(OperatorRepackCanonicalBake)
     bpy.utils.unregister_class(OperatorSelectGroup)
     bpy.utils.unregister_class(LayoutBakingPanel)
 
@@ -0,0 +1,92 @@
+# (c) grinchfox 2019
+
+""" Headless batch baking
+
+Usage:
+    blender -b --python batch_bake.py -- scene.blend [--groups 0,Body] [--modes NORMAL,MASKS]
+        [--output //baked] [--report report.json] [--threads 8]
+    blender -b --python batch_bake.py -- scene.blend --list
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+
+import bpy
+
+LIST_PREFIX = "BAKING_SOLUTION_GROUPS "
+
+
+def load_addon():
+    """ Baking Solution module, registered if it isn't enabled in preferences """
+    addon_dir = os.path.dirname(os.path.abspath(__file__))
+    init_path = os.path.join(addon_dir, "__init__.py")
+    module = None
+    for loaded in list(sys.modules.values()):
+        if os.path.abspath(getattr(loaded, "__file__", None) or "") == init_path:
+            module = loaded
+            break
+    if module is None:
+        sys.path.insert(0, os.path.dirname(addon_dir))
+        module = importlib.import_module(os.path.basename(addon_dir))
+    if not hasattr(bpy.types.Scene, "baking_solution"):
+        module.register()
+    return module
+
+
+def list_groups(module):
+    """ Enabled groups with a rough cost (baked pixels) for sharding """
+    settings = module.BakingSolutionSettings.from_scene(bpy.context.scene)
+    groups = []
+    for index, group in enumerate(settings.groups):
+        if not group.is_enabled or group.target is None:
+            continue
+        items = module.collect_bake_items(settings, [index])
+        pixels = 0
+        for item in items:
+            image = item.image(settings)
+            pixels += image.size[0] * image.size[1] * item.aa_scale * item.aa_scale
+        groups.append({'index': index, 'target': group.target.name, 'items': len(items), 'cost': pixels})
+    return groups
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = "batch_bake.py", description = "Bake Baking Solution groups without UI")
+    parser.add_argument("blend", help = "Blend file to bake")
+    parser.add_argument("--groups", default = "", help = "Comma separated group indices or target names, all enabled groups if omitted")
+    parser.add_argument("--modes", default = "", help = "Comma separated solution modes, all modes if omitted")
+    parser.add_argument("--output", default = "//baked", help = "Directory for baked images")
+    parser.add_argument("--report", default = "", help = "JSON report path")
+    parser.add_argument("--list", action = "store_true", help = "Print enabled groups as JSON and exit")
+    parser.add_argument("--threads", type = int, default = 0, help = "Render threads, 0 keeps the file setting")
+    return parser.parse_args(argv)
+
+
+def main():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    args = parse_args(argv)
+    bpy.ops.wm.open_mainfile(filepath = os.path.abspath(args.blend))
+    module = load_addon()
+    if args.list:
+        print(LIST_PREFIX + json.dumps(list_groups(module)))
+        sys.exit(0)
+    if args.threads > 0:
+        render = bpy.context.scene.render
+        render.threads_mode = 'FIXED'
+        render.threads = args.threads
+    try:
+        result = bpy.ops.baking_solution.bake_batch(
+            groups = args.groups,
+            modes = args.modes,
+            output_dir = args.output,
+            report_path = args.report and os.path.abspath(args.report))
+    except RuntimeError as error:  # error reports of the operator, e.g. an unknown mode
+        print(error)
+        sys.exit(1)
+    sys.exit(0 if result == {'FINISHED'} else 1)  # CANCELLED when any item failed
+
+
+if __name__ == "__main__":
+    main()
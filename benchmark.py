@@ -0,0 +1,262 @@
+# (c) grinchfox 2019
+
+""" Reproducible bake performance benchmark
+
+Builds a procedural high/low-poly scene, times every solution mode across
+resolutions and aa_scale values, update_node_solution and the panel draw.
+Checks jump_flood against a brute force fill first.
+
+Usage:
+    blender -b --factory-startup --python benchmark.py -- [--output results.json]
+        [--baseline baseline.json] [--threshold 0.15] [--sources 4] [--materials 3]
+        [--triangles 20000] [--resolutions 256,512] [--aa 1,2] [--samples 16] [--repeat 3] [--denoise 8]
+
+--denoise N also times COMBINED at N times the samples, once plain and once denoised from --samples.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import bpy
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from batch_bake import load_addon  # noqa: E402
+
+
+class LayoutStub:
+    """ Accepts every UILayout call so Panel.draw can be timed without a window """
+
+    def __getattr__(self, name):
+        return self._call
+
+    def _call(self, *args, **kwargs):
+        return self
+
+    def icon(self, *args, **kwargs):
+        return 0
+
+
+class PanelStub:
+    def __init__(self):
+        self.layout = LayoutStub()
+
+
+def build_scene(module, args):
+    scene = bpy.context.scene
+    scene.render.engine = 'CYCLES'
+    scene.cycles.device = 'CPU'
+    scene.cycles.samples = args.samples
+    scene.cycles.seed = 0
+    module.update_node_solution(force = True)
+    solution_group = bpy.data.node_groups["BakingSolution"]
+
+    materials = []
+    for index in range(args.materials):
+        mat = bpy.data.materials.new("Benchmark Source {}".format(index))
+        mat.use_nodes = True
+        nodes = mat.node_tree.nodes
+        nodes.clear()
+        node_group = nodes.new("ShaderNodeGroup")
+        node_group.node_tree = solution_group
+        hue = index / max(1, args.materials)
+        node_group.inputs["Diffuse"].default_value = (hue, 1 - hue, 0.5, 1)
+        node_group.inputs["Roughness"].default_value = hue
+        node_group.inputs["Metallic"].default_value = index % 2
+        node_out = nodes.new("ShaderNodeOutputMaterial")
+        mat.node_tree.links.new(node_group.outputs["Shader"], node_out.inputs["Surface"])
+        materials.append(mat)
+
+    segments = max(8, int(math.sqrt(args.triangles)))
+    sources = []
+    for index in range(args.sources):
+        angle = 2 * math.pi * index / args.sources
+        bpy.ops.mesh.primitive_uv_sphere_add(segments = segments, ring_count = max(4, segments // 2), radius = 1.0,
+            location = (0.3 * math.cos(angle), 0.3 * math.sin(angle), 0))
+        source = bpy.context.active_object
+        for mat in materials:
+            source.data.materials.append(mat)
+        material_indices = [polygon % len(materials) for polygon in range(len(source.data.polygons))]
+        source.data.polygons.foreach_set('material_index', material_indices)
+        sources.append(source)
+
+    bpy.ops.mesh.primitive_uv_sphere_add(segments = 32, ring_count = 16, radius = 1.2)
+    target = bpy.context.active_object
+    target.name = "Benchmark Target"
+    target_mat = bpy.data.materials.new("Benchmark Target")
+    target_mat.use_nodes = True
+    target.data.materials.append(target_mat)
+
+    settings = module.BakingSolutionSettings.from_scene(scene)
+    settings.use_cache = False
+    group = settings.groups.add()
+    group.target = target
+    group.cage_extrusion = 0.5
+    for source in sources:
+        module.add_object_to_sources(group.sources, source)
+    for mode, _, _ in module.enum_solution_modes:
+        image = bpy.data.images.new("Benchmark {}".format(mode), 64, 64, alpha = True, float_buffer = mode == 'NORMAL')
+        getattr(group.image_targets, mode).image = image
+        node = target_mat.node_tree.nodes.new("ShaderNodeTexImage")
+        node.image = image
+    settings.group_index = 0
+    return settings
+
+
+def brute_force_nearest(covered):
+    """ Squared distance of every pixel to its nearest covered pixel """
+    rows, columns = np.indices(covered.shape)
+    covered_rows, covered_columns = np.nonzero(covered)
+    return ((rows[..., None] - covered_rows) ** 2 + (columns[..., None] - covered_columns) ** 2).min(axis = -1)
+
+
+def check_jump_flood(module):
+    """ Sizes that are odd, non-square or smaller than the margin, checked against a brute force fill """
+    rng = np.random.default_rng(0)
+    failures = []
+    for height, width, margin in ((10, 40, 16), (51, 51, 64), (7, 3, 5), (33, 17, 40), (8, 8, 100), (1, 9, 4), (64, 13, 30)):
+        covered = rng.random((height, width)) < 0.05
+        covered[height // 2, width // 2] = True
+        nearest, distance = module.jump_flood(covered, margin)
+        expected = brute_force_nearest(covered)
+        reached = expected <= margin * margin
+        if not np.array_equal(nearest >= 0, reached) or not np.array_equal(distance[reached], expected[reached]):
+            failures.append("{}x{} margin {}".format(width, height, margin))
+    return failures
+
+
+def best_of(repeat, function):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_benchmarks(module, settings, args):
+    context = bpy.context
+    results = {}
+    group = settings.groups[0]
+    for resolution in args.resolutions:
+        for aa_scale in args.aa:
+            settings.aa_scale = aa_scale
+            for mode, _, _ in module.enum_solution_modes:
+                image = getattr(group.image_targets, mode).image
+                module.resize_image(image, resolution, resolution)
+                def bake():
+                    module.canonical_bakes.clear()  # time a real bake on every repeat
+                    module.tangent_frame_cache.clear()
+                    module.bake_items_sync(context, [module.new_bake_item(settings, 0, mode)])
+                key = "bake/{}/{}/aa{:g}".format(mode, resolution, aa_scale)
+                results[key] = best_of(args.repeat, bake)
+                print("{}: {:.3f}s".format(key, results[key]))
+
+    if args.denoise > 0:
+        profile = settings.render_profiles.COMBINED
+        profile.use_profile = True
+        profile.samples = args.samples * args.denoise
+        profile.denoise_samples = args.samples
+        settings.aa_scale = 1.0
+        image = group.image_targets.COMBINED.image
+        for resolution in args.resolutions:
+            module.resize_image(image, resolution, resolution)
+            for use_denoising in (False, True):
+                profile.use_denoising = use_denoising
+                def bake():
+                    module.bake_items_sync(context, [module.new_bake_item(settings, 0, 'COMBINED')])
+                key = "denoise/{}/{}".format(resolution, use_denoising and "denoised" or "full")
+                results[key] = best_of(args.repeat, bake)
+                print("{}: {:.3f}s".format(key, results[key]))
+        profile.use_profile = False
+
+    def rebuild():
+        module.update_node_solution(force = True)
+    results["update_node_solution/rebuild"] = best_of(args.repeat * 10, rebuild)
+
+    solution_settings = settings.active_solution_settings
+    settings.solution_mode = 'COMBINED'
+    def patch():
+        solution_settings.combined_emission_mul = solution_settings.combined_emission_mul == 1.0 and 2.0 or 1.0  # updates right away in background mode
+    results["update_node_solution/patch"] = best_of(args.repeat * 10, patch)
+
+    def switch_mode():
+        for mode, _, _ in module.enum_solution_modes:
+            settings.solution_mode = mode
+    results["update_node_solution/switch_modes"] = best_of(args.repeat * 10, switch_mode)
+
+    panel = PanelStub()
+    def draw():
+        module.LayoutBakingPanel.draw(panel, context)
+    results["panel_draw"] = best_of(args.repeat * 10, draw)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Keys slower than baseline by more than threshold """
+    regressions = []
+    for key, seconds in sorted(results.items()):
+        reference = baseline.get(key)
+        if not reference:
+            continue
+        ratio = seconds / reference
+        print("{:<40} {:>10.4f}s {:>10.4f}s {:>7.2f}x".format(key, seconds, reference, ratio))
+        if ratio > 1 + threshold:
+            regressions.append(key)
+    return regressions
+
+
+def parse_args(argv):
+    def numbers(kind):
+        return lambda text: [kind(value) for value in text.split(",")]
+    parser = argparse.ArgumentParser(prog = "benchmark.py", description = "Baking Solution performance benchmark")
+    parser.add_argument("--output", default = "", help = "JSON results path")
+    parser.add_argument("--baseline", default = "", help = "JSON results to compare against")
+    parser.add_argument("--threshold", type = float, default = 0.15, help = "Allowed slowdown ratio before failing")
+    parser.add_argument("--sources", type = int, default = 4)
+    parser.add_argument("--materials", type = int, default = 3)
+    parser.add_argument("--triangles", type = int, default = 20000, help = "Triangles per source object")
+    parser.add_argument("--resolutions", type = numbers(int), default = [256, 512])
+    parser.add_argument("--aa", type = numbers(float), default = [1.0, 2.0])
+    parser.add_argument("--samples", type = int, default = 16)
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--denoise", type = int, default = 0, help = "Sample factor of the denoise comparison, 0 skips it")
+    return parser.parse_args(argv)
+
+
+def main():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    args = parse_args(argv)
+    bpy.ops.wm.read_factory_settings(use_empty = True)
+    module = load_addon()
+    failures = check_jump_flood(module)
+    if failures:
+        print("jump_flood differs from brute force: {}".format(", ".join(failures)))
+        sys.exit(1)
+    settings = build_scene(module, args)
+    results = run_benchmarks(module, settings, args)
+    output = {
+        'blender': bpy.app.version_string,
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'results': results }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(output, file, indent = 2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('config') != output['config']:
+            print("Warning: baseline was recorded with a different configuration")
+        regressions = compare(results, baseline.get('results', {}), args.threshold)
+        if regressions:
+            print("Regressions: {}".format(", ".join(regressions)))
+            sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# (c) grinchfox 2019
+
+""" Parallel baking across Blender worker processes
+
+Runs with plain python, shards the enabled groups of a .blend across workers
+that each run batch_bake.py in background mode.
+
+Usage:
+    python parallel_bake.py scene.blend --workers 8 [--blender blender] [--modes NORMAL]
+        [--output //baked] [--report report.json] [--threads-per-worker 8]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BATCH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "batch_bake.py")
+LIST_PREFIX = "BAKING_SOLUTION_GROUPS "
+
+
+def blender_command(blender, blend, args):
+    return [blender, "-b", "--python", BATCH_SCRIPT, "--", os.path.abspath(blend)] + args
+
+
+def list_groups(blender, blend):
+    output = subprocess.run(blender_command(blender, blend, ["--list"]), capture_output = True, text = True, check = True).stdout
+    for line in output.splitlines():
+        if line.startswith(LIST_PREFIX):
+            return json.loads(line[len(LIST_PREFIX):])
+    raise RuntimeError("Unable to list groups of {}".format(blend))
+
+
+def shard_groups(groups, workers):
+    """ Longest processing time first: biggest groups go to the least loaded worker """
+    shards = [[] for _ in range(workers)]
+    loads = [0.0] * workers
+    for group in sorted(groups, key = lambda group: group['cost'], reverse = True):
+        worker = loads.index(min(loads))
+        shards[worker].append(group['index'])
+        loads[worker] += group['cost']
+    return [shard for shard in shards if len(shard) > 0]
+
+
+def merge_reports(worker_reports, wall_time):
+    items = []
+    workers = []
+    for worker, report in enumerate(worker_reports):
+        for entry in report.get('items', []):
+            entry['worker'] = worker
+            items.append(entry)
+        workers.append({'worker': worker, 'total_time': report.get('total_time'), 'items': len(report.get('items', []))})
+    busy_time = sum(worker['total_time'] or 0 for worker in workers)
+    return {
+        'items': items,
+        'workers': workers,
+        'wall_time': wall_time,
+        'busy_time': busy_time,
+        'speedup': wall_time > 0 and busy_time / wall_time or 0 }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = "parallel_bake.py", description = "Bake Baking Solution groups in parallel Blender processes")
+    parser.add_argument("blend", help = "Blend file to bake")
+    parser.add_argument("--blender", default = "blender", help = "Blender executable")
+    parser.add_argument("--workers", type = int, default = 2, help = "Number of Blender processes")
+    parser.add_argument("--threads-per-worker", type = int, default = 0, help = "Render threads per worker, 0 splits the CPU evenly")
+    parser.add_argument("--modes", default = "", help = "Comma separated solution modes, all modes if omitted")
+    parser.add_argument("--output", default = "//baked", help = "Directory for baked images")
+    parser.add_argument("--report", default = "", help = "Merged JSON report path")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    groups = list_groups(args.blender, args.blend)
+    shards = shard_groups(groups, max(1, args.workers))
+    if len(shards) == 0:
+        print("Nothing to bake")
+        return 0
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // len(shards))
+
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix = "baking_solution_") as report_dir:
+        processes = []
+        for worker, shard in enumerate(shards):
+            report_path = os.path.join(report_dir, "worker_{}.json".format(worker))
+            command = blender_command(args.blender, args.blend, [
+                "--groups", ",".join(str(index) for index in shard),
+                "--modes", args.modes,
+                "--output", args.output,
+                "--report", report_path,
+                "--threads", str(threads)])
+            print("Worker {}: groups {} with {} threads".format(worker, shard, threads))
+            processes.append((subprocess.Popen(command), report_path))
+
+        worker_reports = []
+        failed = 0
+        for process, report_path in processes:
+            if process.wait() != 0:
+                failed += 1
+            if os.path.exists(report_path):
+                with open(report_path) as file:
+                    worker_reports.append(json.load(file))
+            else:
+                worker_reports.append({})
+    report = merge_reports(worker_reports, time.perf_counter() - start)
+
+    print("Baked {} items in {:.1f}s with {} workers ({:.2f}x)".format(len(report['items']), report['wall_time'], len(shards), report['speedup']))
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file, indent = 2)
+    return failed and 1 or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))